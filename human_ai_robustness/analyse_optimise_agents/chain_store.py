@@ -0,0 +1,98 @@
+import os, pickle, glob
+import numpy as np
+
+"""
+Binary store of the steps of a Metropolis chain of the TOM params (see sample_tom_params_metropolis.py), replacing the
+text file of params that print_save_sampling_info used to append to. The store is a directory with:
+
+- meta.pkl: the names of the (free) params, and the state of the chain when the store was made (its settings)
+- chunk_<first step>.npz: a structured array with up to chunk_size rows, one per step: the step number, the params in
+  logit space (see convert_to_logit), the log likelihood, whether the candidate was accepted, the wall time of the
+  step, and the step size after the step
+
+Steps are buffered and written when there's a chunk's worth, or on flush (a partly full last chunk is topped up on the
+next flush). Chunks are written atomically, so a crash never leaves a half-written chunk. Every step is stored, so
+burn in and thinning are chosen when the samples are used (see summarise_chains.py).
+"""
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def chain_store_dtype(num_params):
+    return np.dtype([("step", np.int64), ("logit_params", np.float64, (num_params,)), ("log_prob", np.float64),
+                     ("accepted", np.int8), ("step_time", np.float64), ("step_size", np.float64)])
+
+
+class ChainStore(object):
+
+    def __init__(self, store_dir, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Open an existing store (see create_chain_store)"""
+        self.store_dir = store_dir
+        self.chunk_size = chunk_size
+        with open(os.path.join(store_dir, "meta.pkl"), 'rb') as f:
+            self.meta = pickle.load(f)
+        self.dtype = chain_store_dtype(len(self.meta["param_names"]))
+        self.buffer = []
+
+    def append(self, step, logit_params, log_prob, accepted, step_time, step_size):
+        self.buffer.append((step, logit_params, log_prob, accepted, step_time, step_size))
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        rows = np.array(self.buffer, dtype=self.dtype)
+        self.buffer = []
+        files = chunk_files(self.store_dir)
+        if len(files) > 0:
+            last_chunk = np.load(files[-1])["rows"]
+            if len(last_chunk) < self.chunk_size:
+                rows = np.concatenate([last_chunk, rows])
+        for start in range(0, len(rows), self.chunk_size):
+            write_chunk(self.store_dir, rows[start:start + self.chunk_size])
+
+    def truncate(self, num_steps):
+        """Drop any steps from num_steps on, e.g. those stored after the chain was last saved, before resuming it"""
+        self.buffer = []
+        for chunk_file in reversed(chunk_files(self.store_dir)):
+            if chunk_first_step(chunk_file) >= num_steps:
+                os.remove(chunk_file)
+            else:
+                rows = np.load(chunk_file)["rows"]
+                if rows["step"][-1] >= num_steps:
+                    write_chunk(self.store_dir, rows[rows["step"] < num_steps])
+                break
+
+
+def create_chain_store(store_dir, param_names, chain_state, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Make a new (empty) store. chain_state is the state of the chain (see MetropolisChain.get_state), which gives
+    the settings of the chain when it's resumed from the store"""
+    os.makedirs(store_dir, exist_ok=True)
+    for chunk_file in chunk_files(store_dir):
+        os.remove(chunk_file)
+    with open(os.path.join(store_dir, "meta.pkl.tmp"), 'wb') as f:
+        pickle.dump({"param_names": list(param_names), "chain_state": chain_state}, f)
+    os.replace(os.path.join(store_dir, "meta.pkl.tmp"), os.path.join(store_dir, "meta.pkl"))
+    return ChainStore(store_dir, chunk_size)
+
+def chunk_files(store_dir):
+    return sorted(glob.glob(os.path.join(store_dir, "chunk_*.npz")))
+
+def chunk_first_step(chunk_file):
+    return int(os.path.basename(chunk_file)[len("chunk_"):-len(".npz")])
+
+def write_chunk(store_dir, rows):
+    chunk_file = os.path.join(store_dir, "chunk_{:09d}.npz".format(rows["step"][0]))
+    with open(chunk_file + ".tmp", 'wb') as f:
+        np.savez(f, rows=rows)
+    os.replace(chunk_file + ".tmp", chunk_file)
+
+def load_chain(store_dir):
+    """All the steps in the store (as one structured array, in order of step), and its meta"""
+    with open(os.path.join(store_dir, "meta.pkl"), 'rb') as f:
+        meta = pickle.load(f)
+    chunks = [np.load(chunk_file)["rows"] for chunk_file in chunk_files(store_dir)]
+    if len(chunks) == 0:
+        return np.zeros(0, dtype=chain_store_dtype(len(meta["param_names"]))), meta
+    return np.concatenate(chunks), meta
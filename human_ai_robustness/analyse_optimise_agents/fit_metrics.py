@@ -0,0 +1,60 @@
+import numpy as np
+
+"""
+Metrics of how well a human model (several copies of a TOM or HM) fits the human data, used by the fitting scripts
+(sample_tom_params_metropolis.py, zeroth_order_opt_active_states.py). Each takes copy_actions, an array of shape
+(number of states, number of copies) with the action each copy of the model chose in each state in which the data acts
+(as indices in Action.ALL_ACTIONS), and data_actions, the action of the data in each of those states.
+"""
+
+# Min prob of the data's action (otherwise we get infinities in the cross entropy):
+MIN_PROB = 0.01
+
+
+def probs_data_action(copy_actions, data_actions):
+    """Prob that the model takes the data's action in each state: the fraction of copies that choose it, with a minimum
+    of MIN_PROB"""
+    probs = np.mean(copy_actions == np.asarray(data_actions)[:, None], axis=1)
+    probs[probs == 0] = MIN_PROB
+    return probs
+
+def log_likelihood(copy_actions, data_actions):
+    return float(np.sum(np.log(probs_data_action(copy_actions, data_actions))))
+
+def cross_entropy_loss(copy_actions, data_actions):
+    """Cross entropy loss, with each state's loss normalised by log(MIN_PROB), so that it's at most 1"""
+    return log_likelihood(copy_actions, data_actions) / np.log(MIN_PROB)
+
+def top_two_actions(copy_actions):
+    """The most and 2nd most frequent action of the copies in each state (-1 if the copies all chose the same action).
+    Draws go to the action chosen by the earliest copy, as with Counter.most_common"""
+    num_states, num_copies = copy_actions.shape
+    num_actions = max(int(np.max(copy_actions)) + 1 if copy_actions.size > 0 else 0, 2)
+    states = np.arange(num_states)[:, None]
+    counts = np.zeros((num_states, num_actions), dtype=int)
+    np.add.at(counts, (states, copy_actions), 1)
+    first_copy = np.full((num_states, num_actions), num_copies)
+    np.minimum.at(first_copy, (states, copy_actions), np.arange(num_copies))
+    # Order by count, then by the first copy to choose the action:
+    score = counts * (num_copies + 1) - first_copy
+    top_action = np.argmax(score, axis=1)
+    score[np.arange(num_states), top_action] = -num_copies - 1
+    second_action = np.argmax(score, axis=1)
+    second_action[counts[np.arange(num_states), second_action] == 0] = -1
+    return top_action, second_action
+
+def top_12_accuracy(copy_actions, data_actions):
+    """
+    Top-1 (top-2) accuracy, which is the proportion of states in which the model's most likely (or 2nd most likely)
+    action equals the action from the data
+    """
+    #TODO: Here we're ignoring draws between two actions:
+    top_action, second_action = top_two_actions(copy_actions)
+    top_1 = top_action == data_actions
+    top_2 = top_1 | (second_action == data_actions)
+    return float(np.mean(top_1)), float(np.mean(top_2))
+
+def prob_not_acting(acting):
+    """Probability of the data not acting, and the number of states in which it acts, from whether it acts in each
+    (player) state"""
+    return float(1 - np.mean(acting)), int(np.sum(acting))
@@ -0,0 +1,74 @@
+import numpy as np
+
+"""
+Convergence diagnostics for the Metropolis chains of the TOM params (see metropolis_multi_chain.py): the split R-hat
+(Gelman-Rubin) and the effective sample size (ESS) of each param, computed across chains as in Gelman et al., BDA3
+(and Stan). Each function takes the samples of one param as an array of shape (num_chains, num_samples).
+"""
+
+
+def autocorrelation(x):
+    """Autocorrelation of the 1d series x at every lag (0, 1, ..., len(x)-1), found with an FFT"""
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    x = x - np.mean(x)
+    # Pad to avoid the circular correlation wrapping around:
+    fft = np.fft.rfft(x, n=2 * n)
+    acov = np.fft.irfft(fft * np.conjugate(fft))[:n] / n
+    if acov[0] == 0:
+        return np.concatenate([[1.], np.zeros(n - 1)])  # Constant series (e.g. nothing accepted yet)
+    return acov / acov[0]
+
+def split_chains(chains):
+    """Split each chain in half, so that R-hat also picks up chains that haven't yet converged within themselves"""
+    chains = np.asarray(chains, dtype=float)
+    half = chains.shape[1] // 2
+    return np.concatenate([chains[:, :half], chains[:, -half:]]) if half > 0 else chains
+
+def split_rhat(chains):
+    """R-hat of one param. Close to 1 (e.g. < 1.1) means the chains agree. Needs at least 4 samples per chain"""
+    chains = split_chains(chains)
+    num_samples = chains.shape[1]
+    if num_samples < 2:
+        return np.nan
+    within_var = np.mean(np.var(chains, axis=1, ddof=1))
+    between_var = num_samples * np.var(np.mean(chains, axis=1), ddof=1)
+    if within_var == 0:
+        return np.nan if between_var == 0 else np.inf
+    var_plus = (num_samples - 1) / num_samples * within_var + between_var / num_samples
+    return np.sqrt(var_plus / within_var)
+
+def effective_sample_size(chains):
+    """ESS of one param, over all chains. The autocorrelations are summed in pairs (Geyer's initial positive
+    sequence), stopping at the first negative pair"""
+    chains = split_chains(chains)
+    num_chains, num_samples = chains.shape
+    if num_samples < 2:
+        return np.nan
+    chain_vars = np.var(chains, axis=1, ddof=1)
+    within_var = np.mean(chain_vars)
+    var_plus = (num_samples - 1) / num_samples * within_var
+    if num_chains > 1:
+        var_plus += np.var(np.mean(chains, axis=1), ddof=1)
+    if var_plus == 0:
+        return np.nan
+    acov = np.array([autocorrelation(chain) * chain_var * (num_samples - 1) / num_samples
+                     for chain, chain_var in zip(chains, chain_vars)])
+    rho = 1 - (within_var - np.mean(acov, axis=0)) / var_plus
+    rho[0] = 1
+    sum_rho = 0
+    for t in range(0, num_samples - 1, 2):
+        pair = rho[t] + rho[t + 1]
+        if pair < 0:
+            break
+        sum_rho += pair
+    tau = max(2 * sum_rho - 1, 1 / np.log10(num_chains * num_samples + 1))  # (Stan's cap on very anticorrelated)
+    return num_chains * num_samples / tau
+
+def diagnose(samples_each_chain, param_names):
+    """samples_each_chain: list (one per chain) of arrays of shape (num_samples, num_params). The chains are cut to
+    the same length. Returns param name -> (R-hat, ESS)"""
+    num_samples = min(len(samples) for samples in samples_each_chain)
+    stacked = np.array([np.asarray(samples)[-num_samples:] for samples in samples_each_chain])
+    return {name: (split_rhat(stacked[:, :, i]), effective_sample_size(stacked[:, :, i]))
+            for i, name in enumerate(param_names)}
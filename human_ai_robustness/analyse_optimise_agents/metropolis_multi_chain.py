@@ -0,0 +1,231 @@
+import time, os, pickle, random, copy
+import multiprocessing
+import logging
+import numpy as np
+from argparse import ArgumentParser
+from human_aware_rl.data_dir import DATA_DIR
+from human_aware_rl.utils import create_dir_if_not_exists
+from human_ai_robustness.analyse_optimise_agents.sample_tom_params_metropolis import MetropolisChain, \
+    load_data_index, make_starting_person_params, make_params, make_mlp, free_param_names
+from human_ai_robustness.analyse_optimise_agents.mcmc_diagnostics import diagnose
+
+"""
+Run several Metropolis chains of the TOM params (see sample_tom_params_metropolis.py) in parallel, optionally with
+parallel tempering, and report cross-chain diagnostics (R-hat and ESS of each param) as they run.
+
+There are num_chains independent "ladders", each with num_temps chains at inverse temperatures 1 > ... > 1/max_temp.
+Only the temperature 1 (cold) chain of each ladder samples the actual posterior: the hotter chains sample a flatter
+version of it, so they move between modes more easily. Every steps_per_round steps, neighbouring chains of a ladder
+propose to swap their params (replica exchange), which lets the cold chain pick up the modes found by the hot chains.
+With num_temps = 1 this is just num_chains independent chains.
+
+Each chain is a MetropolisChain, and the chains are run in a pool of worker processes. Each worker loads the human data
+index (memory-mapped, so the workers share it) and makes the planner once (init_worker), then runs segments of steps_per_round steps of any chain: the full state of
+the chain (including its RNG state) goes to the worker with the segment, so the result doesn't depend on which worker
+runs it. The state of the whole sampler is saved after each round, so it can be resumed with --resume.
+"""
+
+# The data and planner of this worker process (see init_worker):
+worker_data = {}
+
+
+def init_worker(params):
+    worker_data["data_index"] = load_data_index(params["MDP_PARAMS"]["layout_name"], params)
+    worker_data["mlp"] = make_mlp(params)
+    logging.getLogger().setLevel(logging.ERROR)
+
+def run_chain_segment(chain_state, num_steps):
+    """Run the chain for num_steps steps. Returns the new state of the chain, and the (free) params and log likelihood
+    after each step"""
+    chain = MetropolisChain.from_state(chain_state, worker_data["mlp"], worker_data["data_index"])
+    param_names = free_param_names(chain.params)
+    samples, log_probs = [], []
+    for _ in range(num_steps):
+        chain.step()
+        samples.append([chain.params['PERSON_PARAMS_TOM'][pparam] for pparam in param_names])
+        log_probs.append(chain.current_log_prob)
+    return chain.get_state(), samples, log_probs
+
+def temperature_ladder(num_temps, max_temp):
+    """Inverse temperatures, geometrically spaced from 1 down to 1/max_temp"""
+    return list(1 / np.geomspace(1, max_temp, num_temps)) if num_temps > 1 else [1.]
+
+def make_chain_states(params, starting_params, num_chains, num_temps, max_temp, num_ep_to_use, epsilon_sd, step_size,
+                      filename_base, seed, num_screen_ep=0):
+    """The initial state of every chain, ordered by ladder then temperature. Each chain has its own RNG seed (and its
+    own random starting params if starting_params is 9)"""
+    chain_states = []
+    for ladder in range(num_chains):
+        for temp_idx, inverse_temp in enumerate(temperature_ladder(num_temps, max_temp)):
+            chain_seed = seed + len(chain_states)
+            np.random.seed(chain_seed)
+            random.seed(chain_seed)
+            chain_params = copy.deepcopy(params)
+            chain_params['PERSON_PARAMS_TOM'] = make_starting_person_params(starting_params)
+            chain_name = '_chain{}_temp{}'.format(ladder, np.round(1 / inverse_temp, 2))
+            # Only the cold chains record their steps (in a chain store):
+            store_dir = filename_base.replace('MULTI_', 'CHAIN_STORE_') + chain_name + '/' if temp_idx == 0 else None
+            chain = MetropolisChain(chain_params, None, None, num_ep_to_use, epsilon_sd, step_size,
+                                    filename_base + chain_name + '.txt', store_dir, None, inverse_temp,
+                                    num_screen_ep=num_screen_ep)
+            chain_states.append(chain.get_state())
+    return chain_states
+
+def propose_swaps(chain_states, num_temps, swap_stats, swap_rng):
+    """Replica exchange between neighbouring temperatures of each ladder. Swapping the params of chains a and b (with
+    their log likelihoods, and screen log likelihoods for delayed acceptance) is accepted with prob
+    min(1, exp((beta_a - beta_b) * (log_prob_b - log_prob_a))), where beta is the inverse temperature.
+    swap_stats[temp_idx] counts [accepted, proposed] swaps between temp_idx and temp_idx + 1"""
+    for ladder_start in range(0, len(chain_states), num_temps):
+        for temp_idx in range(num_temps - 1):
+            state_a, state_b = chain_states[ladder_start + temp_idx], chain_states[ladder_start + temp_idx + 1]
+            log_ratio = (state_a["inverse_temp"] - state_b["inverse_temp"]) * \
+                        (state_b["current_log_prob"] - state_a["current_log_prob"])
+            swap_stats[temp_idx][1] += 1
+            if np.log(swap_rng.rand()) < log_ratio:
+                swap_stats[temp_idx][0] += 1
+                params_a, params_b = state_a["params"], state_b["params"]
+                params_a['PERSON_PARAMS_TOM'], params_b['PERSON_PARAMS_TOM'] = \
+                    params_b['PERSON_PARAMS_TOM'], params_a['PERSON_PARAMS_TOM']
+                for k in ["current_log_prob", "current_screen_log_prob"]:
+                    state_a[k], state_b[k] = state_b[k], state_a[k]
+
+def report_diagnostics(sampler_state, param_names, burn_in_period, info_filename):
+    """Print (and save) the R-hat and ESS of each param, over the cold chains, using the samples after burn in"""
+    samples_each_chain = [np.array(samples[burn_in_period:]) for samples in sampler_state["cold_samples"]]
+    num_steps = len(sampler_state["cold_samples"][0])
+    hrs = sampler_state["elapsed_time"] / 3600
+    lines = ['Round {}: {} steps per chain in {} hrs. Log prob of each cold chain: {}'.format(
+        sampler_state["round"], num_steps, np.round(hrs, 2),
+        [float(np.round(log_probs[-1], 1)) for log_probs in sampler_state["cold_log_probs"]])]
+    if sampler_state["chain_states"][0].get("num_screen_ep", 0) > 0:
+        lines.append('Full likelihoods avoided by the screen, each chain: {}'.format(
+            [float(np.round(1 - state["num_full_evaluations"] / max(state["num_screened"], 1), 2))
+             for state in sampler_state["chain_states"]]))
+    if len(sampler_state["swap_stats"]) > 0:
+        lines.append('Swap acceptance between neighbouring temperatures: {}'.format(
+            [float(np.round(accepted / max(proposed, 1), 2)) for accepted, proposed in sampler_state["swap_stats"]]))
+    if len(samples_each_chain[0]) >= 4:
+        for pparam, (rhat, ess) in diagnose(samples_each_chain, param_names).items():
+            lines.append('    {}: R-hat {}, ESS {} ({} per hour)'.format(pparam, np.round(rhat, 3), np.round(ess, 1),
+                                                                       np.round(ess / hrs, 1)))
+    else:
+        lines.append('    (Diagnostics start once there are 4 samples after the burn in period of {} steps)'.format(
+            burn_in_period))
+    print('\n' + '\n'.join(lines) + '\n')
+    with open(info_filename, 'a') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def save_sampler_state(sampler_state, state_filename):
+    with open(state_filename + ".tmp", 'wb') as f:
+        pickle.dump(sampler_state, f)
+    os.replace(state_filename + ".tmp", state_filename)
+
+def run_multi_chain(sampler_state, params, num_temps, steps_per_round, total_number_steps, burn_in_period,
+                    num_workers, info_filename, state_filename):
+    param_names = free_param_names(params)
+    swap_rng = np.random.RandomState()
+    swap_rng.set_state(sampler_state["swap_rng_state"])
+    # Spawn, so that each worker has its own tf (ToMAgent imports pbt_hms)
+    pool = multiprocessing.get_context("spawn").Pool(num_workers, initializer=init_worker, initargs=(params,))
+    try:
+        while sampler_state["round"] * steps_per_round < total_number_steps:
+            start_time = time.time()
+            results = pool.starmap(run_chain_segment, [(chain_state, steps_per_round)
+                                                       for chain_state in sampler_state["chain_states"]])
+            sampler_state["chain_states"] = [chain_state for chain_state, _, _ in results]
+            for ladder, (_, samples, log_probs) in enumerate(results[::num_temps]):
+                sampler_state["cold_samples"][ladder].extend(samples)
+                sampler_state["cold_log_probs"][ladder].extend(log_probs)
+            propose_swaps(sampler_state["chain_states"], num_temps, sampler_state["swap_stats"], swap_rng)
+            sampler_state["swap_rng_state"] = swap_rng.get_state()
+            sampler_state["round"] += 1
+            sampler_state["elapsed_time"] += time.time() - start_time
+            report_diagnostics(sampler_state, param_names, burn_in_period, info_filename)
+            save_sampler_state(sampler_state, state_filename)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+#------------- main -----------------#
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-l", "--layout", help="Layout, (Choose from: bottleneck, room, centre_objects, centre_pots)",
+                        required=True)
+    parser.add_argument("-p", "--params", help="Starting params (all params get this value). OR set to 9 to get "
+                        "random values for the starting params (recommended: chains that start in different places "
+                        "make R-hat meaningful)", required=False, default=9, type=float)
+    parser.add_argument("-nc", "--num_chains", help="Number of independent (cold) chains", required=False, default=4,
+                        type=int)
+    parser.add_argument("-nt", "--num_temps", help="Number of temperatures for parallel tempering (1 for no tempering)",
+                        required=False, default=1, type=int)
+    parser.add_argument("-mt", "--max_temp", help="Temperature of the hottest chain", required=False, default=10,
+                        type=float)
+    parser.add_argument("-sr", "--steps_per_round", help="Steps each chain does between swaps (and diagnostics)",
+                        required=False, default=10, type=int)
+    parser.add_argument("-nw", "--num_workers", help="Number of worker processes (default: one per chain, up to the "
+                        "number of cpus)", required=False, default=None, type=int)
+    parser.add_argument("-ne", "--num_ep", help="Number of episodes to use when training (up to 16?)",
+                        required=False, default=16, type=int)
+    parser.add_argument("-ss", "--step_size", help="Step size for the step in the metropolis algorithm",
+                        required=False, default=1.3, type=float)
+    parser.add_argument("-sd", "--epsilon_sd", type=float, help="Standard deviation of dist picking epison from",
+                        required=False, default=0.02)
+    parser.add_argument("-nh", "--num_toms", help="Number of human models to use for approximating P(action|state)",
+                        required=False, default=3, type=int)
+    parser.add_argument("-ns", "--num_steps", help="Number of steps of each chain", required=False, default=1e9,
+                        type=int)
+    parser.add_argument("-sf", "--save_sample_freq", help="We save every save_sample_freq'th sample (of the cold "
+                        "chains)", required=False, default=50, type=int)
+    parser.add_argument("-bp", "--burn_in_period", help="Only save (and diagnose) samples after this number of "
+                        "steps", required=False, default=1000, type=int)
+    parser.add_argument("-se", "--num_screen_ep", help="Number of episodes to screen the candidates on (delayed "
+                        "acceptance). 0 for no screen", required=False, default=0, type=int)
+    parser.add_argument("-s", "--seed", help="Seed for the chains' RNGs", required=False, default=0, type=int)
+    parser.add_argument("-r", "--resume", help="Resume the sampler saved in this file (the MULTI_...pkl file)",
+                        required=False, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.ERROR)
+
+    ensure_random_direction = False
+    params = make_params(args.layout, make_starting_person_params(args.params), args.num_toms,
+                         ensure_random_direction, args.save_sample_freq, args.burn_in_period)
+    load_data_index(args.layout, params)  # Build the index of the data now if needed, rather than in every worker
+    num_workers = args.num_workers or min(args.num_chains * args.num_temps, multiprocessing.cpu_count())
+
+    if args.resume is not None:
+        state_filename = args.resume
+        with open(state_filename, 'rb') as f:
+            sampler_state = pickle.load(f)
+        assert sampler_state["layout"] == args.layout, "The saved sampler is for a different layout"
+        assert len(sampler_state["chain_states"]) == args.num_chains * args.num_temps, \
+            "Use the same num_chains and num_temps as the saved sampler"
+        info_filename = state_filename[:-len('.pkl')] + '.txt'
+        print('Resuming the sampler from round {}'.format(sampler_state["round"]))
+    else:
+        DIR = DATA_DIR + 'metropolis/'
+        create_dir_if_not_exists(DIR)
+        filename_base = DIR + 'MULTI_' + args.layout + '_' + time.strftime('%d-%m_%H:%M:%S')
+        info_filename, state_filename = filename_base + '.txt', filename_base + '.pkl'
+        chain_states = make_chain_states(params, args.params, args.num_chains, args.num_temps, args.max_temp,
+                                         args.num_ep, args.epsilon_sd, args.step_size, filename_base, args.seed,
+                                         args.num_screen_ep)
+        sampler_state = {"layout": args.layout,
+                         "chain_states": chain_states,
+                         "cold_samples": [[] for _ in range(args.num_chains)],
+                         "cold_log_probs": [[] for _ in range(args.num_chains)],
+                         "swap_stats": [[0, 0] for _ in range(args.num_temps - 1)],
+                         "swap_rng_state": np.random.RandomState(args.seed).get_state(),
+                         "round": 0,
+                         "elapsed_time": 0}
+        with open(info_filename, 'a') as f:
+            f.write('Settings: {}\nInverse temperatures: {}\n'.format(
+                vars(args), temperature_ladder(args.num_temps, args.max_temp)))
+
+    run_multi_chain(sampler_state, params, args.num_temps, args.steps_per_round, args.num_steps,
+                    args.burn_in_period, num_workers, info_filename, state_filename)
+
+    print('\nend')
@@ -1,15 +1,22 @@
-import time
+import time, os, pickle, random, copy
+import multiprocessing
 from argparse import ArgumentParser
 from human_aware_rl.human.process_dataframes import get_trajs_from_data
 from human_ai_robustness.pbt_hms import ToMAgent
+from human_ai_robustness.pbt_workers import make_tom_model
 from overcooked_ai_py.mdp.overcooked_mdp import OvercookedGridworld
 from human_ai_robustness.agent import GreedyHumanModel_pk
 from overcooked_ai_py.planning.planners import MediumLevelPlanner
 import logging
 import numpy as np
-from collections import Counter
 from human_aware_rl.data_dir import DATA_DIR
 from human_aware_rl.utils import create_dir_if_not_exists
+from human_ai_robustness.pbt_checkpoint import get_rng_states, set_rng_states
+from human_ai_robustness.human_data_index import get_human_data_index
+from human_ai_robustness.analyse_optimise_agents.chain_store import ChainStore, create_chain_store, load_chain
+from human_ai_robustness.analyse_optimise_agents.fit_metrics import probs_data_action, cross_entropy_loss, \
+    top_12_accuracy, prob_not_acting
+from overcooked_ai_py.mdp.actions import Action
 # np.seterr(divide='ignore', invalid='ignore')  # Suppress error about diving by zero
 import pandas as pd
 
@@ -19,250 +26,117 @@ Here we only optimise the TOM parameter on states for which the data acts. So if
 also act, then compare their actions.
 """
 
+NEW_LAYOUTS_DATA_PATH = "data/human/anonymized/clean_{}_trials_new_layouts.pkl".format('train')
+
 # Helper functions:
 
-def choose_tom_actions(joint_expert_trajs, tom_agent, num_ep_to_use):
+def segment_seed(seed, copy_idx, player, episode):
+    """Each (TOM copy, player, episode) segment of the data has its own seed, so that the likelihood doesn't depend on
+    the order the segments are evaluated in, or on which process evaluates them"""
+    return (seed * 1000003 + copy_idx * 10007 + player * 1009 + episode) % 2**32
+
+def choose_tom_actions(data_index, tom_agent, num_ep_to_use, episodes=None, seed=None, copy_idx=0):
     """
     Take a human model with given parameters, then use this to choose one action for every state in the data.
     Correction: now we only find one action for each state in which the data acts!
     Note that the TOM odel retains a memory of previous plans/actions/other info
-    :return: tom_actions, a list of lists of actions chosen by the TOM
+    Optionally only use some of the episodes, and seed the RNGs at the start of each segment (see segment_seed)
+    :return: tom_actions, the action chosen by the TOM (as an index in Action.ALL_ACTIONS) for each of
+    acting_rows(data_index, num_ep_to_use, episodes)
     """
 
     tom_actions = []
-    joint_actions_from_data = joint_expert_trajs['ep_actions']
-
-    # For each idx:
-    for idx in range(2):
-
-        tom_actions_this_idx = []
-
-        # For each episode we want to use
-        for i in range(num_ep_to_use):
-
-            tom_actions_this_ep = []
-
-            tom_agent.set_agent_index(idx)
-            tom_agent.reset()
-            tom_agent.look_ahead_steps = int(np.round(tom_agent.look_ahead_steps))
 
-            # For each state in the episode trajectory:
-            for j in range(joint_actions_from_data[i].__len__()):
+    # For each idx, then each episode we want to use:
+    for idx, i, rows in data_index.acting_segments(num_ep_to_use):
 
-                # Only let the TOM take an action when the data also acts. Otherwise force TOM action to (0,0) also
-                if joint_actions_from_data[i][j][idx] != (0,0):
+        if episodes is not None and i not in episodes:
+            continue
+        if seed is not None:
+            np.random.seed(segment_seed(seed, copy_idx, idx, i))
+            random.seed(segment_seed(seed, copy_idx, idx, i))
 
-                    current_state = joint_expert_trajs['ep_observations'][i][j]
-                    # The state seems to be missing an order list. Manually add the start_order_list:
-                    current_state.order_list = tom_agent.mdp.start_order_list
-                    #TODO: Fix this properly
+        tom_agent.set_agent_index(idx)
+        tom_agent.reset()
+        tom_agent.look_ahead_steps = int(np.round(tom_agent.look_ahead_steps))
 
-                    # # Print the state to view the game:
-                    # overcooked_env = OvercookedEnv(tom_agent.mdp)
-                    # logging.warning('i = {}, j = {}'.format(i, j))
-                    # overcooked_env.state = current_state
-                    # logging.warning(overcooked_env)
+        # For each state in the episode trajectory in which the data acts (the TOM isn't asked for the others):
+        for row in rows:
 
-                    # Force the agent to take an action
-                    temp_prob_pausing = tom_agent.prob_pausing
-                    tom_agent.prob_pausing = 0
+            # (The order list of the state was already set when the index was made)
+            current_state = data_index.state(row)
+            action_from_data = data_index.data_action(row)
 
-                    # Choose TOM action from state
-                    tom_action = tom_agent.action(current_state)[0]
-                    # This also automatically updates tom_agent.timesteps_stuck, tom_agent.dont_drop,
-                    # tom_agent.prev_motion_goal, tom_agent.prev_state
+            # Force the agent to take an action
+            temp_prob_pausing = tom_agent.prob_pausing
+            tom_agent.prob_pausing = 0
 
-                    # Then reset the prob_pausing:
-                    tom_agent.prob_pausing = temp_prob_pausing
+            # Choose TOM action from state
+            tom_action = tom_agent.action(current_state)[0]
+            # This also automatically updates tom_agent.timesteps_stuck, tom_agent.dont_drop,
+            # tom_agent.prev_motion_goal, tom_agent.prev_state
 
-                    # Set the prev action from the data, but only if there's already a motion goal
-                    if tom_agent.prev_motion_goal != None:
-                        tom_agent.prev_best_action = joint_actions_from_data[i][j][idx]
+            # Then reset the prob_pausing:
+            tom_agent.prob_pausing = temp_prob_pausing
 
-                    # Print everything after:
-                    logging.warning('Action from TOM: {}; Action from data: {}'.format(tom_action, joint_actions_from_data[i][j][idx]))
-                    logging.warning('TOM prev_motion_goal: {}; TOM dont_drop: {}'.format(tom_agent.prev_motion_goal,
-                                                                                       tom_agent.dont_drop))
-                    logging.warning('TOM time stuck: {}'.format(tom_agent.timesteps_stuck))
+            # Set the prev action from the data, but only if there's already a motion goal
+            if tom_agent.prev_motion_goal != None:
+                tom_agent.prev_best_action = action_from_data
 
-                else:
-                    tom_action = (0,0)
+            # Print everything after:
+            logging.warning('Action from TOM: {}; Action from data: {}'.format(tom_action, action_from_data))
+            logging.warning('TOM prev_motion_goal: {}; TOM dont_drop: {}'.format(tom_agent.prev_motion_goal,
+                                                                               tom_agent.dont_drop))
+            logging.warning('TOM time stuck: {}'.format(tom_agent.timesteps_stuck))
 
-                tom_actions_this_ep.append(tom_action)
+            tom_actions.append(Action.ACTION_TO_INDEX[tom_action])
 
-            tom_actions_this_idx.append(tom_actions_this_ep)
+    return np.array(tom_actions, dtype=int)
 
-        tom_actions.append(tom_actions_this_idx)
+def acting_rows(data_index, num_ep_to_use, episodes=None):
+    """The rows of the data index (see human_data_index.py) used by choose_tom_actions, in the same order"""
+    rows = data_index.acting_rows(num_ep_to_use)
+    return rows if episodes is None else rows[np.isin(data_index.ep_idx[rows], episodes)]
 
-    return tom_actions
+def find_multi_tom_actions(multi_tom_agent, data_index, num_ep_to_use, episodes=None, seed=None):
+    """Array of shape (number of agents, number of acting states): the action each agent chooses in each state"""
+    return np.array([choose_tom_actions(data_index, tom_agent, num_ep_to_use, episodes, seed, copy_idx)
+                     for copy_idx, tom_agent in enumerate(multi_tom_agent)])
 
-def find_tom_probs_action_in_state(multi_tom_agent, joint_actions_from_data, num_ep_to_use, joint_expert_trajs):
+def find_tom_probs_action_in_state(multi_tom_agent, data_index, num_ep_to_use, episodes=None, seed=None):
     """
     Find the prob that tom takes action a in state s. BUT only for the actions the data actually takes (we don't need
     the probs for the other actions, as the loss is zero for these)
-
-    :param multi_tom_agent:
-    :param actions_from_data:
-    :param num_ep_to_use:
-    :param expert_trajs:
-    :return:
+    :return: the prob for each of acting_rows(data_index, num_ep_to_use, episodes)
     """
+    multi_tom_actions = find_multi_tom_actions(multi_tom_agent, data_index, num_ep_to_use, episodes, seed)
+    actions_from_data = data_index.action[acting_rows(data_index, num_ep_to_use, episodes)]
 
-    multi_tom_actions = []
-
-    # For each agent
-    for tom_agent in multi_tom_agent:
-
-        # Find all actions by this agent:
-        tom_actions = choose_tom_actions(joint_expert_trajs, tom_agent, num_ep_to_use)
-        multi_tom_actions.append(tom_actions)
-
-    # Now have all actions for all agents
-
-    # List of lists of zeros:
-    tom_probs_action_in_state = [[[0 for i in range(2)] for j in range(len(joint_actions_from_data[k]))] for k in range(num_ep_to_use)]
-
-    # For each episode we want to use
-    for i in range(num_ep_to_use):
-
-        # For each index
-        for idx in range(2):
-
-            # For each state in the episode trajectory:
-            for j in range(joint_actions_from_data[i].__len__()):
-
-                # For each agent
-                for tom_actions in multi_tom_actions:
-                #TODO: Should really swap this "for" with the "if" below
-
-                    # Only work out the probs for states where the data acts:
-                    if joint_actions_from_data[i][j][idx] != (0,0):
-
-                        # If agent chooses the same action as the data, then count this
-                        if joint_actions_from_data[i][j][idx] == tom_actions[idx][i][j]:
-
-                            # 1 / number of agents. Therefore if all agents act correctly then prob will be 1
-                            tom_probs_action_in_state[i][j][idx] += 1/multi_tom_agent.__len__()
-
-                    # data gives (0,0):
-                    else:
-                        # Set to -1 to signal that we're not using this probability
-                        tom_probs_action_in_state[i][j][idx] = -1
-                        # Both the data and the agent should give (0,0):
-                        assert joint_actions_from_data[i][j][idx] == tom_actions[idx][i][j]
-
-                # Force prob to be 0.01 minimum (otherwise we get infinities in the cross entropy):
-                if tom_probs_action_in_state[i][j][idx] == 0:
-                    tom_probs_action_in_state[i][j][idx] = 0.01
-
-    return tom_probs_action_in_state
-
-def find_prob_not_acting(joint_actions_from_data, num_ep_to_use):
-
-    count_number_not_acting = 0
-    count_total_states = 0
-
-    # For each episode we want to use
-    for i in range(num_ep_to_use):
-
-        # For both indices:
-        for idx in range(2):
-
-            # For each state in the episode trajectory:
-            for j in range(joint_actions_from_data[i].__len__()):
+    # 1 / number of agents for each agent that chooses the same action as the data. Therefore if all agents act
+    # correctly then prob will be 1 (and the min prob is 0.01, otherwise we get infinities in the cross entropy)
+    return probs_data_action(multi_tom_actions.T, actions_from_data)
 
-                count_total_states += 1
+def find_prob_not_acting(data_index, num_ep_to_use):
+    """Probability that the data doesn't act (over both indices), and the number of states in which it acts"""
+    return prob_not_acting(data_index.acting[data_index.rows(num_ep_to_use)])
 
-                if joint_actions_from_data[i][j][idx] == (0,0):
-                    # Count for how many of the states the data doesn't act:
-                    count_number_not_acting += 1
-
-    prob_data_doesnt_act = count_number_not_acting / count_total_states
-    number_states_with_acting = count_total_states - count_number_not_acting
-
-    return prob_data_doesnt_act, number_states_with_acting
-
-def find_cross_entropy_loss(actions_from_data, expert_trajs, multi_tom_agent, num_ep_to_use):
+def find_cross_entropy_loss(data_index, multi_tom_agent, num_ep_to_use):
     """
-    ...?
-    :param expert_trajs:
-    :param multi_tom_agent:
-    :param num_ep_to_use:
-    :return:
+    Cross entropy loss, only over the states for which the data acts. Each state's loss is normalised by log(0.01),
+    so that it's at most 1
     """
-    # Find Prob_TOM(action|state) for all actions chosen by the data
-    tom_probs_action_in_state = find_tom_probs_action_in_state(multi_tom_agent, actions_from_data, num_ep_to_use,
-                                                          expert_trajs)
-
-    loss = 0
-
-    # For each episode we want to use
-    for i in range(num_ep_to_use):
-        # For each state in the episode trajectory:
-        for j in range(actions_from_data[i].__len__()):
-
-            # Only add to the loss if it's a state for which the data acts:
-            if actions_from_data[i][j] != (0,0):
-                loss += np.log(tom_probs_action_in_state[i][j])/np.log(0.01)  # Normalise by 0.01, so that loss_ij=1 max
-            else:
-                assert tom_probs_action_in_state[i][j] == -1
+    multi_tom_actions = find_multi_tom_actions(multi_tom_agent, data_index, num_ep_to_use)
+    actions_from_data = data_index.action[data_index.acting_rows(num_ep_to_use)]
+    return cross_entropy_loss(multi_tom_actions.T, actions_from_data)
 
-    return loss
-
-def two_most_frequent(List):
-    occurence_count = Counter(List)
-    second_action = None
-    if len(occurence_count) > 1:
-        second_action = occurence_count.most_common(2)[1][0]
-    return occurence_count.most_common(1)[0][0], second_action
-
-def find_top_12_accuracy(actions_from_data, expert_trajs, multi_tom_agent, num_ep_to_use, number_states_with_acting):
+def find_top_12_accuracy(data_index, multi_tom_agent, num_ep_to_use):
     """
     Find top-1 (top-2) accuracy, which is the proportion of states in which the TOM's most likely (2nd most likely)
     action equals the action from the data
     """
-
-    multi_tom_actions = []
-    # For each agent
-    for tom_agent in multi_tom_agent:
-        # Find all actions by this agent:
-        tom_actions = choose_tom_actions(expert_trajs, tom_agent, num_ep_to_use)
-        multi_tom_actions.append(tom_actions)
-    # Now have all actions for all agents
-
-    count_top_1 = 0
-    count_top_2 = 0
-
-    # For each state:
-    for i in range(num_ep_to_use):
-        for j in range(actions_from_data[i].__len__()):
-
-            # Only consider states where the data takes an action:
-            if actions_from_data[i][j] != (0, 0):
-
-                # Change format of multi_tom_actions:
-                list_actions = []
-                for k in range(len(multi_tom_actions)):
-                    list_actions.append(multi_tom_actions[k][i][j])
-
-                #TODO: Here we're ignoring draws between two actions:
-                top_action, second_action = two_most_frequent(list_actions)
-
-                assert top_action != second_action
-
-                # If the top/2nd action is the same as the data, count it:
-                if top_action == actions_from_data[i][j]:
-                    count_top_1 += 1
-                    count_top_2 += 1
-                elif second_action == actions_from_data[i][j]:
-                    count_top_2 += 1
-
-    top_1_acc = count_top_1 / number_states_with_acting
-    top_2_acc = count_top_2 / number_states_with_acting
-
-    assert top_2_acc >= top_1_acc
-
-    return top_1_acc, top_2_acc
+    multi_tom_actions = find_multi_tom_actions(multi_tom_agent, data_index, num_ep_to_use)
+    actions_from_data = data_index.action[data_index.acting_rows(num_ep_to_use)]
+    return top_12_accuracy(multi_tom_actions.T, actions_from_data)
 
 def shift_by_epsilon(params, epsilon):
     """
@@ -336,7 +210,7 @@ def shift_by_gradient(params, epsilon, delta_loss, lr):
         # print('param shifted final: {}'.format(PERSON_PARAMS_TOM[pparam]))
     # return PERSON_PARAMS_TOM
 
-def find_gradient_and_step_multi_tom(params, mlp, expert_trajs, num_ep_to_use, lr, epsilon_sd,
+def find_gradient_and_step_multi_tom(params, mlp, data_index, num_ep_to_use, lr, epsilon_sd,
                                     start_time, step_number, total_number_steps):
     """
     Same as find_gradient_and_step_single_tom except here we have multiple toms taking multiple actions, so we find
@@ -344,13 +218,11 @@ def find_gradient_and_step_multi_tom(params, mlp, expert_trajs, num_ep_to_use, l
     :return: loss
     """
 
-    actions_from_data = expert_trajs['ep_actions']
-
     tom_number = ''
     # Make multiple tom agents:
     multi_tom_agent = ToMAgent(params, 99, tom_number).get_multi_agent(mlp)
 
-    loss = find_cross_entropy_loss(actions_from_data, expert_trajs, multi_tom_agent, num_ep_to_use)
+    loss = find_cross_entropy_loss(data_index, multi_tom_agent, num_ep_to_use)
 
     # Choose random epsilon (eps) from normal dist, sd=epsilon_sd
     epsilon = np.random.normal(scale=epsilon_sd, size=params['PERSON_PARAMS_TOM'].__len__())
@@ -380,7 +252,7 @@ def find_gradient_and_step_multi_tom(params, mlp, expert_trajs, num_ep_to_use, l
     # Find loss for new params
     tom_number = 'eps'
     multi_tom_agent_eps = ToMAgent(params, 99, tom_number).get_multi_agent(mlp)
-    loss_eps = find_cross_entropy_loss(actions_from_data, expert_trajs, multi_tom_agent_eps, num_ep_to_use)
+    loss_eps = find_cross_entropy_loss(data_index, multi_tom_agent_eps, num_ep_to_use)
     delta_loss = loss - loss_eps
 
     # Set new personality params by shifting in the direction of downhill
@@ -391,7 +263,7 @@ def find_gradient_and_step_multi_tom(params, mlp, expert_trajs, num_ep_to_use, l
     # What's the loss after this grad step:
     # tom_number = ''
     # multi_tom_agent = ToMAgent(params, 99, tom_number).get_multi_agent(mlp)
-    # loss_final = find_cross_entropy_loss(actions_from_data, expert_trajs, multi_tom_agent, num_ep_to_use)
+    # loss_final = find_cross_entropy_loss(data_index, multi_tom_agent, num_ep_to_use)
     # return loss_final
 
     if (step_number % (total_number_steps / 1000)) == 0:
@@ -403,34 +275,289 @@ def find_gradient_and_step_multi_tom(params, mlp, expert_trajs, num_ep_to_use, l
 #--------------------------------------------#
 #------------ Metropolis sampling -----------#
 
-def iterate_metropolis_sampling(params, mlp, joint_expert_trajs, num_ep_to_use, epsilon_sd, start_time, step_number,
-                                total_number_steps, accepted_history, step_size, info_filename, params_filename):
-    """Randomly sample a new candidate set of params, calculate ratio of the probabilities that the new:old params
-    recover the data, then accepts or reject the candidate params."""
-
-    tom_number = ''
-    multi_tom_agent_initial = ToMAgent(params, 99, tom_number).get_multi_agent(mlp)  # Make multiple tom agents
-
-    #TODO: Note that (at the time of writing) this is proportional to the cross entropy loss!
-    initial_log_prob = find_log_prob_data_given_params(joint_expert_trajs, multi_tom_agent_initial, num_ep_to_use)
-
-    generate_candidate_params(params, epsilon_sd, step_size)
-
-    tom_number = 'eps'  # This means that multi_tom_agent_cand will use the params that were shifted by epsilon
-    multi_tom_agent_cand = ToMAgent(params, 99, tom_number).get_multi_agent(mlp)  # Make multiple 'candidate' tom agents
-
-    candidate_log_prob = find_log_prob_data_given_params(joint_expert_trajs, multi_tom_agent_cand, num_ep_to_use)
-
-    accepted, log_prob = acceptance_function(initial_log_prob, candidate_log_prob)
+class MetropolisChain(object):
+    """
+    A Metropolis chain over the TOM params. The chain carries everything needed to continue it: the current params
+    (params['PERSON_PARAMS_TOM']), their log likelihood, the step size, the accepted history, and the RNG state. The
+    log likelihood of the current params is cached: it only changes when a candidate is accepted, in which case we've
+    just found it. So each step only evaluates the candidate, which halves the cost of each step. The trade-off: the
+    likelihood is a noisy estimate (the TOMs are stochastic), and this isn't a pseudo-marginal sampler, as
+    exp(sum of log probs), with each prob floored at 0.01, isn't an unbiased estimate of the likelihood. A lucky
+    overestimate for the current params is kept until a candidate beats it, so the chain can get stuck there (and
+    the chain is biased towards params whose estimates are noisier). reestimate_freq = N re-estimates the current
+    params' likelihood every N steps, which unsticks the chain at the cost of one more likelihood every N steps.
+
+    The chain can be saved (see save) and resumed with MetropolisChain.load, e.g. to continue a run that was stopped.
+    Every step is recorded in a binary chain store in store_dir (see chain_store.py), and the chain can also be resumed
+    from its store alone, with MetropolisChain.from_store.
+
+    inverse_temp < 1 samples from the tempered posterior, P(data|params)^inverse_temp, which is flatter so the chain
+    moves more freely (see metropolis_multi_chain.py).
+
+    num_tries > 1 makes it a multiple-try Metropolis chain (see multiple_try_step): each step proposes num_tries
+    candidates, and their likelihoods are found together (concurrently, with a ParallelLikelihoodEvaluator).
+
+    num_screen_ep > 0 makes it a delayed acceptance chain (see delayed_acceptance_step): candidates are first screened
+    on the likelihood of num_screen_ep episodes, and most are rejected without finding their full likelihood.
+    """
 
-    step_size = print_save_sampling_info(params, start_time, step_number, total_number_steps, accepted,
-                                         accepted_history, step_size, info_filename, params_filename, log_prob)
+    def __init__(self, params, mlp, data_index, num_ep_to_use, epsilon_sd, step_size, info_filename,
+                 store_dir, chain_filename, inverse_temp=1, likelihood_evaluator=None, num_tries=1,
+                 num_screen_ep=0, reestimate_freq=None):
+        self.params = params
+        self.mlp = mlp
+        self.data_index = data_index
+        self.num_ep_to_use = num_ep_to_use
+        self.epsilon_sd = epsilon_sd
+        self.step_size = step_size
+        self.info_filename = info_filename
+        self.store_dir = store_dir  # None to not record the steps (e.g. for the hot chains of parallel tempering)
+        self.chain_store = None  # Opened at the first step
+        self.chain_filename = chain_filename
+        self.inverse_temp = inverse_temp
+        self.likelihood_evaluator = likelihood_evaluator  # E.g. a ParallelLikelihoodEvaluator (None: serial)
+        self.num_tries = num_tries
+        self.num_screen_ep = num_screen_ep
+        assert num_tries == 1 or num_screen_ep == 0, "Multiple-try with delayed acceptance isn't implemented"
+        self.reestimate_freq = reestimate_freq  # None to never re-estimate the current params' log likelihood
+        self.step_number = 0
+        self.current_log_prob = None  # Log likelihood of params['PERSON_PARAMS_TOM']
+        self.current_screen_log_prob = None  # Log likelihood of the screen episodes (for delayed acceptance)
+        self.num_screened = 0  # Candidates screened (delayed acceptance)
+        self.num_full_evaluations = 0  # Candidates that passed the screen, so their full likelihood was found
+        self.accepted_history = ([1]+3*[0])*25  # Wiki recommends acceptance should be 23% (for a Gaussian dist!)
+        self.elapsed_time = 0  # Time spent sampling before this chain was (last) resumed
+        self.start_time = time.time()
+
+    def find_log_prob(self, tom_number, episodes=None, seed=None):
+        """Log likelihood of the data for the TOM params given by tom_number ('' for the current params, 'eps' for
+        the candidate). episodes: only use these episodes"""
+        # The TOMs' randomness comes from this seed, so the chain is the same with or without a parallel evaluator:
+        if seed is None:
+            seed = np.random.randint(2**31)
+        if self.likelihood_evaluator is not None:
+            return self.likelihood_evaluator.find_log_prob(self.params, tom_number, self.num_ep_to_use, seed, episodes)
+        multi_tom_agent = ToMAgent(self.params, 99, tom_number).get_multi_agent(self.mlp)  # Make multiple tom agents
+        #TODO: Note that (at the time of writing) this is proportional to the cross entropy loss!
+        return find_log_prob_data_given_params(self.data_index, multi_tom_agent, self.num_ep_to_use, seed, episodes)
+
+    def find_screen_episodes(self):
+        """The (fixed) episodes used to screen the candidates, spread evenly through the data; the rest of the
+        episodes; and how many times more acting states there are in all the episodes than in the screen episodes"""
+        num_episodes = min(self.num_ep_to_use, self.data_index.num_episodes)
+        screen_episodes = sorted(set(int(i) for i in np.round(np.linspace(0, num_episodes - 1,
+                                                                           min(self.num_screen_ep, num_episodes)))))
+        other_episodes = [i for i in range(num_episodes) if i not in screen_episodes]
+        screen_scale = len(acting_rows(self.data_index, num_episodes)) / \
+                       max(len(acting_rows(self.data_index, num_episodes, screen_episodes)), 1)
+        return screen_episodes, other_episodes, screen_scale
+
+    def find_log_probs(self, person_params_each):
+        """Log likelihood of the data for each of the sets of TOM params in person_params_each (each is a
+        PERSON_PARAMS_TOM dict). With a likelihood evaluator, these are all found at once"""
+        seeds = [np.random.randint(2**31) for _ in person_params_each]
+        return find_log_probs_each_params(self.params, person_params_each, seeds, self.mlp, self.data_index,
+                                          self.num_ep_to_use, self.likelihood_evaluator)
+
+    def step(self):
+        """Do one step of the chain (see metropolis_step, or multiple_try_step, or delayed_acceptance_step), then
+        print info and record the step"""
+        step_start_time = time.time()
+        if self.reestimate_freq is not None and self.step_number > 0 and self.step_number % self.reestimate_freq == 0:
+            # Forget the cached log likelihoods, so the step re-estimates them for the current params
+            self.current_log_prob = None
+            self.current_screen_log_prob = None
+        if self.num_tries > 1:
+            accepted = self.multiple_try_step()
+        elif self.num_screen_ep > 0:
+            accepted = self.delayed_acceptance_step()
+        else:
+            accepted = self.metropolis_step()
+
+        self.step_size = print_save_sampling_info(self.params, self.start_time, self.step_number, None, accepted,
+                                                  self.accepted_history, self.step_size, self.info_filename,
+                                                  self.current_log_prob)
+        if self.num_screen_ep > 0 and self.step_number % 10 == 0:
+            print('Full likelihoods avoided by the screen: {}%\n'.format(
+                np.round(100 * self.fraction_full_evaluations_avoided(), 1)))
+        self.record_step(accepted, time.time() - step_start_time)
+        self.step_number += 1
+
+    def metropolis_step(self):
+        """Randomly sample a new candidate set of params, calculate ratio of the probabilities that the new:old params
+        recover the data, then accepts or reject the candidate params."""
+        if self.current_log_prob is None:
+            self.current_log_prob = self.find_log_prob('')  # Only needed for the first step, or to re-estimate it
+
+        generate_candidate_params(self.params, self.epsilon_sd, self.step_size)
+        # 'eps' means that the candidate tom agents will use the params that were shifted by epsilon:
+        candidate_log_prob = self.find_log_prob('eps')
+
+        accepted, self.current_log_prob = acceptance_function(self.params, self.current_log_prob, candidate_log_prob,
+                                                              self.inverse_temp)
+        return accepted
+
+    def multiple_try_step(self):
+        """
+        A step of multiple-try Metropolis (Liu, Liang & Wong, 2000), with weights w(y) = P(data|y)^inverse_temp (as
+        the proposal is symmetric). Propose num_tries candidates from the current params, and pick one of them, y, with
+        prob proportional to its weight. Then propose num_tries-1 reference points from y, and accept y with prob
+        min(1, sum of the candidates' weights / sum of the weights of the reference points and the current params).
+        This needs 2*num_tries-1 likelihoods per step, but these are found in two batches (the candidates, then the
+        reference points), so with enough workers a step takes about as long as two likelihoods. And picking the best
+        of several candidates means larger steps are accepted.
+        """
+        if self.current_log_prob is None:
+            self.current_log_prob = self.find_log_prob('')  # Only needed for the first step, or to re-estimate it
+        current = dict(self.params['PERSON_PARAMS_TOM'])
+
+        candidates = [propose_person_params(self.params, current, self.epsilon_sd, self.step_size)
+                      for _ in range(self.num_tries)]
+        candidate_log_probs = np.array(self.find_log_probs(candidates))
+        weights = np.exp(self.inverse_temp * (candidate_log_probs - np.max(candidate_log_probs)))
+        chosen = np.random.choice(self.num_tries, p=weights / np.sum(weights))
+
+        references = [propose_person_params(self.params, candidates[chosen], self.epsilon_sd, self.step_size)
+                      for _ in range(self.num_tries - 1)]
+        # The current params keep their cached log likelihood (as in step):
+        reference_log_probs = np.array(self.find_log_probs(references) + [self.current_log_prob])
+
+        # (The weights are P^inverse_temp, so the temperature goes inside the sums)
+        log_acceptance_ratio = log_sum_exp(self.inverse_temp * candidate_log_probs) - \
+            log_sum_exp(self.inverse_temp * reference_log_probs)
+        logging.info('acceptance_ratio: {}'.format(np.exp(log_acceptance_ratio)))
+        accepted = 0
+        if np.log(np.random.rand()) <= log_acceptance_ratio:
+            self.params['PERSON_PARAMS_TOM'].update(candidates[chosen])
+            self.current_log_prob = candidate_log_probs[chosen]
+            accepted = 1
+        return accepted
+
+    def delayed_acceptance_step(self):
+        """
+        A step of delayed acceptance Metropolis (Christen & Fox, 2005). The screen is the log likelihood of the screen
+        episodes, scaled up to the size of the whole data (see find_screen_episodes). First, accept the candidate with
+        prob min(1, screen ratio), and reject it straight away otherwise. Only if it passes do we find its full
+        likelihood, then accept it with the second stage prob (see delayed_acceptance_log_ratio), which corrects for
+        the screen, so the chain samples the same posterior as the standard step. (Ratios are all ^inverse_temp.)
+        Each likelihood is found with one seed (see segment_seed), so the full likelihood is the screen episodes' log
+        likelihood plus the rest's, and only the rest of the episodes need to be evaluated after the screen.
+        """
+        screen_episodes, other_episodes, screen_scale = self.find_screen_episodes()
+        if self.current_log_prob is None or self.current_screen_log_prob is None:
+            seed = np.random.randint(2**31)
+            self.current_screen_log_prob = self.find_log_prob('', screen_episodes, seed)
+            self.current_log_prob = self.current_screen_log_prob + self.find_log_prob('', other_episodes, seed)
+
+        generate_candidate_params(self.params, self.epsilon_sd, self.step_size)
+        seed = np.random.randint(2**31)
+        candidate_screen_log_prob = self.find_log_prob('eps', screen_episodes, seed)
+        log_screen_ratio = self.inverse_temp * screen_scale * (candidate_screen_log_prob - self.current_screen_log_prob)
+        self.num_screened += 1
+
+        accepted = 0
+        if np.log(np.random.rand()) <= log_screen_ratio:
+            self.num_full_evaluations += 1
+            candidate_log_prob = candidate_screen_log_prob + self.find_log_prob('eps', other_episodes, seed)
+            log_ratio = delayed_acceptance_log_ratio(self.inverse_temp * (candidate_log_prob - self.current_log_prob),
+                                                     log_screen_ratio)
+            logging.info('acceptance_ratio: {}'.format(np.exp(log_ratio)))
+            if np.log(np.random.rand()) <= log_ratio:
+                for pparam in self.params['PERSON_PARAMS_TOM']:
+                    self.params['PERSON_PARAMS_TOM'][pparam] = self.params['PERSON_PARAMS_TOMeps'][pparam + 'eps']
+                self.current_log_prob, self.current_screen_log_prob = candidate_log_prob, candidate_screen_log_prob
+                accepted = 1
+        return accepted
+
+    def fraction_full_evaluations_avoided(self):
+        """Fraction of the candidates rejected by the screen, i.e. without finding their full likelihood"""
+        return 1 - self.num_full_evaluations / max(self.num_screened, 1)
+
+    def record_step(self, accepted, step_time):
+        """Add the step to the chain store (see chain_store.py)"""
+        if self.store_dir is None:
+            return
+        if self.chain_store is None:
+            if os.path.exists(os.path.join(self.store_dir, "meta.pkl")):
+                self.chain_store = ChainStore(self.store_dir)
+                # Drop any steps recorded after the state we've resumed from was saved:
+                self.chain_store.truncate(self.step_number)
+            else:
+                self.chain_store = create_chain_store(self.store_dir, free_param_names(self.params), self.get_state())
+        logit_params = [convert_to_logit(self.params['PERSON_PARAMS_TOM'][pparam], pparam)
+                        for pparam in self.chain_store.meta["param_names"]]
+        self.chain_store.append(self.step_number, logit_params, self.current_log_prob, accepted, step_time,
+                                self.step_size)
+
+    def get_state(self):
+        """Everything needed to continue the chain (except the mlp and data), including the RNG state. This flushes
+        the chain store, so that the steps stored match the state"""
+        if self.chain_store is not None:
+            self.chain_store.flush()
+        state = {k: v for k, v in self.__dict__.items()
+                 if k not in ["mlp", "data_index", "likelihood_evaluator", "chain_store", "start_time"]}
+        state["elapsed_time"] = time.time() - self.start_time
+        state.update(get_rng_states())
+        return state
+
+    def save(self):
+        """Save the state of the chain (atomically, so a crash while saving leaves the previous save intact)"""
+        with open(self.chain_filename + ".tmp", 'wb') as f:
+            pickle.dump(self.get_state(), f)
+        os.replace(self.chain_filename + ".tmp", self.chain_filename)
+
+    @staticmethod
+    def from_state(state, mlp, data_index, likelihood_evaluator=None):
+        """Continue the chain from its state (see get_state) as if it had never stopped. Note that this sets the
+        global RNG state"""
+        set_rng_states(state)
+        chain = MetropolisChain(state["params"], mlp, data_index, state["num_ep_to_use"], state["epsilon_sd"],
+                                state["step_size"], state["info_filename"], state.get("store_dir"),
+                                state["chain_filename"], state.get("inverse_temp", 1), likelihood_evaluator,
+                                state.get("num_tries", 1), state.get("num_screen_ep", 0), state.get("reestimate_freq"))
+        for k in ["step_number", "current_log_prob", "accepted_history"]:
+            setattr(chain, k, state[k])
+        for k, default in [("current_screen_log_prob", None), ("num_screened", 0), ("num_full_evaluations", 0)]:
+            setattr(chain, k, state.get(k, default))
+        # So that the times printed are the total time spent sampling:
+        chain.start_time = time.time() - state["elapsed_time"]
+        return chain
+
+    @staticmethod
+    def load(chain_filename, mlp, data_index, likelihood_evaluator=None):
+        with open(chain_filename, 'rb') as f:
+            state = pickle.load(f)
+        state["chain_filename"] = chain_filename
+        return MetropolisChain.from_state(state, mlp, data_index, likelihood_evaluator)
+
+    @staticmethod
+    def from_store(store_dir, mlp, data_index, likelihood_evaluator=None):
+        """Continue the chain recorded in the chain store in store_dir, from its last step. The settings come from
+        the store (the state of the chain when the store was made). The RNGs are seeded afresh, and for delayed
+        acceptance the likelihood of the current params is found again"""
+        rows, meta = load_chain(store_dir)
+        state = copy.deepcopy(meta["chain_state"])
+        state["store_dir"] = store_dir
+        if len(rows) > 0:
+            for pparam, logit_param in zip(meta["param_names"], rows[-1]["logit_params"]):
+                state["params"]['PERSON_PARAMS_TOM'][pparam] = convert_back_from_logit(logit_param, pparam)
+            state["params"]["highest_likelihood"] = np.max(rows["log_prob"])
+            state["step_number"] = int(rows[-1]["step"]) + 1
+            state["current_log_prob"] = rows[-1]["log_prob"]
+            state["current_screen_log_prob"] = None
+            state["step_size"] = rows[-1]["step_size"]
+            for row in rows[-len(state["accepted_history"]):]:
+                state["accepted_history"][row["step"] % len(state["accepted_history"])] = int(row["accepted"])
+            state["elapsed_time"] = np.sum(rows["step_time"])
+        state.update({"np_random_state": np.random.RandomState().get_state(),
+                      "random_state": random.Random().getstate()})
+        return MetropolisChain.from_state(state, mlp, data_index, likelihood_evaluator)
 
-    return step_size
 
 def print_save_sampling_info(params, start_time, step_number, total_number_steps, accepted, accepted_history,
-                             step_size, info_filename, params_filename, log_prob):
-    """Print relevant information about the sampling algorithm and the sampled params"""
+                             step_size, info_filename, log_prob):
+    """Print relevant information about the sampling algorithm and the sampled params. (The samples themselves are
+    saved in the chain store, see MetropolisChain.record_step)"""
 
     display_steps = 10
 
@@ -464,45 +591,109 @@ def print_save_sampling_info(params, start_time, step_number, total_number_steps
         print('\nNew highest likelihood: {}; Best likelihood PPARAMS: {}\n'.format(
                 params["highest_likelihood"], str(params['PERSON_PARAMS_TOM'])))
 
-    if step_number % params["save_sample_freq"] == 0 and step_number >= params["burn_in_period"]:
-        with open(params_filename, 'a') as f:
-            f.write('{},\n'.format(str(params['PERSON_PARAMS_TOM'])))
-
     return step_size
 
-def find_log_prob_data_given_params(joint_expert_trajs, multi_tom_agent, num_ep_to_use):
+def find_log_prob_each_episode(data_index, multi_tom_agent, episodes, seed=None):
+    """The log prob of the data in each of the episodes (see find_log_prob_data_given_params)"""
+    if len(episodes) == 0:
+        return []
+    num_ep_to_use = max(episodes) + 1
+    # Find Prob_TOM(action|state) for all actions chosen by the data (only the states for which the data acts)
+    tom_probs_action_in_state = find_tom_probs_action_in_state(multi_tom_agent, data_index, num_ep_to_use, episodes,
+                                                               seed)
+    episode_of_row = data_index.ep_idx[acting_rows(data_index, num_ep_to_use, episodes)]
+    return [np.sum(np.log(tom_probs_action_in_state[episode_of_row == i])) for i in episodes]
+
+def find_log_prob_data_given_params(data_index, multi_tom_agent, num_ep_to_use, seed=None, episodes=None):
     """Find the probability that the TOM with params in multi_tom_agent reproduces the data -- i.e. the prob that all
     its actions will agree with those from the data (ignoring states for which the data does a zero action).
-    Return the log of the total probability"""
-
-    # Find Prob_TOM(action|state) for all actions chosen by the data
-    joint_actions_from_data = joint_expert_trajs['ep_actions']
-    tom_probs_action_in_state = find_tom_probs_action_in_state(multi_tom_agent, joint_actions_from_data, num_ep_to_use,
-                                                               joint_expert_trajs)
-
-    log_prob_data_given_params = 0
-
-    # For each episode we want to use:
-    for i in range(num_ep_to_use):
-
-        # For each index
-        for idx in range(2):
-
-            # For each state in the episode trajectory:
-            for j in range(joint_actions_from_data[i].__len__()):
-
-                # Only states for which the data acts:
-                if joint_actions_from_data[i][j][idx] != (0, 0):
-                    log_prob_data_given_params += np.log(tom_probs_action_in_state[i][j][idx])
-                else:
-                    assert tom_probs_action_in_state[i][j][idx] == -1
+    Return the log of the total probability.
+    If seed is given, the TOMs' randomness comes from seed (see segment_seed) rather than the global RNGs, which are
+    left as they were. Then the result is the same as ParallelLikelihoodEvaluator.find_log_prob's.
+    episodes: only use these episodes (of the first num_ep_to_use)"""
+    if episodes is None:
+        episodes = list(range(min(num_ep_to_use, data_index.num_episodes)))
+    if seed is None:
+        return sum(find_log_prob_each_episode(data_index, multi_tom_agent, episodes))
+    rng_states = get_rng_states()
+    log_prob_each_episode = find_log_prob_each_episode(data_index, multi_tom_agent, episodes, seed)
+    set_rng_states(rng_states)
+    return sum(log_prob_each_episode)
+
+def find_log_probs_each_params(params, person_params_each, seeds, mlp, data_index, num_ep_to_use,
+                               likelihood_evaluator=None):
+    """Log likelihood of the data for each of the sets of TOM params in person_params_each (PERSON_PARAMS_TOM dicts),
+    with seeds[k] for person_params_each[k]. With a likelihood evaluator (e.g. a ParallelLikelihoodEvaluator), these
+    are all found at once"""
+    params_each = [dict(params, PERSON_PARAMS_TOM=person_params) for person_params in person_params_each]
+    if likelihood_evaluator is not None:
+        return likelihood_evaluator.find_log_probs(params_each, '', num_ep_to_use, seeds)
+    return [find_log_prob_data_given_params(data_index, ToMAgent(params, 99, '').get_multi_agent(mlp),
+                                            num_ep_to_use, seed) for params, seed in zip(params_each, seeds)]
+
+
+class ParallelLikelihoodEvaluator(object):
+    """
+    Finds the log likelihood of the data (as find_log_prob_data_given_params) with the episodes split across a pool of
+    worker processes. Each worker loads the data index and makes the planner once (init_likelihood_worker), then for
+    each episode it's given, makes its own TOM copies from the tom spec of the params. Each segment of the data has
+    its own seed (see segment_seed) and the log probs of the episodes are summed in order, so the result is exactly
+    the same as find_log_prob_data_given_params with the same seed, whatever the number of workers.
+    """
 
-    return log_prob_data_given_params
+    def __init__(self, params, num_episodes, num_workers):
+        self.num_episodes = num_episodes
+        # Spawn, so that each worker has its own tf (ToMAgent imports pbt_hms)
+        self.pool = multiprocessing.get_context("spawn").Pool(num_workers, initializer=init_likelihood_worker,
+                                                              initargs=(params,))
+
+    def find_log_prob(self, params, tom_number, num_ep_to_use, seed, episodes=None):
+        return self.find_log_probs([params], tom_number, num_ep_to_use, [seed], episodes)[0]
+
+    def find_log_probs(self, params_each, tom_number, num_ep_to_use, seeds, episodes=None):
+        """The log likelihood for each of params_each (e.g. the candidates of multiple-try Metropolis), with seeds[k]
+        for params_each[k]. The episodes of all of them are evaluated concurrently. episodes: only use these episodes
+        (of the first num_ep_to_use)"""
+        if episodes is None:
+            episodes = range(min(num_ep_to_use, self.num_episodes))
+        # One task per episode, so the work is shared evenly even though the episodes have different lengths:
+        tasks = [(ToMAgent(params, 99, tom_number).get_tom_spec(), params["sim_threads"], i, seed)
+                 for params, seed in zip(params_each, seeds) for i in episodes]
+        log_prob_each_episode = self.pool.starmap(find_log_prob_episode_in_worker, tasks, chunksize=1)
+        return [sum(log_prob_each_episode[k * len(episodes):(k + 1) * len(episodes)]) for k in range(len(params_each))]
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+# The data index and planner of this likelihood worker process (see init_likelihood_worker):
+likelihood_worker_data = {}
+
+def init_likelihood_worker(params):
+    logging.getLogger().setLevel(logging.ERROR)
+    likelihood_worker_data["data_index"] = load_data_index(params["MDP_PARAMS"]["layout_name"], params)
+    likelihood_worker_data["mlp"] = make_mlp(params)
+
+def find_log_prob_episode_in_worker(tom_spec, num_toms, episode, seed):
+    multi_tom_agent = [make_tom_model(likelihood_worker_data["mlp"], tom_spec, 99) for _ in range(num_toms)]
+    return find_log_prob_each_episode(likelihood_worker_data["data_index"], multi_tom_agent, [episode], seed)[0]
+
+def free_param_names(params):
+    return [pparam for pparam in params['PERSON_PARAMS_TOM'] if pparam not in params['PERSON_PARAMS_FIXED']]
+
+def delayed_acceptance_log_ratio(log_full_ratio, log_screen_ratio):
+    """
+    Log of the second stage acceptance ratio of delayed acceptance: the full ratio, divided by the prob that the screen
+    accepts the forward move, min(1, screen ratio), and multiplied by the prob that it would accept the reverse move,
+    min(1, 1 / screen ratio). (The screen is a likelihood of the params, so its ratio for the reverse move is the
+    inverse.) Together the two screen terms are 1 / screen ratio, whether the screen ratio is above or below 1
+    """
+    return log_full_ratio - min(0, log_screen_ratio) + min(0, -log_screen_ratio)
 
-def acceptance_function(initial_log_prob, candidate_log_prob):
+def acceptance_function(params, initial_log_prob, candidate_log_prob, inverse_temp=1):
     """Determine if we are to accept or reject the new candidate params; if we accept then set params[
     'PERSON_PARAMS_TOM'] to the new params"""
-    acceptance_ratio = np.exp(candidate_log_prob - initial_log_prob)
+    acceptance_ratio = np.exp(inverse_temp * (candidate_log_prob - initial_log_prob))
     logging.info('acceptance_ratio: {}'.format(acceptance_ratio))
     if np.random.rand() <= acceptance_ratio:
         for i, pparam in enumerate(params['PERSON_PARAMS_TOM']):
@@ -537,6 +728,16 @@ def generate_candidate_params(params, epsilon_sd, step_size):
     logging.info('Old params: {}'.format(person_params_tom))
     logging.info('New params: {}'.format(person_params_tom_eps))
 
+def propose_person_params(params, person_params_tom, epsilon_sd, step_size):
+    """A candidate (see generate_candidate_params) for the TOM params person_params_tom, as a PERSON_PARAMS_TOM dict.
+    params isn't changed"""
+    proposal_params = dict(params, PERSON_PARAMS_TOM=person_params_tom, PERSON_PARAMS_TOMeps={})
+    generate_candidate_params(proposal_params, epsilon_sd, step_size)
+    return {pparam: proposal_params['PERSON_PARAMS_TOMeps'][pparam + 'eps'] for pparam in person_params_tom}
+
+def log_sum_exp(log_values):
+    return np.max(log_values) + np.log(np.sum(np.exp(log_values - np.max(log_values))))
+
 def convert_to_logit(param_value, pparam):
     """First convert any parameters that aren't probs to probs; then convert to logit"""
 
@@ -601,72 +802,8 @@ def get_trajs_for_new_data_format(data_path, train_mdps):
     joint_expert_trajs['ep_observations'] = joint_expert_trajs.pop('ep_states')
     return joint_expert_trajs
 
-#------------- main -----------------#
-
-if __name__ == "__main__":
-    """
-
-    """
-    parser = ArgumentParser()
-    parser.add_argument("-l", "--layout",
-                        help="Layout, (Choose from: cramped_room etc)",
-                        required=True)
-    parser.add_argument("-p", "--params", help="Starting params (all params get this value). OR set to 9 to get "
-                                               "random values for the starting params", required=False,
-                        default=None, type=float)
-    parser.add_argument("-ne", "--num_ep", help="Number of episodes to use when training (up to 16?)",
-                        required=False, default=16, type=int)
-    parser.add_argument("-lr", "--base_lr", help="Base learning rate. E.g. 0.1", default=0.1, type=float,
-                        required=False)
-    parser.add_argument("-ss", "--step_size", help="Step size for the step in the metropolis algorithm. E.g. 1.3 is "
-                        "approx for a 7D Gaussian vector, sd=0.5 (see find_length_gaussian_vector)", required=False,
-                        default=1.3, type=float)
-    parser.add_argument("-sd", "--epsilon_sd", type=float,
-                        help="Standard deviation of dist picking epison from. Initial runs suggest sd=0.02 is good",
-                        required=False, default=0.02)
-    parser.add_argument("-nh", "--num_toms", help="Number of human models to use for approximating P(action|state)",
-                        required=False, default=3, type=int)
-    parser.add_argument("-ns", "--num_grad_steps",  help="Number of gradient decent steps", required=False,
-                        default=1e9, type=int)
-    parser.add_argument("-t", "--run_type",
-                        help="Set to met to do metropolis sampling, zeroth to do zeroth order opt, or acc to just "
-                             "check the top-1 and top-2 accuracy",
-                        required=False, default="met")
-    #TODO: This gives problems with the BOOL for some reason: <-- giving "False" doesn't seem to actually give False as the param!
-    # Could use this: "def str2bool(v):
-    #     return str(v).lower() in ("yes", "true", "True", "t", "1")"
-    # parser.add_argument("-r", "--ensure_random_direction",
-    #                     help="Should make extra sure that the random search direction is not biased towards corners "
-    #                          "of the hypercube.", required=False, default=True, type=bool)
-    parser.add_argument("-sf", "--save_sample_freq", help="We save every save_sample_freq'th sample (e.g. if it's 10 "
-                        "we save every 10th sample)", required=False, default=50, type=int)
-    parser.add_argument("-bp", "--burn_in_period", help="Only save samples after this number of iterations",
-                        required=False, default=1000, type=int)
-
-    args = parser.parse_args()
-    layout = args.layout
-    starting_params = args.params
-
-    # -----------------------------#
-    # Settings for the zeroth order optimisation:
-    num_ep_to_use = args.num_ep  # How many episodes to use for the fitting
-    base_learning_rate = args.base_lr  # Quick test suggests loss for a single episode can be up to around 10. So if
-    # base learning rate is 1/5, we shift by roughly epsilon. NEED TO TUNE THIS!
-    step_size = args.step_size
-    epsilon_sd = args.epsilon_sd  # standard deviation of the dist to pick epsilon from
-    # ensure_random_direction = args.ensure_random_direction
-    ensure_random_direction = False
-    number_toms = args.num_toms
-    total_number_steps = args.num_grad_steps  # Number of steps to do in gradient decent
-    run_type = args.run_type
-    save_sample_freq = args.save_sample_freq
-    burn_in_period = args.burn_in_period
-    # -----------------------------#
-
-    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.ERROR)
-    logging.getLogger().setLevel(logging.ERROR)  # pk: Note sure why I need this line too
-
-    # Load human data as state-action pairs:
+def load_joint_expert_trajs(layout):
+    """Load the human data for the layout, as joint_expert_trajs"""
     train_mdps = [layout]
     ordered_trajs = True
     human_ai_trajs = False
@@ -677,13 +814,22 @@ if __name__ == "__main__":
     #
     # ONLY FOR NEW LAYOUTS
     if layout in ['bottleneck', 'room', 'centre_objects', 'centre_pots']:
-        data_path = "data/human/anonymized/clean_{}_trials_new_layouts.pkl".format('train')
-        joint_expert_trajs = get_trajs_for_new_data_format(data_path, train_mdps)
+        joint_expert_trajs = get_trajs_for_new_data_format(NEW_LAYOUTS_DATA_PATH, train_mdps)
 
     # Load (file I saved using pickle) instead FOR SIMPLE ONLY???: pickle_in = open('expert_trajs.pkl',
     # 'rb'); expert_trajs = pickle.load(pickle_in)
+    return joint_expert_trajs
 
-    # Starting personality params
+def load_data_index(layout, params):
+    """The index of the human data for the layout (see human_data_index.py), which is made from the data (loaded with
+    load_joint_expert_trajs) the first time, then cached on disk"""
+    assert layout in ['bottleneck', 'room', 'centre_objects', 'centre_pots'], "Only the new layouts are supported"
+    return get_human_data_index(layout, NEW_LAYOUTS_DATA_PATH, lambda: load_joint_expert_trajs(layout),
+                                params["MDP_PARAMS"]["start_order_list"])
+
+def make_starting_person_params(starting_params):
+    """Starting personality params: starting_params=None gives the default params, 9 gives random params, and any
+    other value gives all params this value"""
     if starting_params == None:
         # (These are found from looking at the other max likelihood TOM params, and seeing if there are patterns)
         PERSON_PARAMS_TOM = {
@@ -723,7 +869,10 @@ if __name__ == "__main__":
             "PROB_THINKING_NOT_MOVING_TOM": 0,
             "PROB_PAUSING_TOM": 99  # This will be modified within the code. Setting to 99 gives an error if it's not
         }
+    return PERSON_PARAMS_TOM
 
+def make_params(layout, PERSON_PARAMS_TOM, number_toms, ensure_random_direction, save_sample_freq, burn_in_period):
+    """The params needed to make the TOM agents (and for the sampling)"""
     # Irrelevant what values these start as:
     PERSON_PARAMS_TOMeps = {
         "COMPLIANCE_TOMeps": 9,
@@ -741,7 +890,7 @@ if __name__ == "__main__":
     PERSON_PARAMS_FIXED = {"PROB_PAUSING_TOM", "PROB_THINKING_NOT_MOVING_TOM"}
 
     # Need some params to create TOM agent:
-    LAYOUT_NAME = train_mdps[0]
+    LAYOUT_NAME = layout
     START_ORDER_LIST = ["any"] * 20
     REW_SHAPING_PARAMS = {
         "PLACEMENT_IN_POT_REW": 3,
@@ -776,61 +925,176 @@ if __name__ == "__main__":
         "PROB_RANDOM_ACTION": 0.06  # This is needed because during metropolis sampling we assume that there is
         # always >0.01 chance of taking each action -- so our agent needs to reflect this
     }  # Using same format as pbt_toms_v2
+    params["sim_threads"] = number_toms  # Needed when using ToMAgent
+    return params
 
+def make_mlp(params):
     mdp = OvercookedGridworld.from_layout_name(**params["MDP_PARAMS"])
 
     # Make the mlp:
     NO_COUNTERS_PARAMS = {
-        'start_orientations': START_ORIENTATIONS,
-        'wait_allowed': WAIT_ALLOWED,
+        'start_orientations': params["START_ORIENTATIONS"],
+        'wait_allowed': params["WAIT_ALLOWED"],
         'counter_goals': mdp.get_counter_locations(),
         'counter_drop': mdp.get_counter_locations(),
-        'counter_pickup': COUNTER_PICKUP,
+        'counter_pickup': params["COUNTER_PICKUP"],
         'same_motion_goals': params["SAME_MOTION_GOALS"]
     }  # This means that all counter locations are allowed to have objects dropped on them AND be "goals" (I think!)
     mlp = MediumLevelPlanner.from_pickle_or_compute(mdp, NO_COUNTERS_PARAMS, force_compute=False)
+    return mlp
+
+#------------- main -----------------#
+
+if __name__ == "__main__":
+    """
+
+    """
+    parser = ArgumentParser()
+    parser.add_argument("-l", "--layout",
+                        help="Layout, (Choose from: cramped_room etc)",
+                        required=True)
+    parser.add_argument("-p", "--params", help="Starting params (all params get this value). OR set to 9 to get "
+                                               "random values for the starting params", required=False,
+                        default=None, type=float)
+    parser.add_argument("-ne", "--num_ep", help="Number of episodes to use when training (up to 16?)",
+                        required=False, default=16, type=int)
+    parser.add_argument("-lr", "--base_lr", help="Base learning rate. E.g. 0.1", default=0.1, type=float,
+                        required=False)
+    parser.add_argument("-ss", "--step_size", help="Step size for the step in the metropolis algorithm. E.g. 1.3 is "
+                        "approx for a 7D Gaussian vector, sd=0.5 (see find_length_gaussian_vector)", required=False,
+                        default=1.3, type=float)
+    parser.add_argument("-sd", "--epsilon_sd", type=float,
+                        help="Standard deviation of dist picking epison from. Initial runs suggest sd=0.02 is good",
+                        required=False, default=0.02)
+    parser.add_argument("-nh", "--num_toms", help="Number of human models to use for approximating P(action|state)",
+                        required=False, default=3, type=int)
+    parser.add_argument("-ns", "--num_grad_steps",  help="Number of gradient decent steps", required=False,
+                        default=1e9, type=int)
+    parser.add_argument("-t", "--run_type",
+                        help="Set to met to do metropolis sampling, zeroth to do zeroth order opt, or acc to just "
+                             "check the top-1 and top-2 accuracy",
+                        required=False, default="met")
+    #TODO: This gives problems with the BOOL for some reason: <-- giving "False" doesn't seem to actually give False as the param!
+    # Could use this: "def str2bool(v):
+    #     return str(v).lower() in ("yes", "true", "True", "t", "1")"
+    # parser.add_argument("-r", "--ensure_random_direction",
+    #                     help="Should make extra sure that the random search direction is not biased towards corners "
+    #                          "of the hypercube.", required=False, default=True, type=bool)
+    parser.add_argument("-sf", "--save_sample_freq", help="Every step is saved in the chain store, but "
+                        "summarise_chains.py only uses every save_sample_freq'th sample (by default)", required=False,
+                        default=50, type=int)
+    parser.add_argument("-bp", "--burn_in_period", help="summarise_chains.py only uses samples after this number of "
+                        "iterations (by default)", required=False, default=1000, type=int)
+    parser.add_argument("-r", "--resume", help="Resume the metropolis chain saved in this file (e.g. "
+                        "DATA_DIR/metropolis/CHAIN_bottleneck_...pkl), or recorded in this chain store (e.g. "
+                        "DATA_DIR/metropolis/CHAIN_STORE_bottleneck_.../). The settings are taken from the saved chain",
+                        required=False, default=None)
+    parser.add_argument("-cf", "--chain_save_freq", help="Save the chain (so it can be resumed) every this many steps",
+                        required=False, default=10, type=int)
+    parser.add_argument("-nw", "--num_workers", help="Number of worker processes to find the likelihood with (the "
+                        "episodes are split between them). 1 to find it in this process", required=False, default=1,
+                        type=int)
+    parser.add_argument("-se", "--num_screen_ep", help="Number of episodes to screen the candidates on, before finding "
+                        "their full likelihood (delayed acceptance). 0 for no screen", required=False, default=0,
+                        type=int)
+    parser.add_argument("-mt", "--num_tries", help="Number of candidates proposed each step (multiple-try Metropolis, "
+                        "best with -nw). 1 for standard Metropolis", required=False, default=1, type=int)
+    parser.add_argument("-ref", "--reestimate_freq", help="Re-estimate the log likelihood of the current params every "
+                        "this many steps (see MetropolisChain). Default: never", required=False, default=None, type=int)
+
+    args = parser.parse_args()
+    layout = args.layout
+    starting_params = args.params
+
+    # -----------------------------#
+    # Settings for the zeroth order optimisation:
+    num_ep_to_use = args.num_ep  # How many episodes to use for the fitting
+    base_learning_rate = args.base_lr  # Quick test suggests loss for a single episode can be up to around 10. So if
+    # base learning rate is 1/5, we shift by roughly epsilon. NEED TO TUNE THIS!
+    step_size = args.step_size
+    epsilon_sd = args.epsilon_sd  # standard deviation of the dist to pick epsilon from
+    # ensure_random_direction = args.ensure_random_direction
+    ensure_random_direction = False
+    number_toms = args.num_toms
+    total_number_steps = args.num_grad_steps  # Number of steps to do in gradient decent
+    run_type = args.run_type
+    save_sample_freq = args.save_sample_freq
+    burn_in_period = args.burn_in_period
+    # -----------------------------#
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.ERROR)
+    logging.getLogger().setLevel(logging.ERROR)  # pk: Note sure why I need this line too
+
+    LAYOUT_NAME = layout
+
+    # Starting personality params
+    PERSON_PARAMS_TOM = make_starting_person_params(starting_params)
+    params = make_params(layout, PERSON_PARAMS_TOM, number_toms, ensure_random_direction, save_sample_freq,
+                         burn_in_period)
+    mlp = make_mlp(params)
+
+    # Load human data as state-action pairs (only the states in which the human acts are used):
+    data_index = load_data_index(layout, params)
 
     #-----------------------------#
     lr = base_learning_rate / num_ep_to_use  # learning rate: the more episodes we use the more the loss will be,
     # so we need to scale it down by num_ep_to_use
-    params["sim_threads"] = number_toms  # Needed when using ToMAgent
-    joint_actions_from_data = joint_expert_trajs['ep_actions']
     # First find the probability of the data not acting:
-    prob_data_doesnt_act, number_states_with_acting = find_prob_not_acting(joint_actions_from_data, num_ep_to_use)
+    prob_data_doesnt_act, number_states_with_acting = find_prob_not_acting(data_index, num_ep_to_use)
     print('Prob of data-agent taking ZERO action, (0,0): {}; Number states when data-agent acts: {}'.format(
         prob_data_doesnt_act, number_states_with_acting))
 
     DIR = DATA_DIR + 'metropolis/'
     create_dir_if_not_exists(DIR)
     info_filename = DIR + LAYOUT_NAME + '_' + time.strftime('%d-%m_%H:%M:%S') + '.txt'
-    params_filename = DIR + 'TOM_PARAMS_' + LAYOUT_NAME + '_' + time.strftime('%d-%m_%H:%M:%S') + '.txt'
-
-    #TODO: Use a more advanced way of doing this (e.g. logging??):
-    with open(info_filename, 'a') as f:
-        f.write('Settings, in this order: layout, starting_params, num_ep_to_use, base_learning_rate, step_size, '
-                    'epsilon_sd, ensure_random_direction, number_toms, total_number_steps, run_type:\n{}, {}, {}, {}, '
-                    '{}, {}, {}, {}, {}, {}'.format(layout, starting_params, num_ep_to_use,
-                    base_learning_rate, step_size, epsilon_sd, ensure_random_direction, number_toms,
-                                                                        total_number_steps, run_type))
-        f.write('\nProb of data-agent taking ZERO action, (0,0): {}; Number states when data-agent acts: {}\n'.format(
-                    prob_data_doesnt_act, number_states_with_acting))
+    store_dir = DIR + 'CHAIN_STORE_' + LAYOUT_NAME + '_' + time.strftime('%d-%m_%H:%M:%S') + '/'
+    chain_filename = DIR + 'CHAIN_' + LAYOUT_NAME + '_' + time.strftime('%d-%m_%H:%M:%S') + '.pkl'
+
+    likelihood_evaluator = None
+    if args.num_workers > 1:
+        likelihood_evaluator = ParallelLikelihoodEvaluator(params, data_index.num_episodes, args.num_workers)
+
+    if run_type == 'met' and args.resume is not None:
+        # Carry on from a saved chain (with the settings and output files of that chain):
+        if os.path.isdir(args.resume):
+            chain = MetropolisChain.from_store(args.resume, mlp, data_index, likelihood_evaluator)
+        else:
+            chain = MetropolisChain.load(args.resume, mlp, data_index, likelihood_evaluator)
+        assert chain.params["MDP_PARAMS"]["layout_name"] == LAYOUT_NAME, "The saved chain is for a different layout"
+        print('Resuming the chain from step {}'.format(chain.step_number))
+    else:
+        #TODO: Use a more advanced way of doing this (e.g. logging??):
+        with open(info_filename, 'a') as f:
+            f.write('Settings, in this order: layout, starting_params, num_ep_to_use, base_learning_rate, step_size, '
+                        'epsilon_sd, ensure_random_direction, number_toms, total_number_steps, run_type, num_tries, '
+                        'num_screen_ep:\n{}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}, {}'.format(layout, starting_params,
+                        num_ep_to_use, base_learning_rate, step_size, epsilon_sd, ensure_random_direction, number_toms,
+                        total_number_steps, run_type, args.num_tries, args.num_screen_ep))
+            f.write('\nProb of data-agent taking ZERO action, (0,0): {}; Number states when data-agent acts: {}\n'.format(
+                        prob_data_doesnt_act, number_states_with_acting))
+        if run_type == 'met':
+            chain = MetropolisChain(params, mlp, data_index, num_ep_to_use, epsilon_sd, step_size,
+                                    info_filename, store_dir, chain_filename,
+                                    likelihood_evaluator=likelihood_evaluator, num_tries=args.num_tries,
+                                    num_screen_ep=args.num_screen_ep, reestimate_freq=args.reestimate_freq)
 
     if run_type == 'met':
         # Metropolis sampling to find TOM params:
-        accepted_history = ([1]+3*[0])*25  # Wiki recommends acceptance should be 23% (for a Gaussian dist!)
-        start_time = time.time()
-        for step_number in range(np.int(total_number_steps)):
-            #TODO: Many of these inputs should be put in "params"
-            step_size = iterate_metropolis_sampling(params, mlp, joint_expert_trajs, num_ep_to_use, epsilon_sd,
-                            start_time, step_number, total_number_steps, accepted_history, step_size,
-                            info_filename, params_filename)
+        while chain.step_number < total_number_steps:
+            chain.step()
+            if chain.step_number % args.chain_save_freq == 0 or chain.step_number == total_number_steps:
+                chain.save()
+        if chain.num_screen_ep > 0:
+            print('Full likelihoods avoided by the screen: {}% ({} of {} candidates)'.format(
+                np.round(100 * chain.fraction_full_evaluations_avoided(), 1),
+                chain.num_screened - chain.num_full_evaluations, chain.num_screened))
     #
     # elif run_type == 'zeroth':
     #     # Optimise the params to fit the data:
     #     start_time = time.time()
     #     # For each gradient decent step, find the gradient and step:
     #     for step_number in range(np.int(total_number_steps)):
-    #         find_gradient_and_step_multi_tom(params, mlp, expert_trajs, num_ep_to_use, lr, epsilon_sd,
+    #         find_gradient_and_step_multi_tom(params, mlp, data_index, num_ep_to_use, lr, epsilon_sd,
     #                                         start_time, step_number, total_number_steps)
     # elif run_type == 'acc':
     #     raise ValueError("Not done yet!")
@@ -843,8 +1107,7 @@ if __name__ == "__main__":
     #     tom_number = 'check'
     #     multi_tom_agent = ToMAgent(params, tom_number).get_multi_agent(mlp)
     #     start_time = time.time()
-    #     top_1_acc, top_2_acc = find_top_12_accuracy(actions_from_data, expert_trajs, multi_tom_agent, num_ep_to_use,
-    #                                                 number_states_with_acting)
+    #     top_1_acc, top_2_acc = find_top_12_accuracy(data_index, multi_tom_agent, num_ep_to_use)
     #
     #     print('\nTop-1 accuracy: {}; Top-2 accuracy: {}; Finished acc calc in time {} secs'.format(
     #                                                             top_1_acc, top_2_acc, round(time.time() - start_time)))
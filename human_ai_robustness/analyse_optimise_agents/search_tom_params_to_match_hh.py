@@ -1,5 +1,8 @@
 import random
 import time
+import os, pickle
+import multiprocessing
+import itertools
 
 from overcooked_ai_py.agents.agent import AgentPair
 from overcooked_ai_py.mdp.overcooked_mdp import OvercookedGridworld
@@ -12,6 +15,24 @@ from human_ai_robustness.import_person_params import import_manual_tom_params
 from argparse import ArgumentParser
 import matplotlib.pyplot as plt
 from human_aware_rl.human.process_dataframes import get_human_human_trajectories
+from human_aware_rl.data_dir import DATA_DIR
+from human_aware_rl.utils import create_dir_if_not_exists
+
+"""
+Search for the prob_pausing_factor that makes the mean score of a population of TOMs (playing with each other) match the
+mean score of the human-human data on a layout.
+
+The gap (TOM mean - HH mean) falls as the factor rises (TOMs that pause more score less), so the factor is found by
+root finding on the gap: secant steps, falling back to bisection whenever the secant step leaves the bracket of the
+root or doesn't shrink it fast enough (see find_prob_pausing_factor). Each trial plays the same schedule of games with
+the same seeds (see make_game_schedule), so the gap is a smooth function of the factor and the search converges.
+
+The games of a trial are played in parallel, by a pool of workers that each make the planner and env once (see
+init_game_worker). The scores of each trial are cached on disk per (factor, seed, ...), so rerunning the search (e.g.
+with a different tolerance) only plays games for factors that haven't been tried before.
+"""
+
+SCORE_CACHE_DIR = DATA_DIR + "search_tom_params_cache/"
 
 no_counters_params = {
     'start_orientations': False,
@@ -121,71 +142,160 @@ def get_human_human_data_scores(layouts):
                 scores.append(expert_data[i][layout]['ep_returns'][j])
     return scores
 
-def get_stats_dict_toms(prob_pausing_factor, mlp, num_opponents, num_avg, layout):
-    """Get stats dict for the toms"""
-
-    scores_x3 = []  # x3 because the HH data has 1200 timesteps whereas we only give the TOMs 400 timesteps!
-
-    np.random.seed(len(layout))  # We want each tom to play with the same toms for each step of the search
-    # (but different for each layout), otherwise the search won't converge!
-
-    # Make the TOM params:
-    ALL_TOM_PARAMS = make_tom_pop(prob_pausing_factor)
-
-    # Make all TOMs:
-    tom_pop = []
-    for this_tom_params in ALL_TOM_PARAMS:
-        tom_agent = make_tom_agent(mlp)
-        tom_agent.set_tom_params(None, None, [this_tom_params], tom_params_choice=0)
-        tom_pop.append(tom_agent)
-    num_toms = len(ALL_TOM_PARAMS) if testing != "True" else 2
-
-    # Find score for each TOM:
+def make_mdp_and_mlp(layout):
+    """The mdp of the layout, and its planner (loaded from its pickle if it's been computed before)"""
+    cook_time = 20
+    start_order_list = 100 * ['any']
+    mdp = OvercookedGridworld.from_layout_name(layout, start_order_list=start_order_list,
+                                               cook_time=cook_time, rew_shaping_params=None)
+    counters_params = dict(no_counters_params, counter_drop=mdp.get_counter_locations(),
+                           counter_goals=mdp.get_counter_locations())
+    mlp = MediumLevelPlanner.from_pickle_or_compute(mdp, counters_params, force_compute=False)
+    return mdp, mlp
+
+def make_game_schedule(num_toms, num_opponents, seed):
+    """The games each trial plays: (tom, game number, opponent, player index of the tom) for num_opponents games of each
+    tom. The opponents and player indices are random, but the same for every trial, i.e. every prob_pausing_factor (as
+    otherwise the search won't converge)"""
+    rng = np.random.RandomState(seed)
+    schedule = []
     for i in range(num_toms):
-
-        score_this_tom = 0
-        tom_agent_player = tom_pop[i]
-
-        # Play with num_opponents opponents. Pick opponents and the player index randomly
         for j in range(num_opponents):
-
-            # Pick random opponent:
-            k = np.random.randint(num_toms)
-            if i != k:
-                tom_agent_opponent = tom_pop[k]
-            else:
-                tom_agent_opponent = copy.deepcopy(tom_pop[k])
-
-            # TODO: Probably not needed as get_rollouts resets??
-            tom_agent_player.reset()
-            tom_agent_opponent.reset()
-
-            # Pick random player index:
-            player_idx = np.random.randint(2)
-            if player_idx == 0:
-                agent_pair = AgentPair(tom_agent_player, tom_agent_opponent)
-            elif player_idx == 1:
-                agent_pair = AgentPair(tom_agent_opponent, tom_agent_player)
-
-            trajs = env.get_rollouts(agent_pair, num_games=num_avg, final_state=False, display=False, info=False)
-            sparse_rews = trajs["ep_returns"]
-            avg_sparse_rew = np.mean(sparse_rews)
-
-            # print('Score this pair: {}'.format(avg_sparse_rew))
-            score_this_tom += avg_sparse_rew
-
-        avg_score_this_tom = score_this_tom / num_opponents
-        scores_x3.append(avg_score_this_tom * 3)
-        # print('\n\nAvg score TOM{} on layout {}: {}\n\n'.format(i, layout_name, avg_score_this_tom))
-    print("\nTOM with pp factor {}:".format(prob_pausing_factor))
+            # Pick random opponent and random player index:
+            k = rng.randint(num_toms)
+            player_idx = rng.randint(2)
+            schedule.append((i, j, k, player_idx))
+    return schedule
+
+def game_seed(seed, tom_idx, game_number):
+    """The seed of each game (the same for every trial). The TOMs use the global RNGs"""
+    return (seed * 1000003 + tom_idx * 10007 + game_number * 101) % 2**32
+
+# The planner and env of this game worker process (see init_game_worker):
+game_worker_data = {}
+
+def init_game_worker(layout, horizon):
+    mdp, mlp = make_mdp_and_mlp(layout)
+    game_worker_data["mlp"] = mlp
+    game_worker_data["env"] = OvercookedEnv(mdp, horizon=horizon)
+
+def make_tom_from_params(mlp, tom_params):
+    tom_agent = make_tom_agent(mlp)
+    tom_agent.set_tom_params(None, None, [tom_params], tom_params_choice=0)
+    return tom_agent
+
+def play_game(prob_pausing_factor, tom_idx, opponent_idx, player_idx, num_avg, seed):
+    """Mean score of the tom tom_idx with the tom opponent_idx (from make_tom_pop(prob_pausing_factor)), over num_avg
+    games"""
+    np.random.seed(seed)
+    random.seed(seed)
+    all_tom_params = make_tom_pop(prob_pausing_factor)
+    # Only the two TOMs of this game are made (the opponent is a separate TOM even if it has the same params):
+    tom_agent_player = make_tom_from_params(game_worker_data["mlp"], all_tom_params[tom_idx])
+    tom_agent_opponent = make_tom_from_params(game_worker_data["mlp"], all_tom_params[opponent_idx])
+    if player_idx == 0:
+        agent_pair = AgentPair(tom_agent_player, tom_agent_opponent)
+    elif player_idx == 1:
+        agent_pair = AgentPair(tom_agent_opponent, tom_agent_player)
+    trajs = game_worker_data["env"].get_rollouts(agent_pair, num_games=num_avg, final_state=False, display=False,
+                                                 info=False)
+    return np.mean(trajs["ep_returns"])
+
+def score_cache_filename(layout):
+    return SCORE_CACHE_DIR + "scores_{}.pkl".format(layout)
+
+def load_score_cache(layout):
+    """(prob_pausing_factor, seed, num_toms, num_opponents, num_avg, horizon) -> scores_x3 of the toms"""
+    if not os.path.exists(score_cache_filename(layout)):
+        return {}
+    with open(score_cache_filename(layout), 'rb') as f:
+        return pickle.load(f)
+
+def save_score_cache(layout, score_cache):
+    create_dir_if_not_exists(SCORE_CACHE_DIR)
+    with open(score_cache_filename(layout) + ".tmp", 'wb') as f:
+        pickle.dump(score_cache, f)
+    os.replace(score_cache_filename(layout) + ".tmp", score_cache_filename(layout))
+
+def get_stats_dict_toms(prob_pausing_factor, schedule, settings, pool, score_cache, layout):
+    """Get stats dict for the toms. settings: (seed, num_toms, num_opponents, num_avg, horizon). The games are played
+    by the pool (or in this process if pool is None), unless the scores are already in score_cache"""
+
+    seed, num_toms, num_opponents, num_avg, horizon = settings
+    cache_key = (round(prob_pausing_factor, 12),) + settings
+    if cache_key in score_cache:
+        scores_x3 = score_cache[cache_key]
+        print("\nTOM with pp factor {} (cached):".format(prob_pausing_factor))
+    else:
+        tasks = [(prob_pausing_factor, i, k, player_idx, num_avg, game_seed(seed, i, j))
+                 for i, j, k, player_idx in schedule]
+        game_scores = pool.starmap(play_game, tasks, chunksize=1) if pool is not None \
+            else list(itertools.starmap(play_game, tasks))
+        # x3 because the HH data has 1200 timesteps whereas we only give the TOMs 400 timesteps!
+        scores_x3 = [np.mean(game_scores[i * num_opponents:(i + 1) * num_opponents]) * 3 for i in range(num_toms)]
+        score_cache[cache_key] = scores_x3
+        save_score_cache(layout, score_cache)
+        print("\nTOM with pp factor {}:".format(prob_pausing_factor))
     stats_dict = get_stats(scores_x3)
     # title = "TOM pop sp scores_x3 over all layouts"
     # plot_scores_dist(scores_x3, title)
     return stats_dict, scores_x3
 
+def find_prob_pausing_factor(find_gap, initial_factor, tolerance, max_trials, min_bracket_width=1e-4):
+    """
+    Find the root of find_gap(factor) = TOM mean - HH mean, for factor in [0, 1], to within tolerance. The gap is
+    assumed to fall as the factor rises. First find a bracket of the root (the initial factor, and 0 or 1), then
+    take secant steps, or bisect when the secant step leaves the bracket or the last step didn't halve it.
+    :return: the factor with the smallest gap found, and the gap of each factor tried
+    """
+    gaps = {}
+
+    def gap(factor):
+        if factor not in gaps:
+            gaps[factor] = find_gap(factor)
+        return gaps[factor]
+
+    def best_factor():
+        return min(gaps, key=lambda factor: abs(gaps[factor]))
+
+    prev_factor, prev_gap = initial_factor, gap(initial_factor)
+    if abs(prev_gap) <= tolerance:
+        return initial_factor, gaps
+    # If the TOMs score too much, they need to pause more:
+    factor = 1. if prev_gap > 0 else 0.
+    this_gap = gap(factor)
+    if np.sign(this_gap) == np.sign(prev_gap):
+        print("The gap doesn't change sign between pp factors {} and {}, so there's no root in [0, 1]".format(
+            initial_factor, factor))
+        return best_factor(), gaps
+    # The root is between above (gap > 0) and below (gap < 0):
+    above, below = (prev_factor, factor) if prev_gap > 0 else (factor, prev_factor)
+
+    prev_width = np.inf
+    while abs(this_gap) > tolerance and len(gaps) < max_trials and abs(above - below) > min_bracket_width:
+        width = abs(above - below)
+        secant_factor = factor - this_gap * (factor - prev_factor) / (this_gap - prev_gap) \
+            if this_gap != prev_gap else None
+        if secant_factor is not None and min(above, below) < secant_factor < max(above, below) \
+                and width <= prev_width / 2:
+            new_factor, method = secant_factor, "secant"
+        else:
+            new_factor, method = (above + below) / 2, "bisection"
+        prev_width = width
+        prev_factor, prev_gap, factor, this_gap = factor, this_gap, new_factor, gap(new_factor)
+        if this_gap > 0:
+            above = factor
+        else:
+            below = factor
+        print("Trial {} ({}): pp factor {}; gap {}; bracket [{}, {}]".format(len(gaps), method, factor,
+                                                                           np.round(this_gap, 2), min(above, below),
+                                                                           max(above, below)))
+    return best_factor(), gaps
+
 if __name__ == "__main__":
-    """Create a pop of (30?) TOMs, then play each TOM with itself on each layout. Then print a bunch of stats about the 
-    performance of the TOMs, e.g. median score, mean score, range, SD. And plot the scores_x3."""
+    """Create a pop of (30?) TOMs, then play each TOM with other TOMs on the layout, and search for the
+    prob_pausing_factor for which the mean score of the TOMs matches the HH data. Then print a bunch of stats about
+    the performance of the TOMs, e.g. median score, mean score, range, SD. And plot the scores_x3."""
 
     parser = ArgumentParser()
     parser.add_argument("-a", "--num_avg",
@@ -194,18 +304,24 @@ if __name__ == "__main__":
                         help="whether we're testing or not", required=False, default="False")
     parser.add_argument("-l", "--layout", help="e.g. 'cramped_room'", required=True)
     parser.add_argument("-no", "--num_opponents", help="Number of (randomly selected) opponents to play with", required=False, type=int, default=5)
-    parser.add_argument("-lr", "--learning_rate", help="LR", required=False, type=float, default=0.002)
-    parser.add_argument("-ppf", "--prob_pausing_factor", default=0.3, type=float)
+    parser.add_argument("-ppf", "--prob_pausing_factor", help="Initial pp factor", default=0.3, type=float)
+    parser.add_argument("-mt", "--max_trials", help="Max number of pp factors to try", required=False, type=int,
+                        default=20)
+    parser.add_argument("-nw", "--num_workers", help="Number of worker processes to play the games of each trial "
+                        "(1 to play them in this process)", required=False, type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument("-s", "--seed", help="Seed for the games (default: len(layout))", required=False, type=int,
+                        default=None)
 
     args = parser.parse_args()
-    num_avg, testing, layout, num_opponents, learning_rate, initial_prob_pausing_factor \
-        = args.num_avg, args.testing, args.layout, args.num_opponents, args.learning_rate, args.prob_pausing_factor
+    num_avg, testing, layout, num_opponents, initial_prob_pausing_factor \
+        = args.num_avg, args.testing, args.layout, args.num_opponents, args.prob_pausing_factor
 
     # --------------------------#
     # SETTINGS
-    learning_rate = learning_rate
     horizon = 400
     stop_when_within = 0.02
+    seed = args.seed if args.seed is not None else len(layout)  # Different games for each layout
     #--------------------------#
 
     # First find HH data stats
@@ -213,43 +329,44 @@ if __name__ == "__main__":
     print('\nHH:')
     stats_dict_hh = get_stats(HH_scores)
 
-    # Stuff that can be done outside the loop:
-    cook_time = 20
-    start_order_list = 100 * ['any']
-    layout_name = layout
-    mdp = OvercookedGridworld.from_layout_name(layout_name, start_order_list=start_order_list,
-                                               cook_time=cook_time, rew_shaping_params=None)
-    no_counters_params['counter_drop'] = mdp.get_counter_locations()
-    no_counters_params['counter_goals'] = mdp.get_counter_locations()
-    mlp = MediumLevelPlanner.from_pickle_or_compute(mdp, no_counters_params, force_compute=False)
-    env = OvercookedEnv(mdp, horizon=horizon)
-
-    # Fix initial value for prob_pausing_factor
-    prob_pausing_factor = initial_prob_pausing_factor if initial_prob_pausing_factor is not None else 0.3
-
-    loss = np.inf
-    step = 0
+    # Stuff that can be done outside the loop (the schedule of games, and the planner and env of each worker):
+    num_toms = len(make_tom_pop(0)) if testing != "True" else 2
+    schedule = make_game_schedule(num_toms, num_opponents, seed)
+    settings = (seed, num_toms, num_opponents, num_avg, horizon)
+    score_cache = load_score_cache(layout)
+    if args.num_workers > 1:
+        # Spawn, so that each worker has its own tf
+        pool = multiprocessing.get_context("spawn").Pool(args.num_workers, initializer=init_game_worker,
+                                                         initargs=(layout, horizon))
+    else:
+        pool = None
+        init_game_worker(layout, horizon)
+
+    trial_results = {}  # pp factor -> (stats_dict_toms, TOM_scores_x3)
     start_time = time.perf_counter()
 
-    while abs(loss) > stop_when_within*stats_dict_hh["mean"] and step < 1e2:
-        # If the difference between the TOM mean and HH mean is more than 5% of the HH mean then keep searching
-
-        # Find mean of TOMs:
-        stats_dict_toms, TOM_scores_x3 = get_stats_dict_toms(prob_pausing_factor, mlp, num_opponents, num_avg, layout)
-
-        # Find loss and step:
-        loss = stats_dict_hh["mean"] - stats_dict_toms["mean"]
-        prob_pausing_factor = prob_pausing_factor - learning_rate*loss
-        prob_pausing_factor = 0 if prob_pausing_factor < 0 else prob_pausing_factor
-        prob_pausing_factor = 1 if prob_pausing_factor > 1 else prob_pausing_factor
-        step += 1
-        print("Step {}: time elapsed: {}; loss: {}; new pp factor: {}; HH mean: {}; TOM mean: {}"
-              .format(step, np.round(time.perf_counter() - start_time), loss, prob_pausing_factor, stats_dict_hh["mean"], stats_dict_toms["mean"]))
-
-    print('\nFinal pp factor: {}\n'.format(prob_pausing_factor))
+    def find_gap(prob_pausing_factor):
+        trial_results[prob_pausing_factor] = get_stats_dict_toms(prob_pausing_factor, schedule, settings, pool,
+                                                                 score_cache, layout)
+        gap = trial_results[prob_pausing_factor][0]["mean"] - stats_dict_hh["mean"]
+        print("Time elapsed: {}; pp factor: {}; gap: {}; HH mean: {}; TOM mean: {}".format(
+            np.round(time.perf_counter() - start_time), prob_pausing_factor, gap, stats_dict_hh["mean"],
+            trial_results[prob_pausing_factor][0]["mean"]))
+        return gap
+
+    # Stop when the difference between the TOM mean and HH mean is within stop_when_within of the HH mean:
+    try:
+        prob_pausing_factor, gaps = find_prob_pausing_factor(find_gap, initial_prob_pausing_factor,
+                                                             stop_when_within * stats_dict_hh["mean"], args.max_trials)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    stats_dict_toms, TOM_scores_x3 = trial_results[prob_pausing_factor]
+
+    print('\nFinal pp factor: {} (after {} trials)\n'.format(prob_pausing_factor, len(gaps)))
     print("HH stats: ", stats_dict_hh)
     plot_scores_dist(HH_scores, "HH scores", disp=False)
     print("TOM stats: ", stats_dict_toms)
     plot_scores_dist(TOM_scores_x3, "TOM scores x3", disp=False)
     plt.show()
-
@@ -0,0 +1,235 @@
+import time, os, pickle
+import logging
+import numpy as np
+from argparse import ArgumentParser
+from human_aware_rl.data_dir import DATA_DIR
+from human_aware_rl.utils import create_dir_if_not_exists
+from human_ai_robustness.pbt_checkpoint import get_rng_states, set_rng_states
+from human_ai_robustness.analyse_optimise_agents.sample_tom_params_metropolis import ParallelLikelihoodEvaluator, \
+    find_log_probs_each_params, find_prob_not_acting, load_data_index, make_starting_person_params, make_params, \
+    make_mlp, free_param_names, convert_to_logit, convert_back_from_logit
+
+"""
+Fit the TOM params to the human data by minimising the cross entropy loss with SPSA (simultaneous perturbation
+stochastic approximation, Spall 1992), instead of the one-direction-at-a-time zeroth order steps of
+find_gradient_and_step_multi_tom / find_gradient_and_step_multi_hm.
+
+Each step perturbs all the (free) params at once, in logit space (see convert_to_logit), along num_directions random
++-1 directions. The loss is found at theta + c_k*delta and theta - c_k*delta for each direction delta, and the gradient
+estimate is the mean over directions of (loss_plus - loss_minus) / (2*c_k) * delta. The + and - evaluations of a
+direction use the same seed (common random numbers, see segment_seed), so the TOMs' randomness mostly cancels in the
+difference. All 2*num_directions losses of a step are found together, with the episodes of all of them split across
+a pool of workers (see ParallelLikelihoodEvaluator).
+
+The gains follow a schedule (see learning_rate): Spall's a / (k + 1 + A)^alpha, or constant, step or cosine decay,
+with perturbation size c / (k + 1)^gamma. The optimiser is checkpointed (atomically) every save_freq steps, and can be
+resumed with --resume.
+"""
+
+LR_SCHEDULES = ["spsa", "constant", "step", "cosine"]
+
+
+class SPSAOptimiser(object):
+
+    def __init__(self, params, mlp, data_index, num_ep_to_use, num_directions, a, c, big_a, alpha, gamma, lr_schedule,
+                 total_number_steps, info_filename, checkpoint_filename, likelihood_evaluator=None):
+        assert lr_schedule in LR_SCHEDULES, "lr_schedule must be one of {}".format(LR_SCHEDULES)
+        self.params = params
+        self.mlp = mlp
+        self.data_index = data_index
+        self.num_ep_to_use = num_ep_to_use
+        self.num_directions = num_directions
+        self.a = a
+        self.c = c
+        self.big_a = big_a  # Spall's stability constant A
+        self.alpha = alpha
+        self.gamma = gamma
+        self.lr_schedule = lr_schedule
+        self.total_number_steps = total_number_steps
+        self.info_filename = info_filename
+        self.checkpoint_filename = checkpoint_filename
+        self.likelihood_evaluator = likelihood_evaluator  # None to find the losses in this process
+        self.param_names = free_param_names(params)
+        self.theta = np.array([convert_to_logit(params['PERSON_PARAMS_TOM'][pparam], pparam)
+                               for pparam in self.param_names])
+        self.step_number = 0
+        self.history = []  # (step number, loss estimate, params) of each step
+        self.elapsed_time = 0
+        self.start_time = time.time()
+
+    def learning_rate(self, k):
+        """a_k, the gain of the gradient step at step k"""
+        if self.lr_schedule == "spsa":
+            return self.a / (k + 1 + self.big_a) ** self.alpha
+        elif self.lr_schedule == "constant":
+            return self.a
+        elif self.lr_schedule == "step":
+            return self.a * 0.5 ** (k // max(self.total_number_steps // 4, 1))  # Halve 4 times over the run
+        elif self.lr_schedule == "cosine":
+            return self.a * 0.5 * (1 + np.cos(np.pi * min(k / self.total_number_steps, 1)))
+
+    def perturbation_size(self, k):
+        """c_k"""
+        return self.c / (k + 1) ** self.gamma
+
+    def person_params(self, theta):
+        """The PERSON_PARAMS_TOM dict for the free params theta (in logit space)"""
+        person_params = dict(self.params['PERSON_PARAMS_TOM'])
+        for pparam, logit_param in zip(self.param_names, theta):
+            person_params[pparam] = convert_back_from_logit(logit_param, pparam)
+        return person_params
+
+    def find_losses(self, thetas, seeds):
+        """Cross entropy loss (per acting state, normalised by log(0.01) as in find_cross_entropy_loss) of each theta"""
+        log_probs = find_log_probs_each_params(self.params, [self.person_params(theta) for theta in thetas], seeds,
+                                               self.mlp, self.data_index, self.num_ep_to_use,
+                                               self.likelihood_evaluator)
+        number_states_with_acting = find_prob_not_acting(self.data_index, self.num_ep_to_use)[1]
+        return np.array(log_probs) / np.log(0.01) / number_states_with_acting
+
+    def step(self):
+        k = self.step_number
+        c_k = self.perturbation_size(k)
+        # Rademacher (+-1) directions, and one seed per direction, shared by its + and - evaluations:
+        deltas = np.random.choice([-1., 1.], size=(self.num_directions, len(self.theta)))
+        seeds = [np.random.randint(2**31) for _ in range(self.num_directions)]
+        thetas = [self.theta + sign * c_k * delta for delta in deltas for sign in [1, -1]]
+        losses = self.find_losses(thetas, [seed for seed in seeds for _ in range(2)])
+        loss_plus, loss_minus = losses[0::2], losses[1::2]
+
+        gradient = np.mean([(loss_plus[d] - loss_minus[d]) / (2 * c_k) * deltas[d]
+                            for d in range(self.num_directions)], axis=0)
+        self.theta = self.theta - self.learning_rate(k) * gradient
+        # (Keep the params away from 0 and 1, where the logit is infinite)
+        self.theta = np.clip(self.theta, -10, 10)
+
+        loss = float(np.mean(losses))  # Estimate of the loss at theta (before the step)
+        self.history.append((k, loss, self.person_params(self.theta)))
+        self.params['PERSON_PARAMS_TOM'] = self.person_params(self.theta)
+        print_spsa_info(self, loss, gradient)
+        self.step_number += 1
+
+    def get_state(self):
+        """Everything needed to continue the optimisation (except the mlp and data), including the RNG state"""
+        state = {k: v for k, v in self.__dict__.items()
+                 if k not in ["mlp", "data_index", "likelihood_evaluator", "start_time"]}
+        state["elapsed_time"] = time.time() - self.start_time
+        state.update(get_rng_states())
+        return state
+
+    def save(self):
+        """Save a checkpoint (atomically, so a crash while saving leaves the previous checkpoint intact)"""
+        with open(self.checkpoint_filename + ".tmp", 'wb') as f:
+            pickle.dump(self.get_state(), f)
+        os.replace(self.checkpoint_filename + ".tmp", self.checkpoint_filename)
+
+    @staticmethod
+    def load(checkpoint_filename, mlp, data_index, likelihood_evaluator=None):
+        """Continue from a checkpoint as if the optimisation had never stopped. Note that this sets the global RNG
+        state"""
+        with open(checkpoint_filename, 'rb') as f:
+            state = pickle.load(f)
+        set_rng_states(state)
+        optimiser = SPSAOptimiser(state["params"], mlp, data_index, state["num_ep_to_use"], state["num_directions"],
+                                  state["a"], state["c"], state["big_a"], state["alpha"], state["gamma"],
+                                  state["lr_schedule"], state["total_number_steps"], state["info_filename"],
+                                  checkpoint_filename, likelihood_evaluator)
+        for k in ["theta", "step_number", "history"]:
+            setattr(optimiser, k, state[k])
+        optimiser.start_time = time.time() - state["elapsed_time"]
+        return optimiser
+
+
+def print_spsa_info(optimiser, loss, gradient):
+    display_steps = 10
+    if optimiser.step_number % display_steps == 0:
+        print('Completed {} steps in time {} mins; Loss: {}; lr: {}; c: {}; Gradient norm: {}'.format(
+            optimiser.step_number, round((time.time() - optimiser.start_time) / 60), np.round(loss, 4),
+            np.round(optimiser.learning_rate(optimiser.step_number), 5),
+            np.round(optimiser.perturbation_size(optimiser.step_number), 5), np.round(np.linalg.norm(gradient), 4)))
+        print(optimiser.params['PERSON_PARAMS_TOM'])
+        with open(optimiser.info_filename, 'a') as f:
+            f.write('Step {}; Loss: {}; PPARAMS: {}\n'.format(optimiser.step_number, loss,
+                                                              optimiser.params['PERSON_PARAMS_TOM']))
+
+
+#------------- main -----------------#
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-l", "--layout", help="Layout, (Choose from: bottleneck, room, centre_objects, centre_pots)",
+                        required=True)
+    parser.add_argument("-p", "--params", help="Starting params (all params get this value). OR set to 9 to get "
+                        "random values for the starting params", required=False, default=None, type=float)
+    parser.add_argument("-ne", "--num_ep", help="Number of episodes to use when training (up to 16?)",
+                        required=False, default=16, type=int)
+    parser.add_argument("-nh", "--num_toms", help="Number of human models to use for approximating P(action|state)",
+                        required=False, default=3, type=int)
+    parser.add_argument("-ns", "--num_grad_steps", help="Number of SPSA steps", required=False, default=1000,
+                        type=int)
+    parser.add_argument("-nd", "--num_directions", help="Number of +- perturbation pairs per step (their losses are "
+                        "found concurrently)", required=False, default=4, type=int)
+    parser.add_argument("-a", "--lr", help="Learning rate a (the gain of the gradient step, in logit space)",
+                        required=False, default=0.5, type=float)
+    parser.add_argument("-c", "--perturbation", help="Perturbation size c (in logit space)", required=False,
+                        default=0.2, type=float)
+    parser.add_argument("-A", "--stability_constant", help="Spall's A, for the spsa schedule (e.g. 10% of the number "
+                        "of steps)", required=False, default=100, type=float)
+    parser.add_argument("-al", "--alpha", help="Decay exponent of the learning rate (spsa schedule)", required=False,
+                        default=0.602, type=float)
+    parser.add_argument("-ga", "--gamma", help="Decay exponent of the perturbation size", required=False,
+                        default=0.101, type=float)
+    parser.add_argument("-lrs", "--lr_schedule", help="Learning rate schedule: {}".format(LR_SCHEDULES),
+                        required=False, default="spsa")
+    parser.add_argument("-nw", "--num_workers", help="Number of worker processes to find the losses with. 1 to find "
+                        "them in this process", required=False, default=1, type=int)
+    parser.add_argument("-sf", "--save_freq", help="Checkpoint every this many steps", required=False, default=10,
+                        type=int)
+    parser.add_argument("-r", "--resume", help="Resume from this checkpoint (the SPSA_...pkl file)", required=False,
+                        default=None)
+    parser.add_argument("-s", "--seed", help="Seed for the RNGs", required=False, default=0, type=int)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.ERROR)
+    logging.getLogger().setLevel(logging.ERROR)
+
+    np.random.seed(args.seed)
+    ensure_random_direction = False
+    save_sample_freq, burn_in_period = None, None  # (Only used by the Metropolis sampling)
+    params = make_params(args.layout, make_starting_person_params(args.params), args.num_toms,
+                         ensure_random_direction, save_sample_freq, burn_in_period)
+    mlp = make_mlp(params)
+    data_index = load_data_index(args.layout, params)
+    likelihood_evaluator = None
+    if args.num_workers > 1:
+        likelihood_evaluator = ParallelLikelihoodEvaluator(params, data_index.num_episodes, args.num_workers)
+
+    if args.resume is not None:
+        optimiser = SPSAOptimiser.load(args.resume, mlp, data_index, likelihood_evaluator)
+        assert optimiser.params["MDP_PARAMS"]["layout_name"] == args.layout, "The checkpoint is for a different layout"
+        print('Resuming from step {}'.format(optimiser.step_number))
+    else:
+        DIR = DATA_DIR + 'spsa/'
+        create_dir_if_not_exists(DIR)
+        filename_base = DIR + 'SPSA_' + args.layout + '_' + time.strftime('%d-%m_%H:%M:%S')
+        with open(filename_base + '.txt', 'a') as f:
+            f.write('Settings: {}\n'.format(vars(args)))
+        optimiser = SPSAOptimiser(params, mlp, data_index, args.num_ep, args.num_directions, args.lr,
+                                  args.perturbation, args.stability_constant, args.alpha, args.gamma,
+                                  args.lr_schedule, args.num_grad_steps, filename_base + '.txt',
+                                  filename_base + '.pkl', likelihood_evaluator)
+
+    try:
+        while optimiser.step_number < optimiser.total_number_steps:
+            optimiser.step()
+            if optimiser.step_number % args.save_freq == 0 or \
+                    optimiser.step_number == optimiser.total_number_steps:
+                optimiser.save()
+    finally:
+        if likelihood_evaluator is not None:
+            likelihood_evaluator.close()
+
+    best_step, best_loss, best_params = min(optimiser.history, key=lambda entry: entry[1])
+    print('\nFinal params: {}\nLowest loss estimate {} at step {}, with params: {}'.format(
+        optimiser.params['PERSON_PARAMS_TOM'], best_loss, best_step, best_params))
+    print('\nend')
@@ -0,0 +1,76 @@
+import numpy as np
+from argparse import ArgumentParser
+from human_ai_robustness.analyse_optimise_agents.chain_store import load_chain
+from human_ai_robustness.analyse_optimise_agents.mcmc_diagnostics import autocorrelation, effective_sample_size, \
+    diagnose
+from human_ai_robustness.analyse_optimise_agents.sample_tom_params_metropolis import convert_back_from_logit
+
+"""
+Summary of Metropolis chains of the TOM params, from their chain stores (see chain_store.py): for each chain, the
+acceptance rate, the autocorrelation and ESS (per hour of sampling) of each param, and the posterior quantiles of each
+param. With several chains, the R-hat and ESS over all the chains too (see mcmc_diagnostics.py).
+
+E.g. python summarise_chains.py DATA_DIR/metropolis/CHAIN_STORE_bottleneck_.../ -bp 1000
+"""
+
+QUANTILES = [2.5, 25, 50, 75, 97.5]
+LAGS = [1, 5, 10, 50]
+
+
+def chain_samples(store_dir, burn_in_period=None, thin=None):
+    """The steps after the burn in period, and the meta of the store. The burn in period and thinning default to those
+    the chain was run with (burn_in_period and save_sample_freq)"""
+    rows, meta = load_chain(store_dir)
+    chain_params = meta["chain_state"]["params"]
+    burn_in_period = chain_params["burn_in_period"] if burn_in_period is None else burn_in_period
+    thin = chain_params["save_sample_freq"] if thin is None else thin
+    return rows[rows["step"] >= burn_in_period][::thin], rows, meta
+
+def summarise_chain(store_dir, burn_in_period=None, thin=None):
+    samples, rows, meta = chain_samples(store_dir, burn_in_period, thin)
+    print('\n{}: {} steps in {} hrs, {} samples used'.format(store_dir, len(rows),
+                                                             np.round(np.sum(rows["step_time"]) / 3600, 2),
+                                                             len(samples)))
+    if len(samples) < 4:
+        print('    (Need at least 4 samples after the burn in period)')
+        return
+    burnt_in = rows[rows["step"] >= samples["step"][0]]
+    hrs = np.sum(burnt_in["step_time"]) / 3600
+    print('Acceptance rate: {}; Log prob: mean {}, last {}'.format(np.round(np.mean(burnt_in["accepted"]), 3),
+                                                                  np.round(np.mean(samples["log_prob"]), 1),
+                                                                  np.round(rows[-1]["log_prob"], 1)))
+    for i, pparam in enumerate(meta["param_names"]):
+        logit_samples = samples["logit_params"][:, i]
+        autocorr = autocorrelation(logit_samples)
+        ess = effective_sample_size(logit_samples[None, :])
+        quantiles = [convert_back_from_logit(q, pparam) for q in np.percentile(logit_samples, QUANTILES)]
+        print('    {}: quantiles {} {}; autocorrelation at lags {}: {}; ESS {} ({} per hour)'.format(
+            pparam, QUANTILES, [float(np.round(q, 3)) for q in quantiles], LAGS,
+            [float(np.round(autocorr[lag], 2)) if lag < len(autocorr) else None for lag in LAGS],
+            np.round(ess, 1), np.round(ess / hrs, 1) if hrs > 0 else None))
+
+def summarise_chains(store_dirs, burn_in_period=None, thin=None):
+    for store_dir in store_dirs:
+        summarise_chain(store_dir, burn_in_period, thin)
+    if len(store_dirs) > 1:
+        samples_each_chain = [chain_samples(store_dir, burn_in_period, thin)[0] for store_dir in store_dirs]
+        if min(len(samples) for samples in samples_each_chain) >= 4:
+            param_names = load_chain(store_dirs[0])[1]["param_names"]
+            print('\nOver all {} chains:'.format(len(store_dirs)))
+            for pparam, (rhat, ess) in diagnose([samples["logit_params"] for samples in samples_each_chain],
+                                                param_names).items():
+                print('    {}: R-hat {}, ESS {}'.format(pparam, np.round(rhat, 3), np.round(ess, 1)))
+
+
+#------------- main -----------------#
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("store_dirs", help="The chain store(s) to summarise", nargs='+')
+    parser.add_argument("-bp", "--burn_in_period", help="Only use samples after this number of steps (default: the "
+                        "chain's burn_in_period)", required=False, default=None, type=int)
+    parser.add_argument("-th", "--thin", help="Only use every thin'th sample (default: the chain's save_sample_freq)",
+                        required=False, default=None, type=int)
+    args = parser.parse_args()
+
+    summarise_chains(args.store_dirs, args.burn_in_period, args.thin)
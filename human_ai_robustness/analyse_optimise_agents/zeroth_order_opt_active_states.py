@@ -7,7 +7,10 @@ from human_ai_robustness.agent import GreedyHumanModel_pk
 from overcooked_ai_py.planning.planners import MediumLevelPlanner
 import logging
 import numpy as np
-from collections import Counter
+from overcooked_ai_py.mdp.actions import Action
+from human_ai_robustness.human_data_index import get_human_data_index
+from human_ai_robustness.analyse_optimise_agents.fit_metrics import probs_data_action, cross_entropy_loss, \
+    top_12_accuracy, prob_not_acting
 # np.seterr(divide='ignore', invalid='ignore')  # Suppress error about diving by zero
 
 """
@@ -17,23 +20,21 @@ also act, then compare their actions.
 
 # Helper functions:
 
-def choose_hm_actions(expert_trajs, hm_agent, num_ep_to_use):
+def choose_hm_actions(data_index, hm_agent, num_ep_to_use):
     """
     Take a human model with given parameters, then use this to choose one action for every state in the data.
     Correction: now we only find one action for each state in which the data acts!
-    :return: hm_actions, a list of lists of actions chosen by the HM
+    :return: hm_actions, the action chosen by the HM (as an index in Action.ALL_ACTIONS) for each of
+    data_index.acting_rows(num_ep_to_use, by_episode=True)
     """
 
     hm_actions = []
-    actions_from_data = expert_trajs['ep_actions']
 
     # For each episode we want to use
-    for i in range(num_ep_to_use):
-
-        hm_actions_this_ep = []
+    for agent_idx, i, rows in data_index.acting_segments(num_ep_to_use, by_episode=True):
 
         # Reset histories in the HM:
-        hm_agent.agent_index =  expert_trajs['ep_agent_idxs'][i]
+        hm_agent.agent_index = agent_idx
         hm_agent.prev_state = None
         hm_agent.timesteps_stuck = 0  # Count how many times there's a clash with the other player
         hm_agent.dont_drop = False
@@ -41,213 +42,77 @@ def choose_hm_actions(expert_trajs, hm_agent, num_ep_to_use):
         hm_agent.prev_best_action = None
         hm_agent.GHM = GreedyHumanModel_pk(hm_agent.mlp, player_index=1 - hm_agent.agent_index)
 
-        # For each state in the episode trajectory:
-        for j in range(actions_from_data[i].__len__()):
-
-            # Only let the HM take an action when the data also acts. Otherwise force HM action to (0,0) also
-            if actions_from_data[i][j] != (0,0):
-
-                current_state = expert_trajs['ep_observations'][i][j]
-                # The state seems to be missing an order list. Manually add the start_order_list:
-                current_state.order_list = hm_agent.mdp.start_order_list
-                #TODO: Fix this properly
+        # For each state in the episode trajectory in which the data acts (the HM isn't asked for the others):
+        for row in rows:
 
-                # # Print the state to view the game:
-                # overcooked_env = OvercookedEnv(hm_agent.mdp)
-                # logging.warning('i = {}, j = {}'.format(i, j))
-                # overcooked_env.state = current_state
-                # logging.warning(overcooked_env)
+            # (The order list of the state was already set when the index was made)
+            current_state = data_index.state(row)
+            action_from_data = data_index.data_action(row)
 
-                # Force the agent to take an action
-                temp_prob_pausing = hm_agent.prob_pausing
-                hm_agent.prob_pausing = 0
+            # Force the agent to take an action
+            temp_prob_pausing = hm_agent.prob_pausing
+            hm_agent.prob_pausing = 0
 
-                # Choose HM action from state
-                hm_action = hm_agent.action(current_state)
-                # This also automatically updates hm_agent.timesteps_stuck, hm_agent.dont_drop,
-                # hm_agent.prev_motion_goal, hm_agent.prev_state
+            # Choose HM action from state
+            hm_action = hm_agent.action(current_state)
+            # This also automatically updates hm_agent.timesteps_stuck, hm_agent.dont_drop,
+            # hm_agent.prev_motion_goal, hm_agent.prev_state
 
-                # Then reset the prob_pausing:
-                hm_agent.prob_pausing = temp_prob_pausing
+            # Then reset the prob_pausing:
+            hm_agent.prob_pausing = temp_prob_pausing
 
-                # Set the prev action from the data, but only if there's already a motion goal
-                if hm_agent.prev_motion_goal != None:
-                    hm_agent.prev_best_action = actions_from_data[i][j]
+            # Set the prev action from the data, but only if there's already a motion goal
+            if hm_agent.prev_motion_goal != None:
+                hm_agent.prev_best_action = action_from_data
 
-                # Print everything after:
-                logging.warning('Action from HM: {}; Action from data: {}'.format(hm_action, actions_from_data[i][j]))
-                logging.warning('HM prev_motion_goal: {}; HM dont_drop: {}'.format(hm_agent.prev_motion_goal,
-                                                                                   hm_agent.dont_drop))
-                logging.warning('HM time stuck: {}'.format(hm_agent.timesteps_stuck))
+            # Print everything after:
+            logging.warning('Action from HM: {}; Action from data: {}'.format(hm_action, action_from_data))
+            logging.warning('HM prev_motion_goal: {}; HM dont_drop: {}'.format(hm_agent.prev_motion_goal,
+                                                                               hm_agent.dont_drop))
+            logging.warning('HM time stuck: {}'.format(hm_agent.timesteps_stuck))
 
-            else:
-                hm_action = (0,0)
+            hm_actions.append(Action.ACTION_TO_INDEX[hm_action])
 
-            hm_actions_this_ep.append(hm_action)
+    return np.array(hm_actions, dtype=int)
 
-        hm_actions.append(hm_actions_this_ep)
+def find_multi_hm_actions(multi_hm_agent, data_index, num_ep_to_use):
+    """Array of shape (number of agents, number of acting states): the action each agent chooses in each state"""
+    return np.array([choose_hm_actions(data_index, hm_agent, num_ep_to_use) for hm_agent in multi_hm_agent])
 
-    return hm_actions
-
-def find_hm_probs_action_in_state(multi_hm_agent, actions_from_data, num_ep_to_use, expert_trajs):
+def find_hm_probs_action_in_state(multi_hm_agent, data_index, num_ep_to_use):
     """
     Find the prob that hm takes action a in state s. BUT only for the actions the data actually takes (we don't need
     the probs for the other actions, as the loss is zero for these)
-
-    :param multi_hm_agent:
-    :param actions_from_data:
-    :param num_ep_to_use:
-    :param expert_trajs:
-    :return:
+    :return: the prob for each of data_index.acting_rows(num_ep_to_use, by_episode=True)
     """
+    multi_hm_actions = find_multi_hm_actions(multi_hm_agent, data_index, num_ep_to_use)
+    actions_from_data = data_index.action[data_index.acting_rows(num_ep_to_use, by_episode=True)]
 
-    multi_hm_actions = []
-
-    # For each agent
-    for hm_agent in multi_hm_agent:
-
-        # Find all actions by this agent:
-        hm_actions = choose_hm_actions(expert_trajs, hm_agent, num_ep_to_use)
-        multi_hm_actions.append(hm_actions)
-
-    # Now have all actions for all agents
-
-    # List of lists of zeros:
-    hm_probs_action_in_state = [[0] * actions_from_data[i].__len__() for i in range(num_ep_to_use)]
-
-    # For each episode we want to use
-    for i in range(num_ep_to_use):
-        # For each state in the episode trajectory:
-        for j in range(actions_from_data[i].__len__()):
-
-            # For each agent
-            for hm_actions in multi_hm_actions:
-            #TODO: Should really swap this "for" with the "if" below
-
-                # Only work out the probs for states where the data acts:
-                if actions_from_data[i][j] != (0,0):
-
-                    # If agent chooses the same action as the data, then count this
-                    if actions_from_data[i][j] == hm_actions[i][j]:
-
-                        # 1 / number of agents. Therefore if all agents act correctly then prob will be 1
-                        hm_probs_action_in_state[i][j] += 1/multi_hm_agent.__len__()
+    # 1 / number of agents for each agent that chooses the same action as the data. Therefore if all agents act
+    # correctly then prob will be 1 (and the min prob is 0.01, otherwise we get infinities in the cross entropy)
+    return probs_data_action(multi_hm_actions.T, actions_from_data)
 
-                # data gives (0,0):
-                else:
-                    # Set to -1 to signal that we're not using this probability
-                    hm_probs_action_in_state[i][j] = -1
-                    # Both the data and the agent should give (0,0):
-                    assert actions_from_data[i][j] == hm_actions[i][j]
+def find_prob_not_acting(data_index, num_ep_to_use):
+    """Probability that the data doesn't act, and the number of states in which it acts"""
+    return prob_not_acting(data_index.acting[data_index.rows(num_ep_to_use)])
 
-            # Force prob to be 0.01 minimum (otherwise we get infinities in the cross entropy):
-            if hm_probs_action_in_state[i][j] == 0:
-                hm_probs_action_in_state[i][j] = 0.01
-
-    return hm_probs_action_in_state
-
-def find_prob_not_acting(actions_from_data, num_ep_to_use):
-
-    count_number_not_acting = 0
-    count_total_states = 0
-
-    # For each episode we want to use
-    for i in range(num_ep_to_use):
-        # For each state in the episode trajectory:
-        for j in range(actions_from_data[i].__len__()):
-
-            count_total_states += 1
-
-            if actions_from_data[i][j] == (0,0):
-                # Count for how many of the states the data doesn't act:
-                count_number_not_acting += 1
-
-    prob_data_doesnt_act = count_number_not_acting / count_total_states
-    number_states_with_acting = count_total_states - count_number_not_acting
-
-    return prob_data_doesnt_act, number_states_with_acting
-
-def find_cross_entropy_loss(actions_from_data, expert_trajs, multi_hm_agent, num_ep_to_use):
+def find_cross_entropy_loss(data_index, multi_hm_agent, num_ep_to_use):
     """
-    ...?
-    :param expert_trajs:
-    :param multi_hm_agent:
-    :param num_ep_to_use:
-    :return:
+    Cross entropy loss, only over the states for which the data acts. Each state's loss is normalised by log(0.01),
+    so that it's at most 1
     """
-    # Find Prob_HM(action|state) for all actions chosen by the data
-    hm_probs_action_in_state = find_hm_probs_action_in_state(multi_hm_agent, actions_from_data, num_ep_to_use,
-                                                          expert_trajs)
+    multi_hm_actions = find_multi_hm_actions(multi_hm_agent, data_index, num_ep_to_use)
+    actions_from_data = data_index.action[data_index.acting_rows(num_ep_to_use, by_episode=True)]
+    return cross_entropy_loss(multi_hm_actions.T, actions_from_data)
 
-    loss = 0
-
-    # For each episode we want to use
-    for i in range(num_ep_to_use):
-        # For each state in the episode trajectory:
-        for j in range(actions_from_data[i].__len__()):
-
-            # Only add to the loss if it's a state for which the data acts:
-            if actions_from_data[i][j] != (0,0):
-                loss += np.log(hm_probs_action_in_state[i][j])/np.log(0.01)  # Normalise by 0.01, so that loss_ij=1 max
-            else:
-                assert hm_probs_action_in_state[i][j] == -1
-
-    return loss
-
-def two_most_frequent(List):
-    occurence_count = Counter(List)
-    second_action = None
-    if len(occurence_count) > 1:
-        second_action = occurence_count.most_common(2)[1][0]
-    return occurence_count.most_common(1)[0][0], second_action
-
-def find_top_12_accuracy(actions_from_data, expert_trajs, multi_hm_agent, num_ep_to_use, number_states_with_acting):
+def find_top_12_accuracy(data_index, multi_hm_agent, num_ep_to_use):
     """
     Find top-1 (top-2) accuracy, which is the proportion of states in which the HM's most likely (2nd most likely)
     action equals the action from the data
     """
-
-    multi_hm_actions = []
-    # For each agent
-    for hm_agent in multi_hm_agent:
-        # Find all actions by this agent:
-        hm_actions = choose_hm_actions(expert_trajs, hm_agent, num_ep_to_use)
-        multi_hm_actions.append(hm_actions)
-    # Now have all actions for all agents
-
-    count_top_1 = 0
-    count_top_2 = 0
-
-    # For each state:
-    for i in range(num_ep_to_use):
-        for j in range(actions_from_data[i].__len__()):
-
-            # Only consider states where the data takes an action:
-            if actions_from_data[i][j] != (0, 0):
-
-                # Change format of multi_hm_actions:
-                list_actions = []
-                for k in range(len(multi_hm_actions)):
-                    list_actions.append(multi_hm_actions[k][i][j])
-
-                #TODO: Here we're ignoring draws between two actions:
-                top_action, second_action = two_most_frequent(list_actions)
-
-                assert top_action != second_action
-
-                # If the top/2nd action is the same as the data, count it:
-                if top_action == actions_from_data[i][j]:
-                    count_top_1 += 1
-                    count_top_2 += 1
-                elif second_action == actions_from_data[i][j]:
-                    count_top_2 += 1
-
-    top_1_acc = count_top_1 / number_states_with_acting
-    top_2_acc = count_top_2 / number_states_with_acting
-
-    assert top_2_acc >= top_1_acc
-
-    return top_1_acc, top_2_acc
+    multi_hm_actions = find_multi_hm_actions(multi_hm_agent, data_index, num_ep_to_use)
+    actions_from_data = data_index.action[data_index.acting_rows(num_ep_to_use, by_episode=True)]
+    return top_12_accuracy(multi_hm_actions.T, actions_from_data)
 
 def shift_by_epsilon(params, epsilon):
     """
@@ -321,7 +186,7 @@ def shift_by_gradient(params, epsilon, delta_loss, lr):
         # print('param shifted final: {}'.format(PERSON_PARAMS_HM[pparam]))
     # return PERSON_PARAMS_HM
 
-def find_gradient_and_step_multi_hm(params, mlp, expert_trajs, num_ep_to_use, lr, epsilon_sd,
+def find_gradient_and_step_multi_hm(params, mlp, data_index, num_ep_to_use, lr, epsilon_sd,
                                     start_time, step_number, total_number_steps):
     """
     Same as find_gradient_and_step_single_hm except here we have multiple hms taking multiple actions, so we find
@@ -329,13 +194,11 @@ def find_gradient_and_step_multi_hm(params, mlp, expert_trajs, num_ep_to_use, lr
     :return: loss
     """
 
-    actions_from_data = expert_trajs['ep_actions']
-
     hm_number = ''
     # Make multiple hm agents:
     multi_hm_agent = ToMAgent(params, hm_number).get_multi_agent(mlp)
 
-    loss = find_cross_entropy_loss(actions_from_data, expert_trajs, multi_hm_agent, num_ep_to_use)
+    loss = find_cross_entropy_loss(data_index, multi_hm_agent, num_ep_to_use)
 
     # Choose random epsilon (eps) from normal dist, sd=epsilon_sd
     epsilon = np.random.normal(scale=epsilon_sd, size=params['PERSON_PARAMS_HM'].__len__())
@@ -365,7 +228,7 @@ def find_gradient_and_step_multi_hm(params, mlp, expert_trajs, num_ep_to_use, lr
     # Find loss for new params
     hm_number = 'eps'
     multi_hm_agent_eps = ToMAgent(params, hm_number).get_multi_agent(mlp)
-    loss_eps = find_cross_entropy_loss(actions_from_data, expert_trajs, multi_hm_agent_eps, num_ep_to_use)
+    loss_eps = find_cross_entropy_loss(data_index, multi_hm_agent_eps, num_ep_to_use)
     delta_loss = loss - loss_eps
 
     # Set new personality params by shifting in the direction of downhill
@@ -374,7 +237,7 @@ def find_gradient_and_step_multi_hm(params, mlp, expert_trajs, num_ep_to_use, lr
     # What's the loss after this grad step:
     # hm_number = ''
     # multi_hm_agent = ToMAgent(params, hm_number).get_multi_agent(mlp)
-    # loss_final = find_cross_entropy_loss(actions_from_data, expert_trajs, multi_hm_agent, num_ep_to_use)
+    # loss_final = find_cross_entropy_loss(data_index, multi_hm_agent, num_ep_to_use)
     # return loss_final
 
     if (step_number % (total_number_steps / 1000)) == 0:
@@ -440,7 +303,6 @@ if __name__ == "__main__":
     ordered_trajs = True
     human_ai_trajs = False
     data_path = "human_aware_rl/data/human/anonymized/clean_{}_trials.pkl".format('train')
-    expert_trajs = get_trajs_from_data(data_path, train_mdps, ordered_trajs, human_ai_trajs)
     # Load (file I saved using pickle) instead FOR SIMPLE ONLY???: pickle_in = open('expert_trajs.pkl',
     # 'rb'); expert_trajs = pickle.load(pickle_in)
 
@@ -545,9 +407,13 @@ if __name__ == "__main__":
     lr = base_learning_rate / num_ep_to_use  # learning rate: the more episodes we use the more the loss will be,
     # so we need to scale it down by num_ep_to_use
     params["sim_threads"] = number_hms  # Needed when using ToMAgent
-    actions_from_data = expert_trajs['ep_actions']
+    # Only the states in which the human acts are used, so we use an index of the data (see human_data_index.py),
+    # which is made the first time then cached on disk:
+    data_index = get_human_data_index(layout, data_path,
+                                      lambda: get_trajs_from_data(data_path, train_mdps, ordered_trajs, human_ai_trajs),
+                                      params["MDP_PARAMS"]["start_order_list"])
     # First find the probability of the data not acting:
-    prob_data_doesnt_act, number_states_with_acting = find_prob_not_acting(actions_from_data, num_ep_to_use)
+    prob_data_doesnt_act, number_states_with_acting = find_prob_not_acting(data_index, num_ep_to_use)
     print('Prob of data-agent taking ZERO action, (0,0): {}; Number states when data-agent acts: {}'.format(
         prob_data_doesnt_act, number_states_with_acting))
 
@@ -556,7 +422,7 @@ if __name__ == "__main__":
         start_time = time.time()
         # For each gradient decent step, find the gradient and step:
         for step_number in range(np.int(total_number_steps)):
-            find_gradient_and_step_multi_hm(params, mlp, expert_trajs, num_ep_to_use, lr, epsilon_sd,
+            find_gradient_and_step_multi_hm(params, mlp, data_index, num_ep_to_use, lr, epsilon_sd,
                                             start_time, step_number, total_number_steps)
 
     elif check_accuracy_only:
@@ -569,8 +435,7 @@ if __name__ == "__main__":
         hm_number = 'check'
         multi_hm_agent = ToMAgent(params, hm_number).get_multi_agent(mlp)
         start_time = time.time()
-        top_1_acc, top_2_acc = find_top_12_accuracy(actions_from_data, expert_trajs, multi_hm_agent, num_ep_to_use,
-                                                    number_states_with_acting)
+        top_1_acc, top_2_acc = find_top_12_accuracy(data_index, multi_hm_agent, num_ep_to_use)
 
         print('\nTop-1 accuracy: {}; Top-2 accuracy: {}; Finished acc calc in time {} secs'.format(
                                                                 top_1_acc, top_2_acc, round(time.time() - start_time)))
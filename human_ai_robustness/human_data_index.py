@@ -0,0 +1,142 @@
+import os, pickle, copy
+import numpy as np
+from overcooked_ai_py.mdp.actions import Action
+from human_aware_rl.data_dir import DATA_DIR
+
+"""
+Pre-decoded, disk-cached index of the human data, for fitting human models to it (sample_tom_params_metropolis.py,
+zeroth_order_opt_active_states.py). Loading the human data means unpickling the whole dataframe of trials; then each
+likelihood evaluation walked every timestep of every episode, patching the order list of each state and checking
+whether the human acted. Instead, the data for a layout is converted once into an index, saved in INDEX_DIR:
+
+- One row per (episode, player, timestep), ordered by episode, then player, then timestep, with the columns ep_idx,
+  player_idx, timestep, action (index in Action.ALL_ACTIONS) and acting (whether the player acted, i.e. the action
+  isn't (0,0)). Each column is a .npy file, loaded memory-mapped, so worker processes share one copy via the page cache
+- ep_boundaries: the first row of each episode (and the number of rows at the end)
+- state_idx: for each row, the index of its state in states.pkl (-1 if the player didn't act, as those states are
+  never used). states.pkl has the decoded OvercookedStates of the timesteps where either player acts, with the order
+  list already set
+
+The index is rebuilt automatically if the data file or start_order_list change.
+"""
+
+INDEX_DIR = DATA_DIR + "human_data_index/"
+COLUMNS = ["ep_idx", "player_idx", "timestep", "action", "acting", "state_idx"]
+NO_ACTION = (0, 0)
+
+
+class HumanDataIndex(object):
+
+    def __init__(self, index_dir):
+        for column in COLUMNS + ["ep_boundaries"]:
+            setattr(self, column, np.load(index_dir + column + ".npy", mmap_mode='r'))
+        with open(index_dir + "states.pkl", 'rb') as f:
+            self.states = pickle.load(f)
+        with open(index_dir + "meta.pkl", 'rb') as f:
+            self.meta = pickle.load(f)
+        self.num_episodes = len(self.ep_boundaries) - 1
+        self.segment_rows = {}  # (episode, player) -> acting rows, see acting_segments
+
+    def rows(self, num_ep_to_use):
+        """All rows of the first num_ep_to_use episodes"""
+        return np.arange(self.ep_boundaries[min(num_ep_to_use, self.num_episodes)])
+
+    def acting_rows(self, num_ep_to_use, by_episode=False):
+        """The rows (of the first num_ep_to_use episodes) where the player acts, in the order of acting_segments"""
+        segments = list(self.acting_segments(num_ep_to_use, by_episode))
+        return np.concatenate([rows for _, _, rows in segments]) if len(segments) > 0 else np.array([], dtype=int)
+
+    def acting_segments(self, num_ep_to_use, by_episode=False):
+        """(player, episode, acting rows) for each player and episode in the data, in the order the fitting scripts go
+        through the data (a human model is reset at the start of each segment): player by player, or episode by
+        episode if by_episode"""
+        episodes = range(min(num_ep_to_use, self.num_episodes))
+        if by_episode:
+            keys = [(episode, player) for episode in episodes for player in range(2)]
+        else:
+            keys = [(episode, player) for player in range(2) for episode in episodes]
+        for episode, player in keys:
+            if (episode, player) not in self.segment_rows:
+                start, end = self.ep_boundaries[episode], self.ep_boundaries[episode + 1]
+                is_player = self.player_idx[start:end] == player
+                # (None if the player isn't in the data for this episode, e.g. for single-agent trajs)
+                self.segment_rows[(episode, player)] = np.arange(start, end)[is_player & self.acting[start:end]] \
+                    if np.any(is_player) else None
+            if self.segment_rows[(episode, player)] is not None:
+                yield player, episode, self.segment_rows[(episode, player)]
+
+    def state(self, row):
+        return self.states[self.state_idx[row]]
+
+    def data_action(self, row):
+        return Action.ALL_ACTIONS[self.action[row]]
+
+
+def encode_actions(actions):
+    return np.array([Action.ACTION_TO_INDEX[action] for action in actions], dtype=np.int8)
+
+def build_human_data_index(expert_trajs, start_order_list, index_dir, meta):
+    """Write the index of expert_trajs to index_dir. expert_trajs can either be joint trajs (the new layouts: each
+    action is a joint action) or single-agent trajs (with 'ep_agent_idxs')"""
+    columns = {column: [] for column in COLUMNS}
+    ep_boundaries = [0]
+    states = []
+    for i in range(len(expert_trajs['ep_actions'])):
+        ep_actions = expert_trajs['ep_actions'][i]
+        if 'ep_agent_idxs' in expert_trajs:
+            players = [expert_trajs['ep_agent_idxs'][i]]
+            actions_each_player = {players[0]: list(ep_actions)}
+        else:
+            players = [0, 1]
+            actions_each_player = {idx: [joint_action[idx] for joint_action in ep_actions] for idx in players}
+        # One copy of each state in which either player acts:
+        state_idx_each_timestep = {}
+        for j in range(len(ep_actions)):
+            if any(actions_each_player[idx][j] != NO_ACTION for idx in players):
+                state = copy.deepcopy(expert_trajs['ep_observations'][i][j])
+                # The states are missing an order list. Add the start_order_list:
+                state.order_list = list(start_order_list)
+                state_idx_each_timestep[j] = len(states)
+                states.append(state)
+        for idx in players:
+            actions = actions_each_player[idx]
+            acting = [action != NO_ACTION for action in actions]
+            columns["ep_idx"].append(np.full(len(actions), i))
+            columns["player_idx"].append(np.full(len(actions), idx))
+            columns["timestep"].append(np.arange(len(actions)))
+            columns["action"].append(encode_actions(actions))
+            columns["acting"].append(np.array(acting, dtype=bool))
+            columns["state_idx"].append(np.array([state_idx_each_timestep[j] if acting[j] else -1
+                                                  for j in range(len(actions))]))
+        ep_boundaries.append(ep_boundaries[-1] + len(players) * len(ep_actions))
+
+    os.makedirs(index_dir, exist_ok=True)
+    if os.path.exists(index_dir + "meta.pkl"):
+        os.remove(index_dir + "meta.pkl")  # (The index is incomplete until the new meta.pkl is written)
+    dtypes = {"ep_idx": np.int32, "player_idx": np.int8, "timestep": np.int32, "action": np.int8, "acting": bool,
+              "state_idx": np.int32}
+    for column in COLUMNS:
+        np.save(index_dir + column + ".npy", np.concatenate(columns[column]).astype(dtypes[column]))
+    np.save(index_dir + "ep_boundaries.npy", np.array(ep_boundaries, dtype=np.int64))
+    with open(index_dir + "states.pkl", 'wb') as f:
+        pickle.dump(states, f)
+    # meta is written last, so an index without meta.pkl is incomplete (and gets rebuilt):
+    with open(index_dir + "meta.pkl.tmp", 'wb') as f:
+        pickle.dump(meta, f)
+    os.replace(index_dir + "meta.pkl.tmp", index_dir + "meta.pkl")
+
+def get_human_data_index(layout, data_path, load_trajs_fn, start_order_list, index_dir=None):
+    """Load the index of the human data for the layout, first building it if needed (with load_trajs_fn(), which
+    loads the data from data_path, e.g. as joint_expert_trajs)"""
+    if index_dir is None:
+        index_dir = INDEX_DIR + "{}_{}/".format(layout, os.path.splitext(os.path.basename(data_path))[0])
+    meta = {"layout": layout, "data_path": os.path.abspath(data_path), "data_mtime": os.path.getmtime(data_path),
+            "start_order_list": list(start_order_list)}
+    existing_meta = None
+    if os.path.exists(index_dir + "meta.pkl"):
+        with open(index_dir + "meta.pkl", 'rb') as f:
+            existing_meta = pickle.load(f)
+    if existing_meta != meta:
+        print("Building the index of the human data for {} in {}".format(layout, index_dir))
+        build_human_data_index(load_trajs_fn(), start_order_list, index_dir, meta)
+    return HumanDataIndex(index_dir)
@@ -0,0 +1,88 @@
+import os, shutil, pickle, random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Crash-safe checkpoints of the full state of pbt_one_run, so that a run can be resumed (RESUME=True) rather than
+restarted from zero. A checkpoint is a dir with the weights of each ppo agent (one npz each) and a manifest pickle with
+all the non-tf state: the pbt iter, the best_sparse bookkeeping, the RNG states, and each agent's params and logs.
+
+The snapshot of the state is taken on the main thread (this is quick: it's all in memory), then written to disk by a
+background thread so that training isn't blocked on disk I/O. Checkpoints are written to a tmp dir that's renamed
+once complete, then the "latest" file is atomically replaced to point to it, so a crash at any point leaves the
+previous checkpoint intact.
+"""
+
+LATEST_FILE = "latest.txt"
+
+
+class CheckpointWriter(object):
+
+    def __init__(self, checkpoint_dir, num_to_keep=2):
+        self.checkpoint_dir = checkpoint_dir
+        self.num_to_keep = num_to_keep
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = None
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def save(self, pbt_iter, manifest, weights_each_agent):
+        """Write the checkpoint for this pbt iter in the background. manifest and weights_each_agent (agent name ->
+        list of arrays) must be copies that the training loop won't modify"""
+        # Only one write at a time, and raise any error from the previous write here rather than losing it:
+        self.wait()
+        manifest = dict(manifest, pbt_iter=pbt_iter)
+        self.pending = self.executor.submit(self.write, pbt_iter, manifest, weights_each_agent)
+
+    def write(self, pbt_iter, manifest, weights_each_agent):
+        final_dir = self.checkpoint_dir + "iter{}/".format(pbt_iter)
+        tmp_dir = self.checkpoint_dir + "tmp_iter{}/".format(pbt_iter)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for agent_name, weights in weights_each_agent.items():
+            np.savez(tmp_dir + agent_name + ".npz", *weights)
+        with open(tmp_dir + "manifest.pkl", 'wb') as f:
+            pickle.dump(manifest, f)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.rename(tmp_dir, final_dir)
+        with open(self.checkpoint_dir + LATEST_FILE + ".tmp", 'w') as f:
+            f.write("iter{}".format(pbt_iter))
+        os.replace(self.checkpoint_dir + LATEST_FILE + ".tmp", self.checkpoint_dir + LATEST_FILE)
+        self.delete_old_checkpoints(pbt_iter)
+
+    def delete_old_checkpoints(self, latest_iter):
+        iters = sorted(int(d[len("iter"):]) for d in os.listdir(self.checkpoint_dir)
+                       if d.startswith("iter") and int(d[len("iter"):]) < latest_iter)
+        for old_iter in iters[:max(len(iters) - (self.num_to_keep - 1), 0)]:
+            shutil.rmtree(self.checkpoint_dir + "iter{}/".format(old_iter), ignore_errors=True)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
+
+
+def load_latest_checkpoint(checkpoint_dir):
+    """Returns (manifest, agent name -> list of weight arrays) of the latest complete checkpoint, or None if there
+    isn't one"""
+    if not os.path.exists(checkpoint_dir + LATEST_FILE):
+        return None
+    with open(checkpoint_dir + LATEST_FILE, 'r') as f:
+        latest_dir = checkpoint_dir + f.read().strip() + "/"
+    with open(latest_dir + "manifest.pkl", 'rb') as f:
+        manifest = pickle.load(f)
+    weights_each_agent = {}
+    for agent_state in manifest["agents"]:
+        weights = np.load(latest_dir + agent_state["agent_name"] + ".npz")
+        weights_each_agent[agent_state["agent_name"]] = [weights["arr_{}".format(i)] for i in range(len(weights.files))]
+    return manifest, weights_each_agent
+
+def get_rng_states():
+    return {"np_random_state": np.random.get_state(), "random_state": random.getstate()}
+
+def set_rng_states(manifest):
+    np.random.set_state(manifest["np_random_state"])
+    random.setstate(manifest["random_state"])
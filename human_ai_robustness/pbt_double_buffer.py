@@ -0,0 +1,105 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+import baselines.ppo2.ppo2 as ppo2
+
+"""
+Double-buffered rollout collection for the ppo updates in pbt_hms (DOUBLE_BUFFERED_ROLLOUTS). The update itself is
+still update_model, i.e. the human_aware_rl fork of ppo2.learn, so the LR and clipping schedules, the losses and the
+train_info are exactly those of a normal update. The only difference is the runner that learn builds: inside
+double_buffered_runner, learn gets a DoubleBufferedRunner, which collects the next batch in a background thread while
+learn optimises on the current one.
+
+The batches are collected by a "behaviour" copy of the model, whose weights can be slightly stale. The behaviour
+weights are re-synced whenever a batch would otherwise be more than max_policy_staleness optimisation steps stale by
+the time it's used (the ppo ratio uses the behaviour policy's neglogpacs, so the update stays correct for stale
+batches). tf releases the GIL while it runs, so the env/ToM stepping really does run during the optimisation. Anything
+that learn changes in the env between batches (e.g. the reward shaping) reaches the collection one batch late.
+"""
+
+
+class DoubleBufferedRunner(object):
+    """
+    Stands in for the ppo2 Runner that learn builds. Each run() returns the batch collected in the background (by
+    runner, a ppo2 Runner with the behaviour model) and starts collecting the next one, unless it was the last of the
+    num_batches batches that learn will ask for. Also records the collect and train time of each batch, and how many
+    updates stale each batch was
+    """
+
+    def __init__(self, runner, num_batches, sync_behaviour_model, max_policy_staleness, executor):
+        self.runner = runner
+        self.num_batches = num_batches
+        self.sync_behaviour_model = sync_behaviour_model
+        self.max_policy_staleness = max_policy_staleness
+        self.executor = executor
+        self.stats = defaultdict(list)
+        self.num_batches_returned = 0
+        self.updates_since_sync = 0
+        self.last_return_time = None
+        self.next_batch = None
+
+    def __getattr__(self, name):
+        # Anything else learn needs from its runner comes from the real runner
+        if name == "runner":
+            raise AttributeError(name)
+        return getattr(self.runner, name)
+
+    def collect_batch(self):
+        t_start_collect = time.time()
+        batch = self.runner.run()
+        return batch, time.time() - t_start_collect
+
+    def run(self):
+        if self.next_batch is None:
+            # First batch
+            self.sync_behaviour_model()
+            self.next_batch = self.executor.submit(self.collect_batch)
+        else:
+            # Learn has done one update (on the last batch) since the last call
+            self.updates_since_sync += 1
+            self.stats["train_time"].append(time.time() - self.last_return_time)
+
+        batch, collect_time = self.next_batch.result()
+        self.stats["collect_time"].append(collect_time)
+        self.stats["policy_staleness"].append(self.updates_since_sync)
+        self.num_batches_returned += 1
+        # Start collecting the next batch before learn trains on this one. It will be used after one more update:
+        if self.num_batches_returned < self.num_batches:
+            if self.updates_since_sync + 1 > self.max_policy_staleness:
+                self.sync_behaviour_model()
+                self.updates_since_sync = 0
+            self.next_batch = self.executor.submit(self.collect_batch)
+        self.last_return_time = time.time()
+        return batch
+
+    def finish(self):
+        """Record the train time of the last batch, once learn has finished"""
+        if self.last_return_time is not None:
+            self.stats["train_time"].append(time.time() - self.last_return_time)
+
+
+@contextmanager
+def double_buffered_runner(behaviour_model, sync_behaviour_model, total_timesteps, max_policy_staleness, executor):
+    """
+    While this is active, ppo2.learn (and so update_model) collects its batches with a DoubleBufferedRunner. Yields
+    the list of DoubleBufferedRunners that learn has built (one per learn call), so their stats can be read afterwards
+    """
+    assert max_policy_staleness >= 1, "Batches are always at least one update stale when double buffered"
+    original_runner = ppo2.Runner
+    runners = []
+
+    def make_runner(**runner_kwargs):
+        # As in learn: nbatch = nenvs * nsteps, and nupdates = total_timesteps // nbatch
+        num_batches = int(total_timesteps) // (runner_kwargs["env"].num_envs * runner_kwargs["nsteps"])
+        runner = original_runner(**dict(runner_kwargs, model=behaviour_model))
+        runners.append(DoubleBufferedRunner(runner, num_batches, sync_behaviour_model, max_policy_staleness,
+                                            executor))
+        return runners[-1]
+
+    ppo2.Runner = make_runner
+    try:
+        yield runners
+    finally:
+        ppo2.Runner = original_runner
+        for runner in runners:
+            runner.finish()
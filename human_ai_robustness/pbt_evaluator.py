@@ -0,0 +1,181 @@
+import os, time, pickle, glob, shutil
+import numpy as np
+import multiprocessing
+from argparse import ArgumentParser
+
+from overcooked_ai_py.mdp.overcooked_env import OvercookedEnv
+from overcooked_ai_py.agents.agent import AgentPair
+from overcooked_ai_py.utils import load_dict_from_file
+from human_aware_rl.imitation.behavioural_cloning import get_bc_agent_from_saved
+from human_ai_robustness.pbt_workers import make_pbt_mdp_and_mlp, make_tom_model, load_saved_agent
+
+"""
+Evaluation of the best ppo agent of each pbt iter with HM0, HM1, BC and BC2 (or any subset of these). This can either
+be done inline in pbt_one_run (EVAL_MODE = "inline"), or by an evaluator service (EVAL_MODE = "background"): pbt_one_run
+drops a frozen copy of the best agent into SAVE_DIR/eval_queue/, and a separate process evaluates each new snapshot,
+writes the results to SAVE_DIR/eval_results/ and deletes the snapshot. pbt_one_run then copies the results into agent
+0's logs (in the same log entries as inline evaluation, e.g. best_agent_rew_bc), so plotting is unchanged.
+
+The service can also be run by hand, e.g. to evaluate a run on a different machine:
+python pbt_evaluator.py -d <SAVE_DIR of the seed> --headless
+"""
+
+ALL_EVAL_PARTNERS = ["hm0", "hm1", "bc", "bc2"]
+HM_TOM_SPECS_FILE = "hm_tom_specs.pkl"
+STOP_FILE = "STOP"
+
+
+def make_eval_partners(params, mlp, hm_tom_specs, eval_partners):
+    """Partner name -> (agent, is_hm), for each partner in eval_partners"""
+    partners = {}
+    for name in eval_partners:
+        assert name in ALL_EVAL_PARTNERS, "Unrecognized eval partner {}. Choose from {}".format(name,
+                                                                                               ALL_EVAL_PARTNERS)
+        if name in ["hm0", "hm1"]:
+            hm_idx = int(name[-1])
+            if hm_idx < len(hm_tom_specs):
+                partners[name] = (make_tom_model(mlp, hm_tom_specs[hm_idx], 99), True)
+        else:
+            bc_folder = params["BC_AGENT_FOLDER"] if name == "bc" else params["BC_AGENT_FOLDER2"]
+            partners[name] = (get_bc_agent_from_saved(bc_folder, unblock_if_stuck=True)[0], False)
+    return partners
+
+def evaluate_best_agent(overcooked_env, best_agent, partners, ppo_index, num_eval_games, headless=False):
+    """
+    Play best_agent, as player ppo_index, with each partner (see make_eval_partners) and return partner name -> avg
+    sparse reward. As before, only 1 game is played with HM1. Unless headless, 1 extra game with each partner is
+    displayed, to observe play.
+    """
+    avg_sparse_rews = {}
+    for name, (partner, partner_is_hm) in partners.items():
+        print('\nbest_agent playing with {} (PPO is PLAYER {})'.format(name.upper(), ppo_index))
+        if partner_is_hm:
+            partner.agent_index = 1 - ppo_index  # Don't need to set this, as AgentPair does it for us
+            partner.GHM.agent_index = ppo_index  # But we DO need to set this!
+        agent_pair = AgentPair(best_agent, partner) if ppo_index == 0 else AgentPair(partner, best_agent)
+        num_games = 1 if name == "hm1" else num_eval_games
+        trajs = overcooked_env.get_rollouts(agent_pair, num_games=num_games, final_state=False,
+                                            display=(name == "hm1" and not headless))  # reward shaping not needed
+        avg_sparse_rews[name] = np.mean(trajs["ep_returns"])
+        print('Best agents sparse rew with {} this iter: {}'.format(name.upper(), avg_sparse_rews[name]))
+        if not headless and name != "hm1":
+            # To observe play:
+            overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=True)
+    return avg_sparse_rews
+
+
+class EvaluatorService(object):
+    """Used by pbt_one_run to send snapshots of the best agent to the evaluator process, and to collect its results"""
+
+    def __init__(self, params, hm_tom_specs, headless):
+        self.queue_dir = params["SAVE_DIR"] + "eval_queue/"
+        self.results_dir = params["SAVE_DIR"] + "eval_results/"
+        os.makedirs(self.queue_dir, exist_ok=True)
+        os.makedirs(self.results_dir, exist_ok=True)
+        if os.path.exists(self.queue_dir + STOP_FILE):
+            os.remove(self.queue_dir + STOP_FILE)
+        write_atomically(self.queue_dir + HM_TOM_SPECS_FILE, hm_tom_specs)
+        self.collected_iters = set()
+        # Spawn, so that the evaluator has its own tf session
+        self.process = multiprocessing.get_context("spawn").Process(
+            target=run_evaluator, args=(params["SAVE_DIR"], params["EVAL_PARTNERS"], headless), daemon=True)
+
+    def start(self):
+        """Start the evaluator process (after resume, if resuming, so that it never sees the stale snapshots)"""
+        self.process.start()
+
+    def submit(self, pbt_iter, best_ppo_agent, ppo_index, num_eval_games):
+        snapshot_dir = self.queue_dir + "iter{}/".format(pbt_iter)
+        shutil.rmtree(snapshot_dir, ignore_errors=True)  # E.g. left over from before resuming
+        best_ppo_agent.save_predictor(snapshot_dir + "predictor/")
+        # The job file is written last (and atomically), so the evaluator never sees a half-written snapshot:
+        write_atomically(snapshot_dir + "job.pkl", {"pbt_iter": pbt_iter, "ppo_index": ppo_index,
+                                                    "num_eval_games": num_eval_games})
+
+    def collect(self, wait_for_iters=None):
+        """The results that are ready (sorted by pbt iter) that haven't been collected yet. Optionally wait until the
+        results of all of wait_for_iters are ready"""
+        if wait_for_iters is not None:
+            while not all(os.path.exists(self.results_dir + "iter{}.pkl".format(i)) for i in wait_for_iters):
+                assert self.process.is_alive(), "The evaluator process died"
+                time.sleep(5)
+        results = []
+        for results_file in glob.glob(self.results_dir + "iter*.pkl"):
+            with open(results_file, 'rb') as f:
+                result = pickle.load(f)
+            if result["pbt_iter"] not in self.collected_iters:
+                results.append(result)
+                self.collected_iters.add(result["pbt_iter"])
+        return sorted(results, key=lambda result: result["pbt_iter"])
+
+    def resume(self, collected_iters, checkpoint_iter):
+        """When resuming from the checkpoint after checkpoint_iter: the results of collected_iters are already in the
+        restored logs, so don't collect them again. The snapshots and results of iters after the checkpoint are from
+        before the crash, and those iters will be trained (and submitted) again, so delete them"""
+        self.collected_iters = set(collected_iters)
+        for snapshot_dir in glob.glob(self.queue_dir + "iter*/"):
+            if int(os.path.basename(snapshot_dir.rstrip("/"))[len("iter"):]) > checkpoint_iter:
+                shutil.rmtree(snapshot_dir, ignore_errors=True)
+        for results_file in glob.glob(self.results_dir + "iter*.pkl"):
+            if int(os.path.basename(results_file)[len("iter"):-len(".pkl")]) > checkpoint_iter:
+                os.remove(results_file)
+
+    def close(self):
+        """Let the evaluator finish the snapshots that are queued, then stop it"""
+        open(self.queue_dir + STOP_FILE, 'w').close()
+        self.process.join()
+
+
+def run_evaluator(save_dir, eval_partners, headless, poll_secs=5):
+    """Watch save_dir/eval_queue/ and evaluate each snapshot of the best agent, in order of pbt iter. Each snapshot is
+    deleted once its results are written, and its tf session is closed, so that neither the disk use nor the memory of
+    this (long-lived) process grows with the number of pbt iters"""
+    params = load_dict_from_file(save_dir + "config.txt")
+    queue_dir, results_dir = save_dir + "eval_queue/", save_dir + "eval_results/"
+    os.makedirs(results_dir, exist_ok=True)
+    mdp, mlp = make_pbt_mdp_and_mlp(params)
+    overcooked_env = OvercookedEnv(mdp, **params["ENV_PARAMS"])
+    with open(queue_dir + HM_TOM_SPECS_FILE, 'rb') as f:
+        hm_tom_specs = pickle.load(f)
+    partners = make_eval_partners(params, mlp, hm_tom_specs, eval_partners)
+
+    while True:
+        stopping = os.path.exists(queue_dir + STOP_FILE)  # (Check before listing, so no job can be missed)
+        jobs = []
+        for job_file in glob.glob(queue_dir + "iter*/job.pkl"):
+            with open(job_file, 'rb') as f:
+                job = pickle.load(f)
+            if not os.path.exists(results_dir + "iter{}.pkl".format(job["pbt_iter"])):
+                jobs.append(job)
+            else:
+                # Evaluated, but we stopped before deleting the snapshot
+                shutil.rmtree(os.path.dirname(job_file), ignore_errors=True)
+        for job in sorted(jobs, key=lambda job: job["pbt_iter"]):
+            snapshot_dir = queue_dir + "iter{}/".format(job["pbt_iter"])
+            print("\nEvaluator: evaluating the best agent of pbt iter {}".format(job["pbt_iter"]))
+            best_agent, predictor = load_saved_agent(snapshot_dir + "predictor/", params["sim_threads"])
+            avg_sparse_rews = evaluate_best_agent(overcooked_env, best_agent, partners, job["ppo_index"],
+                                                  job["num_eval_games"], headless)
+            predictor.session.close()
+            write_atomically(results_dir + "iter{}.pkl".format(job["pbt_iter"]),
+                             dict(job, avg_sparse_rews=avg_sparse_rews))
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+        if stopping and len(jobs) == 0:
+            return
+        if len(jobs) == 0:
+            time.sleep(poll_secs)
+
+def write_atomically(filename, obj):
+    with open(filename + ".tmp", 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(filename + ".tmp", filename)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--save_dir", required=True, help="SAVE_DIR of the pbt run (for one seed)")
+    parser.add_argument("-p", "--eval_partners", default=",".join(ALL_EVAL_PARTNERS),
+                        help="Partners separated by commas, from: {}".format(ALL_EVAL_PARTNERS))
+    parser.add_argument("--headless", default=False, action='store_true', help="Never display rollouts")
+    args = parser.parse_args()
+    run_evaluator(os.path.join(args.save_dir, ""), args.eval_partners.split(','), args.headless)
@@ -1,9 +1,11 @@
-import os, time, logging
+import os, time, logging, copy
+import multiprocessing
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # Suppress a tensorflow error
 import numpy as np
 import tensorflow as tf
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tensorflow.saved_model import simple_save
 
 from sacred import Experiment
@@ -29,6 +31,15 @@ from human_aware_rl.baselines_utils import create_model, get_vectorized_gym_env,
 # from human_ai_robustness.human_ai_robustness_utils import LinearAnnealerZeroToOne
 from human_aware_rl.imitation.behavioural_cloning import get_bc_agent_from_saved
 from human_ai_robustness.import_person_params import import_person_params
+from human_ai_robustness.pbt_checkpoint import CheckpointWriter, load_latest_checkpoint, get_rng_states, \
+    set_rng_states
+from human_ai_robustness.pbt_supervisor import SeedSupervisor
+from human_ai_robustness.pbt_profiling import Profiler
+from human_ai_robustness.pbt_double_buffer import double_buffered_runner
+from human_ai_robustness.pbt_logs import ColumnarLogStore, load_agent_logs, PARAMS_HIST_PREFIX
+from human_ai_robustness.pbt_evaluator import make_eval_partners, evaluate_best_agent, EvaluatorService
+from human_ai_robustness.pbt_workers import make_pbt_mdp_and_mlp, make_tom_model, SelectionEvaluator, \
+    PopulationStore, play_selection_games_here, selection_game_seed
 
 # Suppress warnings:
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # This surpresses tf errors, mainly this one was getting in the way: (E
@@ -70,14 +81,16 @@ class ToMAgent(object):
         # self.teamwork = self.params['PERSON_PARAMS_TOM{}'.format(tom_number)]['TEAMWORK_TOM{}'.format(tom_number)]
 
 
+    def get_tom_spec(self):
+        """The ToMModel kwargs for this agent, so that copies of the agent can be made in other processes"""
+        return {"prob_random_action": self.prob_random_action, "compliance": self.compliance,
+                "retain_goals": self.retain_goals, "prob_thinking_not_moving": self.prob_thinking_not_moving,
+                "path_teamwork": self.path_teamwork, "rationality_coefficient": self.rationality_coeff,
+                "prob_pausing": self.prob_pausing, "prob_greedy": self.prob_greedy,
+                "prob_obs_other": self.prob_obs_other, "look_ahead_steps": self.look_ahead_steps}
+
     def get_agent(self, mlp):
-        model = ToMModel(mlp=mlp, prob_random_action=self.prob_random_action, compliance=self.compliance,
-                 retain_goals=self.retain_goals, prob_thinking_not_moving=self.prob_thinking_not_moving,
-                 path_teamwork=self.path_teamwork, rationality_coefficient=self.rationality_coeff,
-                 prob_pausing=self.prob_pausing, prob_greedy=self.prob_greedy,
-                 prob_obs_other=self.prob_obs_other, look_ahead_steps=self.look_ahead_steps)
-        model.set_agent_index(self.player_index)
-        return model
+        return make_tom_model(mlp, self.get_tom_spec(), self.player_index)
 
     def get_multi_agent(self, mlp):
         """Get sim_threads number of agents, for use in training the models"""
@@ -95,10 +108,14 @@ class PPOAgent(object):
     and train them together.
     """
     
-    def __init__(self, agent_name, start_params, combined_pop_size=1, start_logs=None, model=None, gym_env=None):
+    def __init__(self, agent_name, start_params, combined_pop_size=1, start_logs=None, model=None, gym_env=None,
+                 log_store_dir=None):
         # TODO: hacky init code
         self.params = start_params
         self.human_model = False
+        # If given a log_store_dir, the logs that grow during training go in a ColumnarLogStore (see pbt_logs.py)
+        # rather than in self.logs:
+        self.log_store = ColumnarLogStore(log_store_dir) if log_store_dir is not None else None
         self.logs = start_logs if start_logs is not None else {
             "agent_name": agent_name,
             "avg_rew_per_step": [],
@@ -126,6 +143,11 @@ class PPOAgent(object):
             self.model = model if model is not None else create_model(gym_env, agent_name, **start_params)  # pk:
             # create the model
 
+        # Only used with DOUBLE_BUFFERED_ROLLOUTS (see update_double_buffered):
+        self.behaviour_model = None
+        self.rollout_executor = None
+        self.profiler = None
+
     @property
     def num_ppo_runs(self):
         return self.logs["num_ppo_runs"]
@@ -143,27 +165,93 @@ class PPOAgent(object):
 
     def update(self, gym_env):
         with tf.device('/device:GPU:{}'.format(self.params["GPU_ID"])):
-            train_info = update_model(gym_env, self.model, **self.params)
+            if self.params.get("DOUBLE_BUFFERED_ROLLOUTS", False):  # (Older saved params don't have this)
+                train_info = self.update_double_buffered(gym_env)
+            else:
+                train_info = update_model(gym_env, self.model, **self.params)
 
             for k, v in train_info.items():
-                if k not in self.logs.keys():
-                    self.logs[k] = []
-                self.logs[k].extend(v)
+                self.extend_log(k, v)
             self.logs["num_ppo_runs"] += 1
 
+    def update_double_buffered(self, gym_env):
+        """
+        The same ppo update as update_model (in fact it runs update_model), except that experience collection and
+        optimisation overlap: the next batch is collected in a background thread by a "behaviour" copy of the model,
+        while the optimiser processes the current one (see pbt_double_buffer.py)
+        """
+        params = self.params
+        if self.behaviour_model is None:
+            self.behaviour_model = create_model(gym_env, self.agent_name + "_behaviour", **params)
+            if self.profiler is not None:
+                self.profiler.instrument_model(self.behaviour_model)
+            self.rollout_executor = ThreadPoolExecutor(1)
+
+        t_start = time.time()
+        with double_buffered_runner(self.behaviour_model, self.sync_behaviour_model, params["PPO_RUN_TOT_TIMESTEPS"],
+                                    params["MAX_POLICY_STALENESS"], self.rollout_executor) as runners:
+            train_info = update_model(gym_env, self.model, **params)
+        wall_time = time.time() - t_start
+
+        # Add the double buffering stats to the usual train_info
+        train_info = dict(train_info)
+        for runner in runners:
+            for k, v in runner.stats.items():
+                train_info.setdefault(k, []).extend(v)
+        # If collection and optimisation didn't overlap at all, wall time = collect time + train time
+        num_steps = sum(len(runner.stats["collect_time"]) for runner in runners) * \
+                    params["sim_threads"] * params["BATCH_SIZE"]
+        total_collect, total_train = np.sum(train_info["collect_time"]), np.sum(train_info["train_time"])
+        overlap = (total_collect + total_train - wall_time) / max(min(total_collect, total_train), 1e-9)
+        train_info["env_steps_per_sec"] = [num_steps / wall_time]
+        train_info["collect_train_overlap"] = [overlap]
+        print("Double buffered update: {} env steps/sec; collect {}s, train {}s, wall {}s ({}% overlap)".format(
+            np.round(num_steps / wall_time), np.round(total_collect, 1), np.round(total_train, 1),
+            np.round(wall_time, 1), np.round(100 * overlap)))
+        return train_info
+
+    def sync_behaviour_model(self):
+        session = tf.get_default_session()
+        behaviour_variables = tf.trainable_variables(self.agent_name + "_behaviour/")
+        for variable, value in zip(behaviour_variables, self.get_weights()):
+            variable.load(value, session)
+
+    def set_profiler(self, profiler):
+        """Time the tf forward and backward passes of this agent's model (see pbt_profiling.py)"""
+        self.profiler = profiler
+        profiler.instrument_model(self.model)
+
     def update_avg_rew_per_step_logs(self, avg_rew_per_step_stats):
         self.logs["avg_rew_per_step"] = avg_rew_per_step_stats
 
+    def append_log(self, log_name, value):
+        self.extend_log(log_name, [value])
+
+    def extend_log(self, log_name, values):
+        if self.log_store is not None:
+            self.log_store.extend(log_name, values)
+        else:
+            if log_name not in self.logs.keys():
+                self.logs[log_name] = []
+            self.logs[log_name].extend(values)
+
     def save(self, save_folder):
         """Save agent model, logs, and parameters"""
         create_dir_if_not_exists(save_folder)
         save_baselines_model(self.model, save_folder)
-        save_dict_to_file(self.logs, save_folder + "logs") # New code has this instead: save_dict_to_file(dict(self.logs), save_folder + "logs")
+        logs = self.logs
+        if self.log_store is not None:
+            # Only the new values are written to the store. logs.txt records where the store is, and how long each
+            # log was at the time of this save (see load_agent_logs)
+            self.log_store.flush()
+            logs = dict(self.logs, log_store_dir=os.path.relpath(self.log_store.store_dir, save_folder),
+                        log_store_lengths=self.log_store.lengths())
+        save_dict_to_file(logs, save_folder + "logs") # New code has this instead: save_dict_to_file(dict(self.logs), save_folder + "logs")
         save_dict_to_file(self.params, save_folder + "params")
 
     @staticmethod
     def from_dir(load_folder):
-        logs = load_dict_from_file(load_folder + "/logs.txt")
+        logs = load_agent_logs(load_folder)
         agent_name = logs["agent_name"]
         params = load_dict_from_file(load_folder + "/params.txt")
         model = load_baselines_model(load_folder, agent_name, config=params)
@@ -190,6 +278,11 @@ class PPOAgent(object):
             })
 
     def update_pbt_iter_logs(self):
+        if self.log_store is not None:
+            for k, v in self.params.items():
+                if isinstance(v, (int, float, np.number)):
+                    self.log_store.append(PARAMS_HIST_PREFIX + k, v)
+            return
         for k, v in self.params.items():
             self.logs["params_hist"][k].append(v)
         self.logs["params_hist"] = dict(self.logs["params_hist"])
@@ -199,6 +292,26 @@ class PPOAgent(object):
         self.logs["num_ppo_runs"] = best_training_agent.num_ppo_runs
         self.params = self.mutate_params(best_training_agent.params)
 
+    def explore_from_snapshot(self, weights, num_ppo_runs, params):
+        """As explore_from, but from a snapshot of an agent in another process (see PopulationStore)"""
+        self.set_weights(weights)
+        self.logs["num_ppo_runs"] = num_ppo_runs
+        self.params = self.mutate_params(params)
+
+    def get_weights(self, trainable_only=True):
+        """Values of the model's trainable variables (or of all its variables, including e.g. the optimiser's)"""
+        return tf.get_default_session().run(self.get_variables(trainable_only))
+
+    def set_weights(self, weights, trainable_only=True):
+        variables = self.get_variables(trainable_only)
+        assert len(variables) == len(weights)
+        for variable, value in zip(variables, weights):
+            variable.load(value, tf.get_default_session())  # (load doesn't add ops to the graph, unlike assign)
+
+    def get_variables(self, trainable_only=True):
+        scope = self.agent_name + "/"
+        return tf.trainable_variables(scope) if trainable_only else tf.global_variables(scope)
+
     def mutate_params(self, params_to_mutate):
         params_to_mutate = params_to_mutate.copy()
         for k in self.params["HYPERPARAMS_TO_MUTATE"]:
@@ -254,10 +367,21 @@ def my_config():
         SAVE_DIR = PBT_DATA_DIR + EX_DIR + "/" + EX_NAME + "/"
     logging.info("Saving data to ", SAVE_DIR)
     MODEL_SAVE_FREQUENCY = 10
+    CHECKPOINT_FREQUENCY = 1  # Checkpoint the full pbt state every this many pbt iters (see pbt_checkpoint.py)
+    RESUME = False  # Resume each seed from its latest checkpoint, e.g.: python pbt_hms.py with EX_NAME=... RESUME=True
+    # Keep the agents' growing logs in an append-only store on disk (see pbt_logs.py). Only plot_pbt_logs reads these:
+    # logs.txt then doesn't have the metric lists, which e.g. find_best_seed and human_aware_rl's plotting need
+    COLUMNAR_LOGS = False
 
     DELAY_MINS = None
-    QUIT_WO_MULTIKILL = False
-    MULTIKILL_WO_QUIT = True
+
+    # Running the seeds
+    CONCURRENT_SEEDS = 1  # Seeds to run at once. If > 1, each seed is run in its own process (see pbt_supervisor)
+    CPUS_PER_SEED = None  # Default: split all available cpus between the concurrent seeds
+    TF_INTRA_OP_THREADS = None  # Default (when CONCURRENT_SEEDS > 1): CPUS_PER_SEED. Otherwise tf's default
+    TF_INTER_OP_THREADS = None  # Default (when CONCURRENT_SEEDS > 1): 2. Otherwise tf's default
+    MAX_SEED_RESTARTS = 2  # A seed that fails is restarted from its latest checkpoint up to this many times
+    SEED_MONITOR_SECS = 60  # Report the progress and memory of each seed this often
 
     # PBT params
     sim_threads = 50 if not LOCAL_TESTING else 4
@@ -338,7 +462,22 @@ def my_config():
 
     SEEDS = [0]
     NUM_SELECTION_GAMES = 2 if not LOCAL_TESTING else 1
+    # Log the time taken by each part of each update, selection and eval (see pbt_profiling). This wraps every partner
+    # call, so only turn it on when profiling
+    PROFILE_UPDATES = False
+    SELECTION_WORKERS = 0  # Number of processes that play the selection games. 0 means play them in the main process
+    # (unseeded, as originally). With workers, or with racing, each game has its own seed (see SelectionEvaluator)
+    SELECTION_STRATEGY = "fixed"  # "fixed": NUM_SELECTION_GAMES with each partner. "racing": stop evaluating agents once
+    # it's clear if they're the best/worst (using at most the same budget; see SelectionEvaluator.race)
+    RACING_GAMES_PER_ROUND = 4  # Games each agent plays (with different partners) in each round of racing
+    RACING_Z = 2.0  # Width of the confidence intervals used in racing, in standard errors
+    ASYNC_PBT = False  # Each ppo agent trains in its own process, without waiting for the others (see run_async_pbt)
+    DOUBLE_BUFFERED_ROLLOUTS = False  # Collect the next batch while optimising on the current one (see PPOAgent)
+    MAX_POLICY_STALENESS = 1  # With double buffering: max number of updates the collecting weights can be behind by
     NUM_EVAL_GAMES = 5 if not LOCAL_TESTING else 1 # Number of games used when evaluating the best_agent in each iter
+    EVAL_MODE = "inline"  # "inline" or "background" (evaluate the best agent in a separate process, see pbt_evaluator)
+    EVAL_PARTNERS = ["hm0", "hm1", "bc", "bc2"]  # Who the best agent is evaluated with each iter
+    HEADLESS = False  # Never display rollouts (of the best agent) during the run
 
     # NO_COUNTER_PARAMS:
     START_ORIENTATIONS = False
@@ -388,8 +527,12 @@ def my_config():
         "EX_NAME": EX_NAME,
         "SAVE_DIR": SAVE_DIR,
         "DELAY_MINS": DELAY_MINS,
-        "QUIT_WO_MULTIKILL": QUIT_WO_MULTIKILL,
-        "MULTIKILL_WO_QUIT": MULTIKILL_WO_QUIT,
+        "CONCURRENT_SEEDS": CONCURRENT_SEEDS,
+        "CPUS_PER_SEED": CPUS_PER_SEED,
+        "TF_INTRA_OP_THREADS": TF_INTRA_OP_THREADS,
+        "TF_INTER_OP_THREADS": TF_INTER_OP_THREADS,
+        "MAX_SEED_RESTARTS": MAX_SEED_RESTARTS,
+        "SEED_MONITOR_SECS": SEED_MONITOR_SECS,
         "GPU_ID": GPU_ID,
         "PPO_POP_SIZE": PPO_POP_SIZE,
         "HM_POP_SIZE": HM_POP_SIZE,
@@ -452,9 +595,23 @@ def my_config():
         "PERSON_PARAMS_HM3": PERSON_PARAMS_HM3,
         "REW_SHAPING_PARAMS": REW_SHAPING_PARAMS,
         "MODEL_SAVE_FREQUENCY": MODEL_SAVE_FREQUENCY,
+        "CHECKPOINT_FREQUENCY": CHECKPOINT_FREQUENCY,
+        "RESUME": RESUME,
+        "COLUMNAR_LOGS": COLUMNAR_LOGS,
         "SEEDS": SEEDS,
         "NUM_SELECTION_GAMES": NUM_SELECTION_GAMES,
+        "PROFILE_UPDATES": PROFILE_UPDATES,
+        "SELECTION_WORKERS": SELECTION_WORKERS,
+        "SELECTION_STRATEGY": SELECTION_STRATEGY,
+        "RACING_GAMES_PER_ROUND": RACING_GAMES_PER_ROUND,
+        "RACING_Z": RACING_Z,
+        "ASYNC_PBT": ASYNC_PBT,
+        "DOUBLE_BUFFERED_ROLLOUTS": DOUBLE_BUFFERED_ROLLOUTS,
+        "MAX_POLICY_STALENESS": MAX_POLICY_STALENESS,
         "NUM_EVAL_GAMES": NUM_EVAL_GAMES,
+        "EVAL_MODE": EVAL_MODE,
+        "EVAL_PARTNERS": EVAL_PARTNERS,
+        "HEADLESS": HEADLESS,
         "TOTAL_STEPS_PER_AGENT": TOTAL_STEPS_PER_AGENT,
         # "WEIGHT_HM_MAX": WEIGHT_HM_MAX
         "OTHER_AGENT_TYPE": OTHER_AGENT_TYPE,
@@ -791,17 +948,8 @@ def pbt_one_run(params, seed):
     create_dir_if_not_exists(params["SAVE_DIR"])
     save_dict_to_file(params, params["SAVE_DIR"] + "config")
 
-    mdp = OvercookedGridworld.from_layout_name(**params["MDP_PARAMS"])
+    mdp, mlp = make_pbt_mdp_and_mlp(params)
     overcooked_env = OvercookedEnv(mdp, **params["ENV_PARAMS"])
-    NO_COUNTERS_PARAMS = {
-        'start_orientations': params["START_ORIENTATIONS"],
-        'wait_allowed': params["WAIT_ALLOWED"],
-        'counter_goals': mdp.get_counter_locations(),
-        'counter_drop': mdp.get_counter_locations(),
-        'counter_pickup': params["COUNTER_PICKUP"],
-        'same_motion_goals': params["SAME_MOTION_GOALS"]
-    } # This means that all counter locations are allowed to have objects dropped on them AND be "goals" (I think!)
-    mlp = MediumLevelPlanner.from_pickle_or_compute(mdp, NO_COUNTERS_PARAMS, force_compute=False)
 
     # Print the layouts
     print("Visualise the layouts")
@@ -810,9 +958,14 @@ def pbt_one_run(params, seed):
         # to see different random envs rather than just printing the same one 5 times!
         print(overcooked_env)  # We can print this object because the class has function "__repr__"
 
+    # Times each part of the updates, selection and evaluation (see pbt_profiling.py):
+    profiler = Profiler(enabled=params["PROFILE_UPDATES"])
+
     # Create gym env:
     gym_env = get_vectorized_gym_env(overcooked_env, 'Overcooked-v0',
-                                     featurize_fn=lambda mdp, x: mdp.lossless_state_encoding(x), **params)
+                                     featurize_fn=profiler.timed("featurize",
+                                                                 lambda mdp, x: mdp.lossless_state_encoding(x)),
+                                     **params)
     gym_env.update_reward_shaping_param(1.0)  # Start reward shaping from 1
     #TODO  Careful here because get_vectorized_gym_env has 'if kwargs["RUN_TYPE"] == "joint_ppo": gym_env.custom_init(base_env,
     # joint_actions=True)'. What does 'joint_ppo' refer to? It's fine because the default in pbt.py is RUN_TYPE = "pbt"?
@@ -841,7 +994,9 @@ def pbt_one_run(params, seed):
     hm_pop = []
     ppo_agent_names = ['ppo_agent' + str(i) for i in range(ppo_pop_size)]
     for agent_name in ppo_agent_names:
-        agent = PPOAgent(agent_name, params, combined_pop_size, gym_env=gym_env)
+        log_store_dir = params["SAVE_DIR"] + agent_name + "/log_store/" if params["COLUMNAR_LOGS"] else None
+        agent = PPOAgent(agent_name, params, combined_pop_size, gym_env=gym_env, log_store_dir=log_store_dir)
+        agent.set_profiler(profiler)
         ppo_pop.append(agent)
         # combined_pbt_pop.append(agent)  # Quicker to make ppo_pop then do combined_pbt_pop = ppo_pop.copy()?
     # Make hm (human model) population, and also add hm agents to combined_pbt_pop:
@@ -854,19 +1009,90 @@ def pbt_one_run(params, seed):
         hm_pop.append(agent)
         hm_number += 1
 
-    # Make the bc agent:
-    bc_agent, _ = get_bc_agent_from_saved(params["BC_AGENT_FOLDER"], unblock_if_stuck=True)
-    bc_agent2, _ = get_bc_agent_from_saved(params["BC_AGENT_FOLDER2"], unblock_if_stuck=True)
+    # Make the agents that the best agent is evaluated with each iter (the bc agents, and the first 2 hms):
+    hm_tom_specs = [hm_agent.get_tom_spec() for hm_agent in hm_pop]
+    if params["EVAL_MODE"] == "background":
+        evaluator_service = EvaluatorService(params, hm_tom_specs, headless=params["HEADLESS"])
+    else:
+        evaluator_service = None
+        eval_partners = {name: (profiler.wrap_partner(partner, "tom" if partner_is_hm else "bc"), partner_is_hm)
+                         for name, (partner, partner_is_hm) in
+                         make_eval_partners(params, mlp, hm_tom_specs, params["EVAL_PARTNERS"]).items()}
+    eval_iters_submitted = []
+
+    def record_eval_results(eval_results):
+        for eval_result in eval_results:
+            for partner_name, avg_sparse_rew in eval_result["avg_sparse_rews"].items():
+                # Save in agent 0's log:
+                ppo_pop[0].append_log("best_agent_rew_{}".format(partner_name), avg_sparse_rew)
 
     print("Initialized agent models")  # Note: (For now) I'm using 'print' for things I definitely want to print,
     # then using logging.info for information that might or might not be interesting/useful
 
+    # RESUME FROM CHECKPOINT
+
+    checkpoint_writer = CheckpointWriter(params["SAVE_DIR"] + "checkpoints/")
+    start_iter = 1
+    best_sparse_rew_avg = [-np.Inf]*ppo_pop_size
+    checkpoint = load_latest_checkpoint(checkpoint_writer.checkpoint_dir) if params["RESUME"] else None
+    if checkpoint is not None:
+        manifest, weights_each_agent = checkpoint
+        assert [agent_state["agent_name"] for agent_state in manifest["agents"]] == ppo_agent_names
+        for pbt_agent, agent_state in zip(ppo_pop, manifest["agents"]):
+            pbt_agent.set_weights(weights_each_agent[pbt_agent.agent_name], trainable_only=False)
+            pbt_agent.params = agent_state["params"]
+            pbt_agent.logs = agent_state["logs"]
+            if pbt_agent.log_store is not None:
+                # Drop anything logged after the checkpoint was made
+                pbt_agent.log_store.truncate(agent_state.get("log_store_lengths") or {})
+        best_sparse_rew_avg = manifest["best_sparse_rew_avg"]
+        set_rng_states(manifest)
+        start_iter = manifest["pbt_iter"] + 1
+        if evaluator_service is not None:
+            # (Older checkpoints don't record the eval iters: assume all evals up to the checkpoint are in the logs)
+            evaluator_service.resume(manifest.get("eval_iters_collected", range(start_iter)), manifest["pbt_iter"])
+            eval_iters_submitted.extend(manifest.get("eval_iters_submitted", []))
+        print("Resuming from the checkpoint after pbt iter {}".format(manifest["pbt_iter"]))
+    elif params["RESUME"]:
+        print("No checkpoint found in {}: starting from scratch".format(checkpoint_writer.checkpoint_dir))
+    if checkpoint is None:
+        for pbt_agent in ppo_pop:
+            if pbt_agent.log_store is not None:
+                pbt_agent.log_store.truncate({})  # Clear any logs from a previous run in the same SAVE_DIR
+
+    def save_checkpoint(pbt_iter):
+        # Copy everything now, as the checkpoint is written in the background while training continues. The log
+        # stores are on disk already, so we just record how long each log is:
+        for pbt_agent in ppo_pop:
+            if pbt_agent.log_store is not None:
+                pbt_agent.log_store.flush()
+        manifest = {
+            "agents": [{"agent_name": pbt_agent.agent_name, "params": copy.deepcopy(pbt_agent.params),
+                        "logs": copy.deepcopy(pbt_agent.logs),
+                        "log_store_lengths": pbt_agent.log_store.lengths() if pbt_agent.log_store is not None else None}
+                       for pbt_agent in ppo_pop],
+            "best_sparse_rew_avg": list(best_sparse_rew_avg),
+            # The annealers only depend on each agent's num_ppo_runs (which is in its logs), but record them anyway:
+            "annealer_horizons": {"REW_SHAPING_HORIZON": reward_annealer.horizon,
+                                  "PROB_PLAY_HM_HORIZON": prob_play_HM_annealer.horizon},
+            # The background evaluations that are already in agent 0's logs, and those that are still to come:
+            "eval_iters_collected": sorted(evaluator_service.collected_iters) if evaluator_service is not None else [],
+            "eval_iters_submitted": list(eval_iters_submitted),
+        }
+        manifest.update(get_rng_states())
+        weights_each_agent = {pbt_agent.agent_name: pbt_agent.get_weights(trainable_only=False)
+                              for pbt_agent in ppo_pop}
+        checkpoint_writer.save(pbt_iter, manifest, weights_each_agent)
+
+    if evaluator_service is not None:
+        evaluator_service.start()
+    selection_evaluator = SelectionEvaluator(params, num_workers=params["SELECTION_WORKERS"])
+
     # MAIN LOOP
 
     def pbt_training():
-        best_sparse_rew_avg = [-np.Inf]*ppo_pop_size
 
-        for pbt_iter in range(1, params["NUM_PBT_ITER"]+1):
+        for pbt_iter in range(start_iter, params["NUM_PBT_ITER"]+1):
             print("\n\n\nPBT ITERATION NUM {}".format(pbt_iter))
 
             # TRAINING PHASE
@@ -881,11 +1107,11 @@ def pbt_one_run(params, seed):
                     # (Put this here so that the logs can be plotted alongside the logs from the ppo
                     agent_env_steps = pbt_agent0.num_ppo_runs * params["PPO_RUN_TOT_TIMESTEPS"]
                     prob_play_HM = prob_play_HM_annealer.param_value(agent_env_steps)
-                    pbt_agent0.logs["prob_play_HM"].append(prob_play_HM)
+                    pbt_agent0.append_log("prob_play_HM", prob_play_HM)
                     print("Probability of this ppo agent playing with a HM during training:", prob_play_HM)
                     reward_shaping_param = reward_annealer.param_value(agent_env_steps)
                     print("Current reward shaping:", reward_shaping_param)
-                    pbt_agent0.logs["reward_shaping"].append(reward_shaping_param)
+                    pbt_agent0.append_log("reward_shaping", reward_shaping_param)
                     gym_env.update_reward_shaping_param(reward_shaping_param)
 
                     # With probability = 1-prob_play_HM, train with a (random) PPO. Otherwise train with a HM:
@@ -916,7 +1142,9 @@ def pbt_one_run(params, seed):
                     else:
                         gym_env.other_agent_tom = False
 
-                    gym_env.other_agent = pbt_agent1.get_multi_agent(mlp)  # get_multi_agent=get_agent for PPOAgent
+                    # (get_multi_agent=get_agent for PPOAgent)
+                    partner_type = "tom" if pbt_agent1.human_model else "ppo"
+                    gym_env.other_agent = profiler.wrap_partner(pbt_agent1.get_multi_agent(mlp), partner_type)
 
                     # Set up display during training
                     if params["DISPLAY_TRAINING"] and gym_env.other_agent_tom:
@@ -924,7 +1152,9 @@ def pbt_one_run(params, seed):
                         gym_env.other_agent[random_idx].display = True
 
                     # Update agent0's model:
+                    t_start_update = time.time()
                     pbt_agent0.update(gym_env)
+                    profiler.log_update(pbt_agent0, time.time() - t_start_update, params["PPO_RUN_TOT_TIMESTEPS"])
 
                     save_folder = params["SAVE_DIR"] + pbt_agent0.agent_name + '/'
                     pbt_agent0.save(save_folder)
@@ -935,69 +1165,33 @@ def pbt_one_run(params, seed):
             # Overwrite worst ppo agent with best ppo agent (mutated), according to a proxy for generalization
             # performance (avg reward across (subsets of the) population)
 
-            # Dictionary with average returns for each ppo agent when matched with other agents
-            avg_ep_returns_dict = defaultdict(list)
-            avg_ep_returns_sparse_dict = defaultdict(list)
-
-            for i, pbt_agent in enumerate(ppo_pop):
+            for pbt_agent in ppo_pop:
                 # Saving each ppo agent model at the end of the pbt iteration
                 pbt_agent.update_pbt_iter_logs()
 
-                # When the prob of training with HMs is < 0.5, then do selection only with PPOs. Otherwise, do selection
-                # only with HMs. I.e. we only use EITHER the ppo pop OR the hm pop during selection. This speeds up
-                # the runs. And later (earlier) we only really care about performance with HMs (PPOs) anyway.
-
-                if prob_play_HM < 0.5:  # prob_play_HM will be set by only the last ppo agent's latest update. As all
-                    # ppo agents have the same number of updates, then prob_play_HM should be the same for all
-                    # agents. Note that prob_play_HM will be larger than when the PPO was randomly choosing to play
-                    # with HMs. So we use HMs for selection v slightly earlier than when using them for updating models.
-
-                    # Play only with PPO agents:
-                    for j in range(ppo_pop_size):
-
-                        print("Evaluating agent {} with PPO agent {}".format(i, j))
-                        pbt_agent_other = ppo_pop[j].get_agent(mlp)
-                        agent_pair = AgentPair(pbt_agent.get_agent(mlp), pbt_agent_other)
-                        trajs = overcooked_env.get_rollouts(agent_pair, params["NUM_SELECTION_GAMES"],
-                                                            reward_shaping=reward_shaping_param,
-                                                            metadata_fn=find_dense_reward_fn(reward_shaping_param))
-                        dense_rews, sparse_rews, lens = trajs["metadatas"]["ep_returns_shaped"], trajs["ep_returns"], \
-                                                        trajs["ep_lengths"]
-                        rew_per_step = np.sum(dense_rews) / np.sum(lens)
-                        avg_ep_returns_dict[i].append(rew_per_step)
-                        avg_ep_returns_sparse_dict[i].append(sparse_rews)
-
-                elif prob_play_HM >= 0.5:
-
-                    # Play only with HM agents:
-                    for j in range(hm_pop_size):
-
-                        print("Evaluating agent {} with HM agent {}".format(i, j))
-                        pbt_agent_other = hm_pop[j].get_agent(mlp)
-                        pbt_agent_other.agent_index = 1  # We don't actually need to set this, because AgentPair does it
-                        pbt_agent_other.GHM.agent_index = 0  # But we do need to set this!
-                        agent_pair = AgentPair(pbt_agent.get_agent(mlp), pbt_agent_other)
-                        trajs = overcooked_env.get_rollouts(agent_pair, params["NUM_SELECTION_GAMES"],
-                                                            reward_shaping=reward_shaping_param,
-                                                            metadata_fn=find_dense_reward_fn(reward_shaping_param))
-                        dense_rews, sparse_rews, lens = trajs["metadatas"]["ep_returns_shaped"], trajs["ep_returns"], \
-                                                        trajs["ep_lengths"]
-                        rew_per_step = np.sum(dense_rews) / np.sum(lens)
-                        avg_ep_returns_dict[i].append(rew_per_step)
-                        avg_ep_returns_sparse_dict[i].append(sparse_rews)
-
-                #TODO: Keep track of performance with each agent? Note: we'd only have info about the ppo agents for
-                # the first half and only the hm agents for the second half (set rew=0 otherwise?)
-
-                # log_name = "dense_rew_with_agent{}".format(j)
-                # pbt_agent.logs[log_name].append(np.mean(dense_rews))
-                # log_name = "sparse_rew_with_agent{}".format(j)
-                # pbt_agent.logs[log_name].append(np.mean(sparse_rews))
-
-                # if pbt_iter == params["NUM_PBT_ITER"]: # pbt_iter % params["MODEL_SAVE_FREQUENCY"] == 0 or
-                #     save_folder = params["SAVE_DIR"] + pbt_agent.agent_name + '/'
-                #     pbt_agent.save_predictor(save_folder + "pbt_iter{}/".format(pbt_iter))
-                #     pbt_agent.save(save_folder + "pbt_iter{}/".format(pbt_iter))
+            # When the prob of training with HMs is < 0.5, then do selection only with PPOs. Otherwise, do selection
+            # only with HMs. I.e. we only use EITHER the ppo pop OR the hm pop during selection. This speeds up
+            # the runs. And later (earlier) we only really care about performance with HMs (PPOs) anyway.
+            # prob_play_HM will be set by only the last ppo agent's latest update. As all ppo agents have the same
+            # number of updates, then prob_play_HM should be the same for all agents. Note that prob_play_HM will be
+            # larger than when the PPO was randomly choosing to play with HMs. So we use HMs for selection v slightly
+            # earlier than when using them for updating models.
+            selection_partners = ppo_pop if prob_play_HM < 0.5 else hm_pop
+            print("Evaluating each agent with each {} agent".format("PPO" if prob_play_HM < 0.5 else "HM"))
+
+            # Dictionaries with average returns for each ppo agent when matched with each partner
+            t_start_selection = time.time()
+            avg_ep_returns_dict, avg_ep_returns_sparse_dict = selection_evaluator.evaluate(
+                ppo_pop, selection_partners, pbt_iter, reward_shaping_param, mdp, mlp)
+            profiler.log_phase(ppo_pop[0], "selection", time.time() - t_start_selection)
+            num_games_saved = selection_evaluator.num_games_budget - selection_evaluator.num_games_played
+            print("Played {} selection games ({} fewer than the fixed budget of {})".format(
+                selection_evaluator.num_games_played, num_games_saved, selection_evaluator.num_games_budget))
+            ppo_pop[0].append_log("selection_games_played", selection_evaluator.num_games_played)
+            ppo_pop[0].append_log("selection_games_saved", num_games_saved)
+
+            #TODO: Keep track of performance with each agent? Note: we'd only have info about the ppo agents for
+            # the first half and only the hm agents for the second half (set rew=0 otherwise?)
 
             print("AVG ep rewards dict:", avg_ep_returns_dict)
 
@@ -1006,7 +1200,8 @@ def pbt_one_run(params, seed):
             for i, pbt_agent in enumerate(ppo_pop):
             #     #TODO: Does this work correctly? Is it needed?:
                 pbt_agent.update_avg_rew_per_step_logs(avg_ep_returns_dict[i])
-                avg_sparse_rew = np.mean(avg_ep_returns_sparse_dict[i])
+                # (With racing, agents can have played different numbers of games with each partner)
+                avg_sparse_rew = np.mean(np.concatenate(avg_ep_returns_sparse_dict[i]))
 
                 if avg_sparse_rew > best_sparse_rew_avg[i]:
                     best_sparse_rew_avg[i] = avg_sparse_rew
@@ -1030,14 +1225,16 @@ def pbt_one_run(params, seed):
                     .format(worst_agent_idx, avg_ep_returns_dict[worst_agent_idx],
                             best_agent_idx, avg_ep_returns_dict[best_agent_idx]))
 
-            print('\nbest_agent playing with itself...!')
             best_agent = ppo_pop[best_agent_idx].get_agent(mlp)
-            best_agent_copy = ppo_pop[best_agent_idx].get_agent(mlp)
-            agent_pair = AgentPair(best_agent, best_agent_copy)
-            overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=True, display=True,
-                                        reward_shaping=reward_shaping_param)
+            if not params["HEADLESS"]:
+                print('\nbest_agent playing with itself...!')
+                best_agent_copy = ppo_pop[best_agent_idx].get_agent(mlp)
+                agent_pair = AgentPair(best_agent, best_agent_copy)
+                overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=True, display=True,
+                                            reward_shaping=reward_shaping_param)
 
             # EVALUATE BEST AGENT
+            t_start_eval = time.time()
             print('\n#----------------------------#')
             if ((pbt_iter + 1) >= params["NUM_PBT_ITER"]) and not params["LOCAL_TESTING"]:
                 print('FINAL TWO ITERs! So we do 100 eval games')
@@ -1045,151 +1242,182 @@ def pbt_one_run(params, seed):
             else:
                 num_eval_games = params["NUM_EVAL_GAMES"]
 
-            # TODO: Make "play with agent X" into a helper function (this bit is absurbly long, now that the index
-            #  depends on the iteration being odd/even!)
-            # On even iterations, PPO is player 0:
-            if (pbt_iter % 2) == 0:
-
-                # Reward with HM0, for comparison with BC (which plays below):
-                print('best_agent playing with HM0...')
-                print('PPO is PLAYER 0')
-                hm0_agent = hm_pop[0].get_agent(mlp)
-                hm0_agent.agent_index = 1  # Don't need to set this, as AgentPair does it for us
-                hm0_agent.GHM.agent_index = 0  # But we DO need to set this!
-                agent_pair = AgentPair(best_agent, hm0_agent)
-                trajs = overcooked_env.get_rollouts(agent_pair, num_games=num_eval_games,
-                                                    final_state=False, display=False)  # reward shaping not needed
-                sparse_rews = trajs["ep_returns"]
-                avg_sparse_rew = np.mean(sparse_rews)
-                ppo_pop[0].logs["best_agent_rew_hm0"].append(avg_sparse_rew)
-                # To observe play:
-                overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=True)
-
-                # And reward with HM1:
-                #TODO: Could make it play with every HM, but only for 1 game (and display some of them)?
-                if params["HM_POP_SIZE"] > 1:
-                    print('\n\nbest_agent playing with HM1 (only 1 evaluation game with HM1)')
-                    print('PPO is PLAYER 0')
-                    hm1_agent = hm_pop[1].get_agent(mlp)
-                    hm1_agent.agent_index = 1  # Don't need to set this, as AgentPair does it for us
-                    hm1_agent.GHM.agent_index = 0  # But we DO need to set this!
-                    agent_pair = AgentPair(best_agent, hm1_agent)
-                    trajs = overcooked_env.get_rollouts(agent_pair, num_games=1,
-                                                        final_state=False, display=True)  # reward shaping not needed
-                    sparse_rews = trajs["ep_returns"]
-                    avg_sparse_rew = np.mean(sparse_rews)
-                    # Save in agent 0's log:
-                    ppo_pop[0].logs["best_agent_rew_hm1"].append(avg_sparse_rew)
-                    # To observe play:
-                    # overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=False)
-
-                # Play best_agent with a bc agent, and record the sparse reward received
-                # (Putting BC last so that it's easier to find and observe the agent playing with BC
-
-                print('\n\nbest_agent playing with BC agent (train, seed 2)...')
-                print('PPO is PLAYER 0')
-                agent_pair = AgentPair(best_agent, bc_agent)
-                trajs = overcooked_env.get_rollouts(agent_pair, num_games=num_eval_games,
-                                                    final_state=False, display=False)  # reward shaping not needed
-                sparse_rews = trajs["ep_returns"]
-                avg_sparse_rew = np.mean(sparse_rews)
-                # Save in agent 0's log:
-                ppo_pop[0].logs["best_agent_rew_bc"].append(avg_sparse_rew)
-                print('Best agents sparse rew with BC this iter: {}'.format(avg_sparse_rew))
-                # To observe play:
-                overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=True)
-
-                # Play with a different BC agent:
-                print('\n\nbest_agent playing with BC agent 2 (test, seed 0)...')
-                print('PPO is PLAYER 0')
-                agent_pair = AgentPair(best_agent, bc_agent2)
-                trajs = overcooked_env.get_rollouts(agent_pair, num_games=num_eval_games,
-                                                    final_state=False, display=False)  # reward shaping not needed
-                sparse_rews = trajs["ep_returns"]
-                avg_sparse_rew = np.mean(sparse_rews)
-                # Save in agent 0's log:
-                ppo_pop[0].logs["best_agent_rew_bc2"].append(avg_sparse_rew)
-                print('Best agents sparse rew with BC2 this iter: {}'.format(avg_sparse_rew))
-                # To observe play:
-                overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=True)
-
-            # On odd iterations, PPO is player 1:
-            elif (pbt_iter % 2) == 1:
-
-                # Reward with HM0, for comparison with BC (which plays below):
-                print('best_agent playing with HM0...')
-                print('PPO is PLAYER 1')
-                hm0_agent = hm_pop[0].get_agent(mlp)
-                hm0_agent.agent_index = 0  # Don't need to set this, as AgentPair does it for us
-                hm0_agent.GHM.agent_index = 1  # But we DO need to set this!
-                agent_pair = AgentPair(hm0_agent, best_agent)
-                trajs = overcooked_env.get_rollouts(agent_pair, num_games=num_eval_games,
-                                                    final_state=False, display=False)  # reward shaping not needed
-                sparse_rews = trajs["ep_returns"]
-                avg_sparse_rew = np.mean(sparse_rews)
-                ppo_pop[0].logs["best_agent_rew_hm0"].append(avg_sparse_rew)
-                # To observe play:
-                overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=True)
-
-                # And reward with HM1:
-                # TODO: Could make it play with every HM, but only for 1 game (and display some of them)?
-                if params["HM_POP_SIZE"] > 1:
-                    print('\n\nbest_agent playing with HM1 (only 1 evaluation game with HM1)')
-                    print('PPO is PLAYER 1')
-                    hm1_agent = hm_pop[1].get_agent(mlp)
-                    hm1_agent.agent_index = 0  # Don't need to set this, as AgentPair does it for us
-                    hm1_agent.GHM.agent_index = 1  # But we DO need to set this!
-                    agent_pair = AgentPair(hm1_agent, best_agent)
-                    trajs = overcooked_env.get_rollouts(agent_pair, num_games=1,
-                                                        final_state=False,
-                                                        display=True)  # reward shaping not needed
-                    sparse_rews = trajs["ep_returns"]
-                    avg_sparse_rew = np.mean(sparse_rews)
-                    # Save in agent 0's log:
-                    ppo_pop[0].logs["best_agent_rew_hm1"].append(avg_sparse_rew)
-                    # To observe play:
-                    # overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=False)
-
-                # Play best_agent with a bc agent, and record the sparse reward received
-                # (Putting BC last so that it's easier to find and observe the agent playing with BC
-
-                print('\n\nbest_agent playing with BC agent (train, seed 2)...')
-                print('PPO is PLAYER 1')
-                agent_pair = AgentPair(bc_agent, best_agent)
-                trajs = overcooked_env.get_rollouts(agent_pair, num_games=num_eval_games,
-                                                    final_state=False, display=False)  # reward shaping not needed
-                sparse_rews = trajs["ep_returns"]
-                avg_sparse_rew = np.mean(sparse_rews)
-                # Save in agent 0's log:
-                ppo_pop[0].logs["best_agent_rew_bc"].append(avg_sparse_rew)
-                print('Best agents sparse rew with BC this iter: {}'.format(avg_sparse_rew))
-                # To observe play:
-                overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=True)
-
-                # Play with a different BC agent:
-                print('\n\nbest_agent playing with BC agent 2 (test, seed 0)...')
-                print('PPO is PLAYER 1')
-                agent_pair = AgentPair(bc_agent2, best_agent)
-                trajs = overcooked_env.get_rollouts(agent_pair, num_games=num_eval_games,
-                                                    final_state=False, display=False)  # reward shaping not needed
-                sparse_rews = trajs["ep_returns"]
-                avg_sparse_rew = np.mean(sparse_rews)
-                # Save in agent 0's log:
-                ppo_pop[0].logs["best_agent_rew_bc2"].append(avg_sparse_rew)
-                print('Best agents sparse rew with BC2 this iter: {}'.format(avg_sparse_rew))
-                # To observe play:
-                overcooked_env.get_rollouts(agent_pair, num_games=1, final_state=False, display=True)
+            # On even iterations, PPO is player 0; on odd iterations, PPO is player 1:
+            ppo_index = pbt_iter % 2
+            if evaluator_service is not None:
+                # Evaluated by the evaluator process, while training continues. Record any results that are ready:
+                evaluator_service.submit(pbt_iter, ppo_pop[best_agent_idx], ppo_index, num_eval_games)
+                eval_iters_submitted.append(pbt_iter)
+                record_eval_results(evaluator_service.collect())
+            else:
+                avg_sparse_rews = evaluate_best_agent(overcooked_env, best_agent, eval_partners, ppo_index,
+                                                      num_eval_games, headless=params["HEADLESS"])
+                record_eval_results([{"pbt_iter": pbt_iter, "avg_sparse_rews": avg_sparse_rews}])
             print('#----------------------------#\n')
+            profiler.log_phase(ppo_pop[0], "eval", time.time() - t_start_eval)
+
+            if pbt_iter % params["CHECKPOINT_FREQUENCY"] == 0 or pbt_iter == params["NUM_PBT_ITER"]:
+                save_checkpoint(pbt_iter)
 
             elapsed_time_this_seed = time.time() - t_start_seed
-            pred_tot_time_this_seed = elapsed_time_this_seed*params["NUM_PBT_ITER"]/pbt_iter
+            # (If resumed, this is the predicted time for the iters since resuming)
+            pred_tot_time_this_seed = elapsed_time_this_seed*(params["NUM_PBT_ITER"] - start_iter + 1)/\
+                                      (pbt_iter - start_iter + 1)
             print('PREDICTED TOTAL TIME FOR THIS SEED: {} sec = {} hrs'.
                   format(np.round(pred_tot_time_this_seed), np.round(pred_tot_time_this_seed/3600, 2)))
 
     pbt_training()
+    profiler.print_summary(time.time() - t_start_seed)
+    if evaluator_service is not None:
+        # Wait for the evaluations still in the queue
+        evaluator_service.close()
+        record_eval_results(evaluator_service.collect(wait_for_iters=eval_iters_submitted))
+    # Save agent 0's logs again, with the evaluation results of the final iter
+    ppo_pop[0].save(params["SAVE_DIR"] + ppo_pop[0].agent_name + '/')
+    checkpoint_writer.close()
+    selection_evaluator.close()
     reset_tf()
     print(params["SAVE_DIR"])
 
+def run_async_pbt(params, seed):
+    """Asynchronous pbt: start one process per ppo agent (see pbt_async_member) and wait for them all to finish"""
+    params["CURR_SEED"] = seed
+    create_dir_if_not_exists(params["SAVE_DIR"])
+    save_dict_to_file(params, params["SAVE_DIR"] + "config")
+    # Use spawn, as the members each make their own tf session
+    ctx = multiprocessing.get_context("spawn")
+    members = [ctx.Process(target=pbt_async_member, args=(params, seed, member_idx))
+               for member_idx in range(params["PPO_POP_SIZE"])]
+    for member in members:
+        member.start()
+    for member_idx, member in enumerate(members):
+        member.join()
+        print("Async pbt member {} finished with exit code {}".format(member_idx, member.exitcode))
+
+def pbt_async_member(params, seed, member_idx):
+    """
+    One ppo agent in asynchronous pbt. Rather than all agents training, then all stopping for selection, this agent
+    trains, evaluates its own fitness, and publishes a snapshot (weights, predictor, params, fitness) to the on-disk
+    PopulationStore. It then does exploit/explore against the latest snapshots of the others: if it's the worst
+    member, it takes the weights of the best member and mutates its params. Nobody waits for anyone else.
+    """
+    set_global_seed(seed + member_idx)
+    mdp, mlp = make_pbt_mdp_and_mlp(params)
+    overcooked_env = OvercookedEnv(mdp, **params["ENV_PARAMS"])
+    gym_env = get_vectorized_gym_env(overcooked_env, 'Overcooked-v0',
+                                     featurize_fn=lambda mdp, x: mdp.lossless_state_encoding(x), **params)
+    gym_env.update_reward_shaping_param(1.0)
+    gym_env.run_type = params["RUN_TYPE"]
+
+    reward_annealer = LinearAnnealer(horizon=params["REW_SHAPING_HORIZON"])
+    prob_play_HM_annealer = LinearAnnealerZeroToOne(horizon=params["PROB_PLAY_HM_HORIZON"])
+
+    member_names = ['ppo_agent' + str(i) for i in range(params["PPO_POP_SIZE"])]
+    log_store_dir = params["SAVE_DIR"] + member_names[member_idx] + "/log_store/" if params["COLUMNAR_LOGS"] else None
+    pbt_agent = PPOAgent(member_names[member_idx], params, params["COMBINED_POP_SIZE"], gym_env=gym_env,
+                         log_store_dir=log_store_dir)
+    if pbt_agent.log_store is not None:
+        pbt_agent.log_store.truncate({})  # Clear any logs from a previous run in the same SAVE_DIR
+    hm_pop = [ToMAgent(params, hm_number, 99, 'hm_agent' + str(hm_number))
+              for hm_number in range(params["HM_POP_SIZE"])]
+    store = PopulationStore(params["SAVE_DIR"] + "population/")
+    best_sparse_rew_avg = -np.Inf
+    t_start = time.time()
+
+    def get_ppo_partner(member_name):
+        """A partner that plays with the latest snapshot of this member (or with this agent itself)"""
+        record = store.read_member(member_name)
+        if member_name == pbt_agent.agent_name or record is None:
+            return pbt_agent.get_agent(mlp)
+        return store.load_agent(record, params["sim_threads"])
+
+    for pbt_iter in range(1, params["NUM_PBT_ITER"]+1):
+
+        # TRAINING
+        for update_num in range(1, params["UPDATES_EACH_ITER"]+1):
+            agent_env_steps = pbt_agent.num_ppo_runs * params["PPO_RUN_TOT_TIMESTEPS"]
+            prob_play_HM = prob_play_HM_annealer.param_value(agent_env_steps)
+            pbt_agent.append_log("prob_play_HM", prob_play_HM)
+            reward_shaping_param = reward_annealer.param_value(agent_env_steps)
+            pbt_agent.append_log("reward_shaping", reward_shaping_param)
+            gym_env.update_reward_shaping_param(reward_shaping_param)
+
+            if np.random.random() > prob_play_HM:
+                partner_name = member_names[np.random.randint(0, len(member_names))]
+                gym_env.other_agent_tom = False
+                gym_env.other_agent = get_ppo_partner(partner_name)
+            else:
+                hm_partner = hm_pop[np.random.randint(0, len(hm_pop))]
+                partner_name = hm_partner.agent_name
+                gym_env.other_agent_tom = True
+                gym_env.other_agent = hm_partner.get_multi_agent(mlp)
+            print("{} (num_ppo_runs: {}) training with {} (pbt #{}/{}, upd #{}/{})".format(
+                pbt_agent.agent_name, pbt_agent.num_ppo_runs, partner_name, pbt_iter, params["NUM_PBT_ITER"],
+                update_num, params["UPDATES_EACH_ITER"]))
+
+            pbt_agent.update(gym_env)
+            pbt_agent.save(params["SAVE_DIR"] + pbt_agent.agent_name + '/')
+
+        pbt_agent.update_pbt_iter_logs()
+
+        # FITNESS: as in the selection phase of pbt_one_run, but only for this agent
+        if prob_play_HM < 0.5:
+            partners = [(get_ppo_partner(name), False) for name in member_names]
+        else:
+            partners = [(hm.get_agent(mlp), True) for hm in hm_pop]
+        rew_per_step_each_partner, sparse_rews = [], []
+        for j, (partner, partner_is_hm) in enumerate(partners):
+            games = [(pbt_agent.get_agent(mlp), partner, partner_is_hm,
+                      selection_game_seed(seed, pbt_iter, member_idx, j, game))
+                     for game in range(params["NUM_SELECTION_GAMES"])]
+            results = np.array(play_selection_games_here(mdp, params["ENV_PARAMS"], games, reward_shaping_param))
+            rew_per_step_each_partner.append(np.sum(results[:, 0]) / np.sum(results[:, 2]))
+            sparse_rews.extend(results[:, 1])
+        pbt_agent.update_avg_rew_per_step_logs(rew_per_step_each_partner)
+        fitness = np.mean(rew_per_step_each_partner)
+
+        if np.mean(sparse_rews) > best_sparse_rew_avg:
+            best_sparse_rew_avg = np.mean(sparse_rews)
+            print("New best avg sparse rews {} for agent {}, saving...".format(best_sparse_rew_avg,
+                                                                               pbt_agent.agent_name))
+            best_save_folder = params["SAVE_DIR"] + pbt_agent.agent_name + '/best_sparse/'
+            delete_dir_if_exists(best_save_folder, verbose=True)
+            pbt_agent.save_predictor(best_save_folder)
+            pbt_agent.save(best_save_folder)
+
+        # PUBLISH, then EXPLOIT/EXPLORE against the latest snapshots of the others
+        store.publish(pbt_agent, fitness, pbt_iter)
+        population = store.read_population(member_names)
+        if len(population) > 1:
+            best_name = max(population, key=lambda name: population[name]["fitness"])
+            worst_name = min(population, key=lambda name: population[name]["fitness"])
+            if worst_name == pbt_agent.agent_name and best_name != worst_name:
+                best_record = population[best_name]
+                pbt_agent.explore_from_snapshot(PopulationStore.load_weights(best_record),
+                                                best_record["num_ppo_runs"], best_record["params"])
+                print("{} ({} rew) overwritten with the snapshot of {} from its pbt iter {} ({} rew)".format(
+                    pbt_agent.agent_name, fitness, best_name, best_record["pbt_iter"], best_record["fitness"]))
+
+        elapsed_time = time.time() - t_start
+        print('{}: PREDICTED TOTAL TIME: {} hrs'.format(
+            pbt_agent.agent_name, np.round(elapsed_time * params["NUM_PBT_ITER"] / pbt_iter / 3600, 2)))
+
+    store.close()
+    reset_tf()
+
+def run_one_seed(params, seed):
+    set_global_seed(seed)
+    if params["TF_INTRA_OP_THREADS"] is not None or params["TF_INTER_OP_THREADS"] is not None:
+        # Make the default session here, with the thread limits, so that this is the session the models use (0 = tf's
+        # default number of threads)
+        tf.InteractiveSession(config=tf.ConfigProto(
+            intra_op_parallelism_threads=params["TF_INTRA_OP_THREADS"] or 0,
+            inter_op_parallelism_threads=params["TF_INTER_OP_THREADS"] or 0))
+    if params["ASYNC_PBT"]:
+        run_async_pbt(params, seed)
+    else:
+        pbt_one_run(params, seed)
+
 @ex.automain
 def run_pbt(params):
 
@@ -1204,31 +1432,17 @@ def run_pbt(params):
     # Pause before starting run
     if params["DELAY_MINS"]:
         delay_before_run(params["DELAY_MINS"])
-    for seed in params["SEEDS"]:
-        set_global_seed(seed)
-        curr_seed_params = params.copy()
-        curr_seed_params["SAVE_DIR"] += "seed_{}/".format(seed)
-        t_before_run = time.time()
-        pbt_one_run(curr_seed_params, seed)
-        t_after_run = time.time() - t_before_run
-        print('SEED COMPLETE in time {}'.format(t_after_run))
-
-    if params["MULTIKILL_WO_QUIT"]:
-        print('Closing the multiproc children (but not quitting properly)...')
-        # Kill children:
-        import psutil
-        import multiprocessing
-        def kill_children_parent():
-            for proc in multiprocessing.active_children():
-                proc.terminate()
-            parent = psutil.Process(os.getpid())
-            for child in parent.children(recursive=True):
-                child.kill()
-            parent.kill()
-        kill_children_parent
-    if params["QUIT_WO_MULTIKILL"]:
-        print('Quitting (kill) but not closing the multiproc children properly...')
-        import signal
-        import os
-        os.kill(os.getpid(), signal.SIGKILL)
-
+    if params["CONCURRENT_SEEDS"] > 1:
+        supervisor = SeedSupervisor(run_one_seed, params, params["SEEDS"], params["CONCURRENT_SEEDS"],
+                                    cpus_per_seed=params["CPUS_PER_SEED"], max_restarts=params["MAX_SEED_RESTARTS"],
+                                    monitor_secs=params["SEED_MONITOR_SECS"])
+        failed_seeds = supervisor.run()
+        assert len(failed_seeds) == 0, "Seeds {} failed".format(failed_seeds)
+    else:
+        for seed in params["SEEDS"]:
+            curr_seed_params = params.copy()
+            curr_seed_params["SAVE_DIR"] += "seed_{}/".format(seed)
+            t_before_run = time.time()
+            run_one_seed(curr_seed_params, seed)
+            t_after_run = time.time() - t_before_run
+            print('SEED COMPLETE in time {}'.format(t_after_run))
@@ -0,0 +1,156 @@
+import os, shutil
+import numpy as np
+from collections import defaultdict
+
+from overcooked_ai_py.utils import load_dict_from_file
+
+"""
+Append-only, columnar store for the logs of a PBT agent, so that the logs don't grow in memory (and get rewritten in
+full by every save) over the course of a run.
+
+Each metric (e.g. "eprewmean", "reward_shaping", "best_agent_rew_bc") is a 1d series of numbers, stored in its own dir
+as CSV segments of at most SEGMENT_ROWS values, one value per line: STORE_DIR/<metric>/seg<first row>.csv. Appends go
+into a small in-memory buffer, and flush() appends the buffered values to the last segment (starting a new segment when
+it's full), so each flush only writes the new values. The params history is stored with one metric per param, as
+"params_hist.<param name>" (only numerical params are recorded; the others don't change during a run, and are in
+params.txt anyway).
+
+The small, non-growing part of PPOAgent.logs (agent name, num_ppo_runs, ...) is still saved in logs.txt, together with
+the length of each metric at the time of the save. load_agent_logs reads both, and returns the logs in the same format
+as the original (all in logs.txt) logs, so that old and new runs can be plotted the same way.
+"""
+
+SEGMENT_ROWS = 10000
+PARAMS_HIST_PREFIX = "params_hist."
+
+
+class ColumnarLogStore(object):
+
+    def __init__(self, store_dir, segment_rows=SEGMENT_ROWS):
+        self.store_dir = store_dir
+        self.segment_rows = segment_rows
+        self.buffers = defaultdict(list)
+        os.makedirs(store_dir, exist_ok=True)
+        # Number of values of each metric that are already on disk (e.g. if we're resuming a run):
+        self.num_rows_on_disk = {metric: count_rows(store_dir + metric + "/") for metric in os.listdir(store_dir)}
+
+    def append(self, metric, value):
+        assert "/" not in metric, "Metric names are used as dir names"
+        self.buffers[metric].append(float(value))
+        if len(self.buffers[metric]) >= self.segment_rows:
+            self.flush_metric(metric)
+
+    def extend(self, metric, values):
+        for value in values:
+            self.append(metric, value)
+
+    def metrics(self):
+        return sorted(set(self.num_rows_on_disk) | set(self.buffers))
+
+    def num_rows(self, metric):
+        return self.num_rows_on_disk.get(metric, 0) + len(self.buffers.get(metric, []))
+
+    def lengths(self):
+        return {metric: self.num_rows(metric) for metric in self.metrics()}
+
+    def flush(self):
+        for metric in list(self.buffers):
+            self.flush_metric(metric)
+
+    def flush_metric(self, metric):
+        values = self.buffers.pop(metric, [])
+        metric_dir = self.store_dir + metric + "/"
+        os.makedirs(metric_dir, exist_ok=True)
+        row = self.num_rows_on_disk.get(metric, 0)
+        while len(values) > 0:
+            # Fill up the last segment, then start a new one:
+            segment_start = row - row % self.segment_rows
+            num_to_write = min(self.segment_rows - row % self.segment_rows, len(values))
+            with open(metric_dir + "seg{:09d}.csv".format(segment_start), 'a') as f:
+                f.write("".join("{!r}\n".format(value) for value in values[:num_to_write]))
+            values = values[num_to_write:]
+            row += num_to_write
+        self.num_rows_on_disk[metric] = row
+
+    def truncate(self, lengths):
+        """Cut each metric back to the given length (and delete metrics not in lengths). Used when resuming from a
+        checkpoint, as the store will have values that were logged after the checkpoint was made"""
+        self.flush()
+        for metric in self.metrics():
+            metric_dir = self.store_dir + metric + "/"
+            length = lengths.get(metric, 0)
+            if length == 0:
+                shutil.rmtree(metric_dir, ignore_errors=True)
+                del self.num_rows_on_disk[metric]
+                continue
+            for segment_start, segment_file in list_segments(metric_dir):
+                if segment_start >= length:
+                    os.remove(segment_file)
+                elif segment_start + count_lines(segment_file) > length:
+                    with open(segment_file, 'r') as f:
+                        lines = f.readlines()[:length - segment_start]
+                    with open(segment_file + ".tmp", 'w') as f:
+                        f.write("".join(lines))
+                    os.replace(segment_file + ".tmp", segment_file)
+            self.num_rows_on_disk[metric] = min(self.num_rows_on_disk[metric], length)
+
+    def read(self, metric):
+        values = read_metric(self.store_dir + metric + "/") if metric in self.num_rows_on_disk else np.array([])
+        return np.concatenate([values, self.buffers.get(metric, [])])
+
+
+def list_segments(metric_dir):
+    """(first row, filename) of each segment of the metric, in order"""
+    segments = [(int(name[len("seg"):-len(".csv")]), metric_dir + name) for name in os.listdir(metric_dir)
+                if name.startswith("seg") and name.endswith(".csv")]
+    return sorted(segments)
+
+def count_lines(filename):
+    with open(filename, 'r') as f:
+        return sum(1 for _ in f)
+
+def count_rows(metric_dir):
+    segments = list_segments(metric_dir)
+    if len(segments) == 0:
+        return 0
+    last_start, last_file = segments[-1]
+    with open(last_file, 'r') as f:
+        contents = f.read()
+    if len(contents) > 0 and not contents.endswith("\n"):
+        # The run crashed part way through writing a line: drop it
+        contents = contents[:contents.rfind("\n") + 1]
+        with open(last_file, 'w') as f:
+            f.write(contents)
+    return last_start + contents.count("\n")
+
+def read_metric(metric_dir):
+    values = [np.loadtxt(segment_file, ndmin=1) for _, segment_file in list_segments(metric_dir)
+              if os.path.getsize(segment_file) > 0]
+    return np.concatenate(values) if len(values) > 0 else np.array([])
+
+def read_store(store_dir):
+    """Metric -> array of all its values"""
+    return {metric: read_metric(store_dir + metric + "/") for metric in sorted(os.listdir(store_dir))}
+
+def has_log_store(agent_dir):
+    logs = load_dict_from_file(os.path.join(agent_dir, "logs.txt"))
+    return "log_store_dir" in logs
+
+def load_agent_logs(agent_dir):
+    """The logs of the agent saved in agent_dir (e.g. SAVE_DIR/ppo_agent0/, or SAVE_DIR/ppo_agent0/best_sparse/), in
+    the same format as logs that were saved entirely in logs.txt"""
+    logs = load_dict_from_file(os.path.join(agent_dir, "logs.txt"))
+    if "log_store_dir" not in logs:
+        return logs  # Saved before the log store existed
+    store_dir = os.path.join(agent_dir, logs.pop("log_store_dir"), "")
+    lengths = logs.pop("log_store_lengths")
+    params_hist = {}
+    for metric, values in read_store(store_dir).items():
+        # Only use the values logged before logs.txt was saved (e.g. for best_sparse/, which is a snapshot)
+        values = values[:lengths.get(metric, 0)].tolist()
+        if metric.startswith(PARAMS_HIST_PREFIX):
+            params_hist[metric[len(PARAMS_HIST_PREFIX):]] = values
+        else:
+            logs[metric] = values
+    logs["params_hist"] = params_hist
+    return logs
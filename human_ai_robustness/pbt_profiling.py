@@ -0,0 +1,168 @@
+import time, threading
+import numpy as np
+from collections import defaultdict
+
+"""
+Lightweight instrumentation of pbt_one_run, to show where the time goes in each ppo update: env steps/sec, the decision
+latency of the training partner (by partner type: ppo, tom or bc), the featurization time, and the time in the ppo
+model's tf forward (step) and backward (train) passes. The selection and evaluation phases are timed too. The stats
+of each update are written to the ppo agent's logs (as "profile_..." logs) and a summary is printed at the end.
+
+Timing works by wrapping: functions are wrapped with Profiler.timed, and partners with Profiler.wrap_partner, which
+times every method call of the partner. Note that a "decision" is one call, which can decide for several states (e.g.
+a ppo partner acting for all sim threads at once). Time spent inside a partner call isn't also counted as tf
+forward/featurization time.
+"""
+
+PARTNER_PREFIX = "partner_"
+
+
+class Profiler(object):
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.durations = defaultdict(list)  # Since the last collect
+        self.phase_totals = defaultdict(float)
+        self.run_totals = defaultdict(float)  # (phase, name) -> secs
+        self.run_counts = defaultdict(int)
+        self.run_p99s = defaultdict(list)
+        self.local = threading.local()  # (The double buffered rollouts run in another thread)
+
+    def timed(self, name, fn):
+        if not self.enabled:
+            return fn
+        def timed_fn(*args, **kwargs):
+            if getattr(self.local, "in_partner", False):
+                return fn(*args, **kwargs)
+            t_start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.durations[name].append(time.time() - t_start)
+        return timed_fn
+
+    def time_partner_call(self, name, fn, *args, **kwargs):
+        if getattr(self.local, "in_partner", False):
+            return fn(*args, **kwargs)
+        self.local.in_partner = True
+        t_start = time.time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.durations[name].append(time.time() - t_start)
+            self.local.in_partner = False
+
+    def instrument_model(self, model):
+        """Time the forward (step) and backward (train) passes of a baselines ppo model"""
+        if self.enabled:
+            model.step = self.timed("tf_forward", model.step)
+            model.train = self.timed("tf_backward", model.train)
+
+    def wrap_partner(self, partner, partner_type):
+        """partner_type is "ppo", "tom" or "bc" """
+        if not self.enabled:
+            return partner
+        if isinstance(partner, list):
+            # A list of partners (e.g. the ToM copies for each sim thread) stays a list, as the runner checks for lists
+            return [TimedPartner(p, self, PARTNER_PREFIX + partner_type) for p in partner]
+        return TimedPartner(partner, self, PARTNER_PREFIX + partner_type)
+
+    def collect(self, phase="update"):
+        """name -> durations since the last collect (which are also added to the run totals of the phase)"""
+        durations, self.durations = self.durations, defaultdict(list)
+        for name, name_durations in durations.items():
+            self.run_totals[(phase, name)] += np.sum(name_durations)
+            self.run_counts[(phase, name)] += len(name_durations)
+            if name.startswith(PARTNER_PREFIX):
+                self.run_p99s[(phase, name)].append(np.percentile(name_durations, 99))
+        return durations
+
+    def log_update(self, pbt_agent, wall_time, env_steps):
+        """Log the stats of the update that's just finished, to pbt_agent's logs"""
+        if not self.enabled:
+            return
+        self.phase_totals["update"] += wall_time
+        stats = {"profile_update_time": wall_time, "profile_env_steps_per_sec": env_steps / wall_time}
+        stats.update(durations_to_stats(self.collect()))
+        for log_name, value in stats.items():
+            pbt_agent.append_log(log_name, value)
+        print("Update: {} env steps/sec. {}".format(np.round(stats["profile_env_steps_per_sec"]),
+                                                     format_stats(stats, wall_time)))
+
+    def log_phase(self, pbt_agent, phase, wall_time):
+        """Log the time of a phase of the pbt iter (e.g. "selection"), and the stats of what was timed during it"""
+        if not self.enabled:
+            return
+        self.phase_totals[phase] += wall_time
+        stats = {"profile_{}_time".format(phase): wall_time}
+        stats.update({"profile_{}_{}".format(phase, log_name[len("profile_"):]): value
+                      for log_name, value in durations_to_stats(self.collect(phase)).items()})
+        for log_name, value in stats.items():
+            pbt_agent.append_log(log_name, value)
+        print("{} phase took {} secs".format(phase.capitalize(), np.round(wall_time, 1)))
+
+    def print_summary(self, total_time):
+        if not self.enabled:
+            return
+        self.collect("other")
+        print("\nTIME BREAKDOWN ({} hrs in total):".format(np.round(total_time / 3600, 2)))
+        for phase, phase_time in self.phase_totals.items():
+            print("{}: {} hrs ({}%)".format(phase, np.round(phase_time / 3600, 2),
+                                            np.round(100 * phase_time / total_time, 1)))
+            for (name_phase, name), name_time in sorted(self.run_totals.items()):
+                if name_phase != phase:
+                    continue
+                line = "    {}: {} secs ({}% of {} time)".format(name, np.round(name_time, 1),
+                                                               np.round(100 * name_time / phase_time, 1), phase)
+                if name.startswith(PARTNER_PREFIX):
+                    line += ", mean latency {} ms, median p99 latency {} ms".format(
+                        np.round(1000 * name_time / self.run_counts[(phase, name)], 2),
+                        np.round(1000 * np.median(self.run_p99s[(phase, name)]), 2))
+                print(line)
+
+
+class TimedPartner(object):
+    """Stands in for a partner: the same attributes, but every method call is timed"""
+
+    def __init__(self, partner, profiler, name):
+        object.__setattr__(self, "_partner", partner)
+        object.__setattr__(self, "_profiler", profiler)
+        object.__setattr__(self, "_name", name)
+
+    def __getattr__(self, attr):
+        value = getattr(self._partner, attr)
+        if not callable(value):
+            return value
+        def timed_method(*args, **kwargs):
+            return self._profiler.time_partner_call(self._name, value, *args, **kwargs)
+        return timed_method
+
+    def __setattr__(self, attr, value):
+        setattr(self._partner, attr, value)
+
+
+def durations_to_stats(durations):
+    """Log name -> value: mean and p99 latency (ms) for partners, total secs for everything else"""
+    stats = {}
+    for name, name_durations in sorted(durations.items()):
+        if name.startswith(PARTNER_PREFIX):
+            partner_type = name[len(PARTNER_PREFIX):]
+            stats["profile_partner_latency_mean_{}".format(partner_type)] = 1000 * np.mean(name_durations)
+            stats["profile_partner_latency_p99_{}".format(partner_type)] = 1000 * np.percentile(name_durations, 99)
+            stats["profile_partner_time_{}".format(partner_type)] = np.sum(name_durations)
+        else:
+            stats["profile_{}_time".format(name)] = np.sum(name_durations)
+    return stats
+
+def format_stats(stats, wall_time):
+    parts = []
+    for log_name, value in sorted(stats.items()):
+        if log_name.startswith("profile_partner_latency_mean_"):
+            partner_type = log_name[len("profile_partner_latency_mean_"):]
+            parts.append("{} partner: {} ms mean, {} ms p99, {}% of time".format(
+                partner_type, np.round(value, 2), np.round(stats["profile_partner_latency_p99_" + partner_type], 2),
+                np.round(100 * stats["profile_partner_time_" + partner_type] / wall_time)))
+        elif log_name.endswith("_time") and not log_name.startswith("profile_partner_time_") and \
+                log_name != "profile_update_time":
+            parts.append("{}: {}%".format(log_name[len("profile_"):-len("_time")], np.round(100 * value / wall_time)))
+    return "; ".join(parts)
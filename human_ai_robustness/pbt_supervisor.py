@@ -0,0 +1,172 @@
+import os, time, signal
+import numpy as np
+import multiprocessing
+from multiprocessing.connection import wait
+import psutil
+
+from human_ai_robustness.qt_job_runner import get_slot_cpus
+from human_ai_robustness.pbt_checkpoint import LATEST_FILE
+
+"""
+Supervisor for running the seeds of a pbt experiment concurrently (rather than one after another in run_pbt). Each
+seed is its own (spawned) process, pinned to its own set of cpus, with the number of threads used by tf/OpenMP limited
+to match. The supervisor reports the progress (latest checkpointed pbt iter) and memory of each seed, restarts seeds
+that fail from their latest checkpoint (i.e. with RESUME=True), and makes sure no processes are left behind: each seed
+process starts its own process group, which includes all the workers it starts (selection workers, evaluator, ...),
+and the whole group is killed when the seed finishes, fails, or the supervisor is stopped.
+"""
+
+DEFAULT_TF_INTER_OP_THREADS = 2
+
+
+class SeedSupervisor(object):
+
+    def __init__(self, target, params, seeds, num_concurrent, cpus_per_seed=None, max_restarts=2, monitor_secs=60):
+        """target(params, seed) runs one seed. It must be picklable, i.e. a module-level function"""
+        self.target = target
+        self.params = params
+        self.seeds = seeds
+        self.num_concurrent = min(num_concurrent, len(seeds))
+        self.slot_cpus = get_slot_cpus(self.num_concurrent, cpus_per_seed)
+        self.max_restarts = max_restarts
+        self.monitor_secs = monitor_secs
+        self.running = {}  # seed -> (process, slot)
+        self.num_restarts = {seed: 0 for seed in seeds}
+        self.peak_rss = {seed: 0 for seed in seeds}
+        self.start_times = {}
+
+    def seed_params(self, seed, slot, resume):
+        params = self.params.copy()
+        params["SAVE_DIR"] += "seed_{}/".format(seed)
+        params["RESUME"] = params["RESUME"] or resume
+        intra_op_threads = params["TF_INTRA_OP_THREADS"]
+        inter_op_threads = params["TF_INTER_OP_THREADS"]
+        # Default: one tf thread per cpu of this seed's slot
+        params["TF_INTRA_OP_THREADS"] = intra_op_threads if intra_op_threads is not None else len(self.slot_cpus[slot])
+        params["TF_INTER_OP_THREADS"] = inter_op_threads if inter_op_threads is not None \
+            else DEFAULT_TF_INTER_OP_THREADS
+        return params
+
+    def launch(self, seed, slot, resume=False):
+        params = self.seed_params(seed, slot, resume)
+        process = multiprocessing.get_context("spawn").Process(target=run_in_own_process_group,
+                                                               args=(self.target, params, seed))
+        # The child inherits its cpu affinity and env from us when it starts, so set them just for the start. (This
+        # way the limits are in place before the child imports tf)
+        our_cpus, our_env = os.sched_getaffinity(0), os.environ.copy()
+        try:
+            os.sched_setaffinity(0, self.slot_cpus[slot])
+            num_threads = str(params["TF_INTRA_OP_THREADS"])
+            os.environ.update({"OMP_NUM_THREADS": num_threads, "MKL_NUM_THREADS": num_threads,
+                               "RCALL_NUM_CPU": num_threads})  # (RCALL_NUM_CPU is used by baselines' make_session)
+            process.start()
+        finally:
+            os.sched_setaffinity(0, our_cpus)
+            os.environ.clear()
+            os.environ.update(our_env)
+        self.running[seed] = (process, slot)
+        self.start_times[seed] = time.time()
+        print("Supervisor: started seed {} (pid {}) on cpus {}{}".format(seed, process.pid,
+                                                                         sorted(self.slot_cpus[slot]),
+                                                                         ", resuming" if params["RESUME"] else ""))
+
+    def run(self):
+        """Run all the seeds. Returns the seeds that failed (after all their restarts)"""
+        queue = list(self.seeds)
+        free_slots = list(range(self.num_concurrent))
+        failed = []
+        # Make sure the children are killed if we're stopped with ctrl-c or kill:
+        previous_sigterm = signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+        try:
+            last_report = time.time()
+            while len(queue) > 0 or len(self.running) > 0:
+                while len(queue) > 0 and len(free_slots) > 0:
+                    seed = queue.pop(0)
+                    self.launch(seed, free_slots.pop(0), resume=self.num_restarts[seed] > 0)
+
+                sentinels = {process.sentinel: seed for seed, (process, _) in self.running.items()}
+                for sentinel in wait(list(sentinels), timeout=self.monitor_secs):
+                    seed = sentinels[sentinel]
+                    process, slot = self.running.pop(seed)
+                    process.join()
+                    kill_process_group(process.pid)  # Anything the seed left running
+                    free_slots.append(slot)
+                    hrs = np.round((time.time() - self.start_times[seed]) / 3600, 2)
+                    if process.exitcode == 0:
+                        print("Supervisor: seed {} complete in {} hrs".format(seed, hrs))
+                    elif self.num_restarts[seed] < self.max_restarts:
+                        self.num_restarts[seed] += 1
+                        print("Supervisor: seed {} failed after {} hrs (exit code {}). Restarting it from its latest "
+                              "checkpoint (restart {}/{})".format(seed, hrs, process.exitcode, self.num_restarts[seed],
+                                                                  self.max_restarts))
+                        queue.insert(0, seed)
+                    else:
+                        print("Supervisor: seed {} failed after {} hrs (exit code {}), and has no restarts left".format(
+                            seed, hrs, process.exitcode))
+                        failed.append(seed)
+
+                if time.time() - last_report >= self.monitor_secs:
+                    self.report()
+                    last_report = time.time()
+        finally:
+            self.kill_all()
+            signal.signal(signal.SIGTERM, previous_sigterm)
+
+        print("Supervisor: all seeds finished. Peak memory of each seed (MB): {}. Failed seeds: {}".format(
+            {seed: int(rss / 2**20) for seed, rss in self.peak_rss.items()}, failed))
+        return failed
+
+    def report(self):
+        for seed, (process, slot) in sorted(self.running.items()):
+            rss = process_tree_rss(process.pid)
+            self.peak_rss[seed] = max(self.peak_rss[seed], rss)
+            print("Supervisor: seed {}: pbt iter {}/{}, {} hrs, memory {} MB (peak {} MB)".format(
+                seed, latest_checkpoint_iter(self.params["SAVE_DIR"] + "seed_{}/".format(seed)),
+                self.params["NUM_PBT_ITER"], np.round((time.time() - self.start_times[seed]) / 3600, 2),
+                int(rss / 2**20), int(self.peak_rss[seed] / 2**20)))
+
+    def kill_all(self):
+        for seed, (process, _) in self.running.items():
+            print("Supervisor: stopping seed {}".format(seed))
+            kill_process_group(process.pid)
+            process.kill()  # (In case it hadn't made its process group yet)
+            process.join()
+        self.running = {}
+
+
+def run_in_own_process_group(target, params, seed):
+    """Entry point of each seed process. Any processes started by the seed are in the new group too"""
+    os.setpgid(0, 0)
+    target(params, seed)
+
+def kill_process_group(pgid):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass  # Already gone
+
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def process_tree_rss(pid):
+    """Resident memory (bytes) of the process and all its descendants"""
+    try:
+        process = psutil.Process(pid)
+        processes = [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    rss = 0
+    for process in processes:
+        try:
+            rss += process.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+def latest_checkpoint_iter(seed_save_dir):
+    """The pbt iter of the seed's latest checkpoint (see pbt_checkpoint.py), or 0 if there isn't one"""
+    latest_file = seed_save_dir + "checkpoints/" + LATEST_FILE
+    if not os.path.exists(latest_file):
+        return 0
+    with open(latest_file, 'r') as f:
+        return int(f.read().strip()[len("iter"):])
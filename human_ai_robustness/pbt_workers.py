@@ -0,0 +1,380 @@
+import os, time
+import numpy as np
+import multiprocessing
+import random, pickle
+import tensorflow as tf
+
+from overcooked_ai_py.mdp.overcooked_mdp import OvercookedGridworld
+from overcooked_ai_py.mdp.overcooked_env import OvercookedEnv
+from overcooked_ai_py.agents.agent import AgentPair, AgentFromPolicy
+from overcooked_ai_py.planning.planners import MediumLevelPlanner
+from human_aware_rl.utils import set_global_seed, find_dense_reward_fn, delete_dir_if_exists
+from human_aware_rl.baselines_utils import get_model_policy
+from human_ai_robustness.agent import ToMModel
+
+"""
+Parts of pbt_hms that can run in worker processes. This module deliberately doesn't import pbt_hms (which creates the
+sacred experiment on import), and the workers are started with "spawn" rather than "fork", because forking a process
+that already has a tf session can deadlock. So everything a worker needs is passed as picklable data: the params
+dict, the dirs of frozen (saved) ppo policies, and the "tom specs" (the ToMModel kwargs) of the human models.
+"""
+
+
+def make_pbt_mdp_and_mlp(params):
+    """The mdp and mlp used in pbt_one_run"""
+    mdp = OvercookedGridworld.from_layout_name(**params["MDP_PARAMS"])
+    no_counters_params = {
+        'start_orientations': params["START_ORIENTATIONS"],
+        'wait_allowed': params["WAIT_ALLOWED"],
+        'counter_goals': mdp.get_counter_locations(),
+        'counter_drop': mdp.get_counter_locations(),
+        'counter_pickup': params["COUNTER_PICKUP"],
+        'same_motion_goals': params["SAME_MOTION_GOALS"]
+    } # This means that all counter locations are allowed to have objects dropped on them AND be "goals" (I think!)
+    mlp = MediumLevelPlanner.from_pickle_or_compute(mdp, no_counters_params, force_compute=False)
+    return mdp, mlp
+
+def load_saved_agent(save_dir, sim_threads):
+    """As get_agent_from_saved_model, but also returns the predictor, so that its session can be closed when the agent
+    is no longer needed (each predictor has its own tf graph and session)"""
+    predictor = tf.contrib.predictor.from_saved_model(save_dir)
+    state_policy, processed_obs_policy = get_model_policy(lambda obs: predictor({"obs": obs})["action_probs"],
+                                                          sim_threads)
+    return AgentFromPolicy(state_policy, processed_obs_policy), predictor
+
+def make_tom_model(mlp, tom_spec, player_index):
+    """Make a ToMModel from a tom spec (the dict of ToMModel kwargs given by ToMAgent.get_tom_spec)"""
+    model = ToMModel(mlp=mlp, **tom_spec)
+    model.set_agent_index(player_index)
+    return model
+
+def selection_game_seed(seed, pbt_iter, agent_idx, partner_idx, game_num):
+    """Each selection game has its own seed, so the results don't depend on the order the games are played in, or on
+    which process plays them"""
+    return seed * 1000003 + pbt_iter * 10007 + agent_idx * 1009 + partner_idx * 101 + game_num
+
+def play_selection_game(mdp, env_params, ppo_agent, partner_agent, partner_is_hm, reward_shaping_param, game_seed):
+    """Play one selection game, with the ppo agent as player 0. Returns (dense return, sparse return, length)"""
+    env = OvercookedEnv(mdp, **env_params)
+    if partner_is_hm:
+        partner_agent.agent_index = 1  # We don't actually need to set this, because AgentPair does it
+        partner_agent.GHM.agent_index = 0  # But we do need to set this!
+    set_global_seed(game_seed)
+    agent_pair = AgentPair(ppo_agent, partner_agent)
+    trajs = env.get_rollouts(agent_pair, 1, reward_shaping=reward_shaping_param,
+                             metadata_fn=find_dense_reward_fn(reward_shaping_param))
+    return trajs["metadatas"]["ep_returns_shaped"][0], trajs["ep_returns"][0], trajs["ep_lengths"][0]
+
+def play_selection_games_here(mdp, env_params, games, reward_shaping_param):
+    """Play each game in games, a list of (ppo agent, partner agent, partner_is_hm, game seed), in this process"""
+    # Seeding each game would otherwise reset the random state used for training:
+    np_random_state, random_state = np.random.get_state(), random.getstate()
+    results = [play_selection_game(mdp, env_params, ppo_agent, partner_agent, partner_is_hm, reward_shaping_param,
+                                   game_seed) for ppo_agent, partner_agent, partner_is_hm, game_seed in games]
+    np.random.set_state(np_random_state)
+    random.setstate(random_state)
+    return results
+
+
+#----------------------------------------#
+# Selection worker (one per pool process) #
+#----------------------------------------#
+
+_worker = {}
+
+def init_selection_worker(params):
+    # Each worker only needs a single thread: the parallelism comes from the number of workers
+    os.environ['OMP_NUM_THREADS'] = '1'
+    _worker["params"] = params
+    _worker["mdp"], _worker["mlp"] = make_pbt_mdp_and_mlp(params)
+    _worker["policies"] = {}  # policy dir -> (agent, predictor). Only holds the policies of the current snapshot
+
+def run_selection_task(task):
+    policy_dir, partner, partner_is_hm, reward_shaping_param, game_seed = task
+    params = _worker["params"]
+    # Drop (and close) the policies of old snapshots, then load any policies of this snapshot that we don't have yet
+    iter_dir = os.path.dirname(os.path.dirname(policy_dir)) + "/"
+    for old_dir in [d for d in _worker["policies"] if not d.startswith(iter_dir)]:
+        _worker["policies"].pop(old_dir)[1].session.close()
+    policy_dirs = [policy_dir] if partner_is_hm else [policy_dir, partner]
+    for d in policy_dirs:
+        if d not in _worker["policies"]:
+            _worker["policies"][d] = load_saved_agent(d, params["sim_threads"])
+    ppo_agent = _worker["policies"][policy_dir][0]
+    partner_agent = make_tom_model(_worker["mlp"], partner, 99) if partner_is_hm else _worker["policies"][partner][0]
+    return play_selection_game(_worker["mdp"], params["ENV_PARAMS"], ppo_agent, partner_agent, partner_is_hm,
+                               reward_shaping_param, game_seed)
+
+
+class SelectionEvaluator(object):
+    """
+    Plays the selection games of pbt_one_run: NUM_SELECTION_GAMES games of each ppo agent with each partner. With
+    num_workers > 0 the (ppo agent, partner, game) matrix is farmed out to a pool of worker processes, each holding a
+    frozen copy of the current ppo policies (saved with save_predictor) and the tom specs. Each game is then seeded by
+    selection_game_seed and the results are gathered in a fixed order, so the fitness matrix is the same for any
+    number of workers. With num_workers == 0 the games are played in this process, with the live agents, and unseeded
+    (using the global random state), exactly as the original selection phase of pbt_one_run did.
+
+    With SELECTION_STRATEGY = "racing", the games are played in rounds instead (see race), and agents stop being
+    evaluated once it's clear whether they're the best, the worst, or neither (which is all selection needs to know).
+    Racing always seeds each game, with or without workers.
+    """
+
+    def __init__(self, params, num_workers=0):
+        self.params = params
+        self.num_workers = num_workers
+        self.snapshot_dir = params["SAVE_DIR"] + "selection_snapshot/"
+        self.snapshot_iter = None
+        self.pool = None
+        # Number of games played in the last evaluate, and the number the fixed (non-racing) strategy would've played:
+        self.num_games_played = None
+        self.num_games_budget = None
+        if num_workers > 0:
+            self.pool = multiprocessing.get_context("spawn").Pool(num_workers, initializer=init_selection_worker,
+                                                                  initargs=(params,))
+
+    def evaluate(self, ppo_pop, partner_pop, pbt_iter, reward_shaping_param, mdp, mlp):
+        """
+        Play each ppo agent in ppo_pop with each agent in partner_pop (either the ppo pop or the hm pop). Returns two
+        dicts, in the same format as the selection phase in pbt_one_run: ppo agent idx -> list of rew per step with
+        each partner, and ppo agent idx -> list of arrays of sparse returns with each partner.
+
+        With racing, an agent that drops out early may not have played every partner, and partners differ in how
+        hard they are, so means over different partners aren't comparable. So the dicts only have the partners that
+        every agent played with (the same partners, in the same order, for each agent). Each agent's mean over these
+        partners then estimates the same thing, so the agents can be ranked by it.
+        """
+        num_games = self.params["NUM_SELECTION_GAMES"]
+        game_args = (ppo_pop, partner_pop, pbt_iter, reward_shaping_param, mdp, mlp)
+        if self.params["SELECTION_STRATEGY"] == "racing":
+            results = self.race(*game_args)
+        elif self.pool is None:
+            assert self.params["SELECTION_STRATEGY"] == "fixed"
+            results = self.play_unseeded_games(ppo_pop, partner_pop, reward_shaping_param, mdp, mlp)
+        else:
+            assert self.params["SELECTION_STRATEGY"] == "fixed"
+            game_keys = [(i, j, game) for i in range(len(ppo_pop)) for j in range(len(partner_pop))
+                         for game in range(num_games)]
+            results = dict(zip(game_keys, self.play_games(game_keys, *game_args)))
+        self.num_games_played = len(results)
+        self.num_games_budget = len(ppo_pop) * len(partner_pop) * num_games
+
+        # Gather in a fixed order. (With racing, only the partners that every agent played. Each partner's first game
+        # is played before any partner's second game, so an agent has played a partner iff it played its game 0)
+        common_partners = [j for j in range(len(partner_pop)) if all((i, j, 0) in results for i in range(len(ppo_pop)))]
+        if len(common_partners) < len(partner_pop):
+            print("Racing: ranking the agents on the {} of {} partners that all agents played".format(
+                len(common_partners), len(partner_pop)))
+        avg_ep_returns_dict = {}
+        avg_ep_returns_sparse_dict = {}
+        for i in range(len(ppo_pop)):
+            avg_ep_returns_dict[i], avg_ep_returns_sparse_dict[i] = [], []
+            for j in common_partners:
+                results_ij = np.array([results[(i, j, game)] for game in range(num_games) if (i, j, game) in results])
+                avg_ep_returns_dict[i].append(np.sum(results_ij[:, 0]) / np.sum(results_ij[:, 2]))
+                avg_ep_returns_sparse_dict[i].append(results_ij[:, 1])
+        return avg_ep_returns_dict, avg_ep_returns_sparse_dict
+
+    def race(self, ppo_pop, partner_pop, pbt_iter, reward_shaping_param, mdp, mlp):
+        """
+        Racing selection. The (partner, game) pairs are put in a random order (the same for all agents), and each round
+        every agent still in the race plays the next RACING_GAMES_PER_ROUND of them. After each round, we put a
+        confidence interval (mean +- RACING_Z standard errors) on each agent's rew per step. An agent drops out of the
+        race once its interval shows that it's clearly the best, clearly the worst, or clearly neither. No agent plays
+        more than the fixed budget (each partner NUM_SELECTION_GAMES times). Returns (i, j, game) -> game result
+        """
+        num_agents, num_partners = len(ppo_pop), len(partner_pop)
+        z = self.params["RACING_Z"]
+        order_rng = np.random.RandomState(selection_game_seed(self.params["CURR_SEED"], pbt_iter, 0, 0, 0) % 2**32)
+        pairs = [(j, game) for game in range(self.params["NUM_SELECTION_GAMES"])
+                 for j in order_rng.permutation(num_partners)]
+        results = {}
+        num_pairs_played = 0
+        in_race = list(range(num_agents))
+        lcb, ucb = np.full(num_agents, -np.inf), np.full(num_agents, np.inf)
+
+        while len(in_race) > 0:
+            next_pairs = pairs[num_pairs_played: num_pairs_played + self.params["RACING_GAMES_PER_ROUND"]]
+            num_pairs_played += len(next_pairs)
+            game_keys = [(i, j, game) for i in in_race for j, game in next_pairs]
+            results.update(zip(game_keys, self.play_games(game_keys, ppo_pop, partner_pop, pbt_iter,
+                                                          reward_shaping_param, mdp, mlp)))
+            if num_pairs_played == len(pairs):
+                break  # Used the full budget
+            if num_pairs_played < 2:
+                continue  # Need 2 games for a standard error
+
+            for i in in_race:
+                rews_per_step = [results[(i, j, game)][0] / results[(i, j, game)][2] for j, game in
+                                 pairs[:num_pairs_played]]
+                se = np.std(rews_per_step, ddof=1) / np.sqrt(num_pairs_played)
+                lcb[i], ucb[i] = np.mean(rews_per_step) - z * se, np.mean(rews_per_step) + z * se
+            still_in_race = []
+            for i in in_race:
+                others = [k for k in range(num_agents) if k != i]
+                if len(others) == 0:
+                    continue
+                max_other_lcb, max_other_ucb = max(lcb[others]), max(ucb[others])
+                min_other_lcb, min_other_ucb = min(lcb[others]), min(ucb[others])
+                # Still undecided whether it's the best (or the worst):
+                undecided_best = ucb[i] >= max_other_lcb and lcb[i] <= max_other_ucb
+                undecided_worst = lcb[i] <= min_other_ucb and ucb[i] >= min_other_lcb
+                if undecided_best or undecided_worst:
+                    still_in_race.append(i)
+            in_race = still_in_race
+        return results
+
+    def play_unseeded_games(self, ppo_pop, partner_pop, reward_shaping_param, mdp, mlp):
+        """The fixed strategy without workers: play NUM_SELECTION_GAMES unseeded games of each ppo agent with each
+        partner, in this process, as the original selection phase did. Returns (i, j, game) -> game result"""
+        partner_is_hm = partner_pop[0].human_model
+        env = OvercookedEnv(mdp, **self.params["ENV_PARAMS"])
+        results = {}
+        for i in range(len(ppo_pop)):
+            for j in range(len(partner_pop)):
+                partner_agent = partner_pop[j].get_agent(mlp)
+                if partner_is_hm:
+                    partner_agent.agent_index = 1  # We don't actually need to set this, because AgentPair does it
+                    partner_agent.GHM.agent_index = 0  # But we do need to set this!
+                agent_pair = AgentPair(ppo_pop[i].get_agent(mlp), partner_agent)
+                trajs = env.get_rollouts(agent_pair, self.params["NUM_SELECTION_GAMES"],
+                                         reward_shaping=reward_shaping_param,
+                                         metadata_fn=find_dense_reward_fn(reward_shaping_param))
+                for game in range(self.params["NUM_SELECTION_GAMES"]):
+                    results[(i, j, game)] = (trajs["metadatas"]["ep_returns_shaped"][game], trajs["ep_returns"][game],
+                                             trajs["ep_lengths"][game])
+        return results
+
+    def play_games(self, game_keys, ppo_pop, partner_pop, pbt_iter, reward_shaping_param, mdp, mlp):
+        """Play the games given by game_keys, a list of (ppo agent idx, partner idx, game num)"""
+        partner_is_hm = partner_pop[0].human_model
+        game_seeds = [selection_game_seed(self.params["CURR_SEED"], pbt_iter, i, j, game) for i, j, game in game_keys]
+        if self.pool is None:
+            return self.play_games_here(ppo_pop, partner_pop, partner_is_hm, game_keys, game_seeds,
+                                        reward_shaping_param, mdp, mlp)
+        # (pool.map keeps the order of the tasks)
+        return self.play_games_on_workers(ppo_pop, partner_pop, partner_is_hm, game_keys, game_seeds,
+                                          reward_shaping_param, pbt_iter)
+
+    def play_games_here(self, ppo_pop, partner_pop, partner_is_hm, game_keys, game_seeds, reward_shaping_param, mdp,
+                        mlp):
+        games = [(ppo_pop[i].get_agent(mlp), partner_pop[j].get_agent(mlp), partner_is_hm, game_seed)
+                 for (i, j, _), game_seed in zip(game_keys, game_seeds)]
+        return play_selection_games_here(mdp, self.params["ENV_PARAMS"], games, reward_shaping_param)
+
+    def play_games_on_workers(self, ppo_pop, partner_pop, partner_is_hm, game_keys, game_seeds, reward_shaping_param,
+                              pbt_iter):
+        # Freeze the current policies, so the workers all play with the same weights (once per pbt iter, as racing
+        # plays several rounds each iter)
+        iter_dir = self.snapshot_dir + "pbt_iter{}/".format(pbt_iter)
+        policy_dirs = [iter_dir + agent.agent_name + "/" for agent in ppo_pop]
+        if self.snapshot_iter != pbt_iter:
+            delete_dir_if_exists(self.snapshot_dir, verbose=False)
+            for agent, policy_dir in zip(ppo_pop, policy_dirs):
+                agent.save_predictor(policy_dir)
+            self.snapshot_iter = pbt_iter
+        partners = [partner.get_tom_spec() for partner in partner_pop] if partner_is_hm else policy_dirs
+
+        t_start = time.time()
+        tasks = [(policy_dirs[i], partners[j], partner_is_hm, reward_shaping_param, game_seed)
+                 for (i, j, _), game_seed in zip(game_keys, game_seeds)]
+        results = self.pool.map(run_selection_task, tasks, chunksize=1)
+        print("Played {} selection games on {} workers in {} secs".format(len(tasks), self.num_workers,
+                                                                        np.round(time.time() - t_start, 1)))
+        return results
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        delete_dir_if_exists(self.snapshot_dir, verbose=False)
+
+
+#-------------------------------------------#
+# Population store (for asynchronous pbt)   #
+#-------------------------------------------#
+
+class PopulationStore(object):
+    """
+    On-disk store of the latest snapshot of each member of an asynchronous pbt population. Each member publishes its
+    weights, a frozen predictor (so that others can play with it), its params and its fitness. A snapshot is only
+    visible once its "latest" record has been written (atomically, with os.replace), so readers never see a
+    half-written snapshot. Old versions are deleted, but the last NUM_VERSIONS_KEPT are kept, so a slow reader that
+    read an older record can still load it.
+
+    Each reader has its own PopulationStore, which caches the agent it loaded for each member until that member
+    publishes a new version (loading a predictor makes a new tf graph and session).
+    """
+
+    NUM_VERSIONS_KEPT = 4
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.loaded_agents = {}  # member name -> (version, agent, predictor)
+
+    def member_dir(self, member_name):
+        return self.store_dir + member_name + "/"
+
+    def publish(self, pbt_agent, fitness, pbt_iter):
+        member_dir = self.member_dir(pbt_agent.agent_name)
+        os.makedirs(member_dir, exist_ok=True)
+        latest = self.read_member(pbt_agent.agent_name)
+        version = 0 if latest is None else latest["version"] + 1
+        version_dir = member_dir + "v{}/".format(version)
+        delete_dir_if_exists(version_dir, verbose=False)  # In case a previous publish crashed half way through
+        pbt_agent.save_predictor(version_dir + "predictor/")
+        np.savez(version_dir + "weights.npz", *pbt_agent.get_weights())
+
+        record = {
+            "version": version,
+            "version_dir": version_dir,
+            "agent_name": pbt_agent.agent_name,
+            "fitness": fitness,
+            "pbt_iter": pbt_iter,
+            "num_ppo_runs": pbt_agent.num_ppo_runs,
+            "params": pbt_agent.params,
+            "time": time.time()
+        }
+        with open(member_dir + "latest.pkl.tmp", 'wb') as f:
+            pickle.dump(record, f)
+        os.replace(member_dir + "latest.pkl.tmp", member_dir + "latest.pkl")
+
+        if version >= self.NUM_VERSIONS_KEPT:
+            delete_dir_if_exists(member_dir + "v{}/".format(version - self.NUM_VERSIONS_KEPT), verbose=False)
+
+    def read_member(self, member_name):
+        """The latest record of this member, or None if it hasn't published yet"""
+        latest_file = self.member_dir(member_name) + "latest.pkl"
+        if not os.path.exists(latest_file):
+            return None
+        with open(latest_file, 'rb') as f:
+            return pickle.load(f)
+
+    def read_population(self, member_names):
+        """The latest record of each member that has published"""
+        records = {name: self.read_member(name) for name in member_names}
+        return {name: record for name, record in records.items() if record is not None}
+
+    @staticmethod
+    def load_weights(record):
+        weights = np.load(record["version_dir"] + "weights.npz")
+        return [weights["arr_{}".format(i)] for i in range(len(weights.files))]
+
+    def load_agent(self, record, sim_threads):
+        """An agent that plays with this member's snapshot policy (as get_agent_from_saved_model). The agent is reused
+        until the member has a new version, when the old version's session is closed"""
+        cached = self.loaded_agents.get(record["agent_name"])
+        if cached is not None and cached[0] == record["version"]:
+            return cached[1]
+        agent, predictor = load_saved_agent(record["version_dir"] + "predictor/", sim_threads)
+        if cached is not None:
+            cached[2].session.close()
+        self.loaded_agents[record["agent_name"]] = (record["version"], agent, predictor)
+        return agent
+
+    def close(self):
+        for _, _, predictor in self.loaded_agents.values():
+            predictor.session.close()
+        self.loaded_agents = {}
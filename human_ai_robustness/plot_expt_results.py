@@ -1,6 +1,25 @@
 
 from human_aware_rl.ppo.ppo_pop import plot_ppo_tom
+from human_ai_robustness.pbt_logs import load_agent_logs, has_log_store
 import matplotlib.pyplot as plt
+import numpy as np
+
+def plot_pbt_logs(runs_dir, run_name, seeds, partners=("bc", "bc2", "hm0", "hm1")):
+    """Plot the best agent's sparse reward with each partner vs pbt iter (mean and standard error over the seeds), for
+    runs with columnar logs (see pbt_logs.py)"""
+    logs_each_seed = [load_agent_logs('{}/{}/seed_{}/ppo_agent0/'.format(runs_dir, run_name, seed)) for seed in seeds]
+    plt.figure()
+    for partner in partners:
+        rews = [logs["best_agent_rew_{}".format(partner)] for logs in logs_each_seed]
+        num_iters = min(len(rew) for rew in rews)  # (In case some seeds are still running)
+        rews = np.array([rew[:num_iters] for rew in rews])
+        mean, se = np.mean(rews, axis=0), np.std(rews, axis=0) / np.sqrt(len(seeds))
+        plt.plot(range(1, num_iters + 1), mean, label=partner)
+        plt.fill_between(range(1, num_iters + 1), mean - se, mean + se, alpha=0.2)
+    plt.xlabel('PBT iter')
+    plt.ylabel('Best agent sparse rew')
+    plt.title(run_name)
+    plt.legend()
 
 # SEEDS = [2732, 3264, 4859, 9225, 9845]
 # SEEDS = [2732, 4859, 9845]
@@ -24,6 +43,9 @@ for i in range(len(runs)):
 
     # SEEDS = SEEDS if run_name != 'cring_20mixed' else [2732, 3264, 4859, 9225]
 
-    plot_ppo_tom(DIR, run_name, SEEDS, plot_val=False, plot_dense=False)
+    if has_log_store('{}/{}/seed_{}/ppo_agent0/'.format(DIR, run_name, SEEDS[0])):
+        plot_pbt_logs(DIR, run_name, SEEDS)
+    else:
+        plot_ppo_tom(DIR, run_name, SEEDS, plot_val=False, plot_dense=False)
 
 plt.show()
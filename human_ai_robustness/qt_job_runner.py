@@ -0,0 +1,241 @@
+import os, sys, time, json, itertools, subprocess
+import numpy as np
+from argparse import ArgumentParser
+
+from human_ai_robustness import PROJECT_DIR
+
+"""
+Job runner for the qualitative robustness experiments. This replaces launching qualitative_robustness_expt.py by hand
+from the experiments/*.sh scripts: the jobs are given as a declarative matrix (see experiments/qt_bot0.json), and are
+scheduled onto N local worker slots, longest (estimated) job first. The wall time and peak memory of each job are
+recorded, and these records are used to estimate the cost of jobs in future runs.
+
+A matrix file is a list of blocks. Each block maps an argument of qualitative_robustness_expt.py to either a single
+value or a list of values; every combination of the values in a block is one job. E.g.:
+    [{"layout": "bottleneck", "agent_run_folder": "final_neurips_agents/bot/", "agent_run_name": ["bot_1tom_s",
+    "bot_20tom_s"], "tests_to_run": ["Test1ai", "Test3ai"], "agent_seeds": [2732, 3264], "num_avg": 50}]
+gives 8 jobs.
+"""
+
+# Argument name in the matrix -> flag of qualitative_robustness_expt.py
+MATRIX_ARGS_TO_FLAGS = {
+    "layout": "-l",
+    "agent_type": "-a_t",
+    "agent_run_folder": "-a_f",
+    "agent_run_name": "-a_n",
+    "agent_seeds": "-a_s",
+    "tests_to_run": "-t",
+    "num_avg": "-n",
+    "num_val_games": "-nv",
+    "policy_probe": "-pp",
+    "adaptive_ci_width": "-ciw",
+    "adaptive_threshold": "-cit",
+    "common_random_numbers": "-crn",
+    "batched_validation": "-bv",
+}
+# The args that determine the cost of a job (the cost shouldn't depend on which agent of a given type is tested)
+COST_ARGS = ["layout", "agent_type", "tests_to_run", "num_avg", "num_val_games", "policy_probe", "adaptive_ci_width",
+             "adaptive_threshold", "common_random_numbers"]
+# Args that are on/off flags
+FLAG_ARGS = ["policy_probe", "common_random_numbers", "batched_validation"]
+
+TIMINGS_FILE = PROJECT_DIR + "/data/qualitative_expts/job_timings.json"
+LOG_DIR = PROJECT_DIR + "/data/qualitative_expts/job_logs/"
+DEFAULT_JOB_COST = 60 * 60  # secs. Used when we have no previous timings at all
+
+
+class Job(object):
+
+    def __init__(self, job_args):
+        self.args = job_args
+        self.estimated_cost = None
+        self.process = None
+        self.slot = None
+        self.start_time = None
+
+    @property
+    def name(self):
+        return "_".join(str(self.args[k]).replace("/", "").replace(",", "-") for k in sorted(self.args))
+
+    @property
+    def cost_key(self):
+        return json.dumps({k: self.args.get(k) for k in COST_ARGS}, sort_keys=True)
+
+    def command(self):
+        command = [sys.executable, "qualitative_robustness_expt.py"]
+        for arg, value in sorted(self.args.items()):
+            if arg in FLAG_ARGS:
+                if value:
+                    command.append(MATRIX_ARGS_TO_FLAGS[arg])
+            else:
+                command += [MATRIX_ARGS_TO_FLAGS[arg], str(value)]
+        return command
+
+
+def expand_matrix(matrix):
+    """Turn the list of matrix blocks into the list of all jobs"""
+    jobs = []
+    for block in matrix:
+        for arg in block:
+            assert arg in MATRIX_ARGS_TO_FLAGS, "Unrecognized arg {}. Choose from: {}".format(arg,
+                                                                                        list(MATRIX_ARGS_TO_FLAGS))
+        args = sorted(block)
+        values = [block[arg] if isinstance(block[arg], list) else [block[arg]] for arg in args]
+        for combination in itertools.product(*values):
+            jobs.append(Job(dict(zip(args, combination))))
+    return jobs
+
+def load_timings(timings_file=TIMINGS_FILE):
+    if not os.path.exists(timings_file):
+        return []
+    with open(timings_file, 'r') as f:
+        return json.load(f)
+
+def save_timings(timings, timings_file=TIMINGS_FILE):
+    # Write then rename, so that the file is never left half-written
+    with open(timings_file + ".tmp", 'w') as f:
+        json.dump(timings, f, indent=1)
+    os.replace(timings_file + ".tmp", timings_file)
+
+def estimate_job_costs(jobs, timings):
+    """Estimate the cost of each job by the median wall time of successful previous jobs with the same cost_key. For
+    jobs that haven't been run before, use the median over all previous jobs on the same layout (or over all jobs)"""
+    successful = [t for t in timings if t["returncode"] == 0]
+    for job in jobs:
+        same_key = [t["wall_time"] for t in successful if t["cost_key"] == job.cost_key]
+        same_layout = [t["wall_time"] for t in successful if t["args"].get("layout") == job.args.get("layout")]
+        all_times = [t["wall_time"] for t in successful]
+        for times in [same_key, same_layout, all_times]:
+            if len(times) > 0:
+                job.estimated_cost = np.median(times)
+                break
+        else:
+            job.estimated_cost = DEFAULT_JOB_COST
+
+def get_slot_cpus(num_workers, cpus_per_worker):
+    """Split the available cpus into num_workers disjoint sets (one for each worker slot)"""
+    available_cpus = sorted(os.sched_getaffinity(0))
+    if cpus_per_worker is None:
+        cpus_per_worker = max(len(available_cpus) // num_workers, 1)
+    slot_cpus = []
+    for slot in range(num_workers):
+        cpus = available_cpus[slot * cpus_per_worker: (slot + 1) * cpus_per_worker]
+        # If there aren't enough cpus, slots share cpus rather than getting none
+        slot_cpus.append(set(cpus) if len(cpus) > 0 else set(available_cpus))
+    return slot_cpus
+
+def launch_job(job, slot, slot_cpus, gpus):
+    env = os.environ.copy()
+    if gpus is not None:
+        env["CUDA_VISIBLE_DEVICES"] = str(gpus[slot % len(gpus)])
+    # Also limit the number of threads each job uses, so that the jobs don't fight over the cpus:
+    env["OMP_NUM_THREADS"] = str(len(slot_cpus[slot]))
+    log_file = open(LOG_DIR + job.name + ".log", 'w')
+    job.process = subprocess.Popen(job.command(), cwd=PROJECT_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT,
+                                   preexec_fn=lambda: os.sched_setaffinity(0, slot_cpus[slot]))
+    log_file.close()
+    job.slot = slot
+    job.start_time = time.time()
+
+def stop_jobs(jobs, timeout=10):
+    """Stop the running jobs (e.g. when the runner is interrupted), so that they aren't left running on their own"""
+    jobs = list(jobs)
+    print("\nStopping {} running jobs".format(len(jobs)))
+    for job in jobs:
+        job.process.terminate()
+    for job in jobs:
+        try:
+            job.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            job.process.kill()
+            job.process.wait()
+
+def run_jobs(jobs, num_workers, cpus_per_worker=None, gpus=None, timings_file=TIMINGS_FILE):
+    """Run the jobs on num_workers worker slots, longest estimated job first. Whenever a job finishes, record its wall
+    time and peak memory, then start the next job on the free slot"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    timings = load_timings(timings_file)
+    estimate_job_costs(jobs, timings)
+    # Longest job first, so that long jobs don't get stuck at the end of the run
+    queue = sorted(jobs, key=lambda job: job.estimated_cost, reverse=True)
+    print("Running {} jobs on {} workers. Estimated total: {} hrs; estimated wall time: >= {} hrs".format(
+        len(jobs), num_workers, np.round(sum(job.estimated_cost for job in jobs) / 3600, 2),
+        np.round(max([job.estimated_cost for job in jobs] + [sum(job.estimated_cost for job in jobs) / num_workers])
+                 / 3600, 2)))
+
+    slot_cpus = get_slot_cpus(num_workers, cpus_per_worker)
+    free_slots = list(range(num_workers))
+    running = {}  # pid -> job
+    num_failed = 0
+    start_time = time.time()
+
+    while len(queue) > 0 or len(running) > 0:
+        while len(queue) > 0 and len(free_slots) > 0:
+            job = queue.pop(0)
+            launch_job(job, free_slots.pop(0), slot_cpus, gpus)
+            running[job.process.pid] = job
+            print("Started {} on slot {} (estimated {} mins)".format(job.name, job.slot,
+                                                                   np.round(job.estimated_cost / 60, 1)))
+
+        # Wait for any job to finish. wait4 also gives the resource usage of that child only
+        try:
+            pid, status, rusage = os.wait4(-1, 0)
+        except KeyboardInterrupt:
+            stop_jobs(running.values())
+            raise
+        if pid not in running:
+            continue
+        job = running.pop(pid)
+        free_slots.append(job.slot)
+        returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        job.process.returncode = returncode
+        wall_time = time.time() - job.start_time
+        if returncode != 0:
+            num_failed += 1
+
+        timings.append({
+            "cost_key": job.cost_key,
+            "args": job.args,
+            "wall_time": wall_time,
+            "peak_rss_mb": rusage.ru_maxrss / 1024,  # ru_maxrss is in KB on linux
+            "returncode": returncode,
+            "finished": time.strftime('%d-%m-%Y_%H:%M:%S'),
+        })
+        save_timings(timings, timings_file)
+        print("Finished {} in {} mins (estimated {}), peak RSS {} MB, return code {}. {} running, {} queued".format(
+            job.name, np.round(wall_time / 60, 1), np.round(job.estimated_cost / 60, 1),
+            np.round(rusage.ru_maxrss / 1024), returncode, len(running), len(queue)))
+
+    print("\nAll jobs complete in {} hrs; {} failed (see {})".format(
+        np.round((time.time() - start_time) / 3600, 2), num_failed, LOG_DIR))
+    return num_failed
+
+
+if __name__ == "__main__":
+    """
+    Run a matrix of qualitative experiments on this machine, e.g.:
+    python qt_job_runner.py -m experiments/qt_bot0.json -w 4 -g 0,1,2,3
+    """
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--matrix", help="json file with the matrix of jobs, e.g. experiments/qt_bot0.json",
+                        required=True)
+    parser.add_argument("-w", "--num_workers", type=int, default=4, help="Number of jobs to run at once")
+    parser.add_argument("-c", "--cpus_per_worker", type=int, required=False, default=None,
+                        help="Default: split all available cpus between the workers")
+    parser.add_argument("-g", "--gpus", required=False, default=None,
+                        help="GPU ids separated by commas; each worker slot is pinned to one of them. E.g. 0,1,2,3")
+    parser.add_argument("-d", "--dry_run", default=False, action='store_true',
+                        help="Only print the jobs and their estimated costs")
+    args = parser.parse_args()
+
+    with open(args.matrix, 'r') as f:
+        jobs = expand_matrix(json.load(f))
+
+    if args.dry_run:
+        estimate_job_costs(jobs, load_timings())
+        for job in sorted(jobs, key=lambda job: job.estimated_cost, reverse=True):
+            print("{} mins: {}".format(np.round(job.estimated_cost / 60, 1), " ".join(job.command())))
+    else:
+        gpus = args.gpus.split(',') if args.gpus is not None else None
+        num_failed = run_jobs(jobs, args.num_workers, args.cpus_per_worker, gpus)
+        sys.exit(1 if num_failed > 0 else 0)
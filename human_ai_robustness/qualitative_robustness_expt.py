@@ -1,11 +1,12 @@
-import time, copy, json
+import time, copy, json, random
 import numpy as np
 from argparse import ArgumentParser
+from collections import defaultdict
 import matplotlib.pyplot as plt; plt.rcdefaults()
 
 from overcooked_ai_py.utils import mean_and_std_err, save_pickle
-from overcooked_ai_py.agents.agent import AgentPair, RandomAgent, StayAgent, AsymmAgentPairs
-from overcooked_ai_py.mdp.actions import Direction
+from overcooked_ai_py.agents.agent import Agent, AgentPair, RandomAgent, StayAgent, AsymmAgentPairs
+from overcooked_ai_py.mdp.actions import Action, Direction
 from overcooked_ai_py.mdp.overcooked_env import OvercookedEnv, MultiOvercookedEnv
 from overcooked_ai_py.mdp.overcooked_mdp import OvercookedGridworld, PlayerState, ObjectState, OvercookedState
 from overcooked_ai_py.planning.planners import MediumLevelPlanner
@@ -139,6 +140,8 @@ class InitialStatesCreator(object):
 # TESTING CLASSES #
 ###################
 
+WHOLE_HORIZON = "whole_horizon"  # probe_horizon of tests that can be probed over their whole testing horizon
+
 
 class AbstractRobustnessTest(object):
     """
@@ -158,12 +161,26 @@ class AbstractRobustnessTest(object):
     # Attributes meant to be overwitten by subclasses
     valid_layouts = ALL_LAYOUTS
     test_types = None
-
-    def __init__(self, mdp, trained_agent, trained_agent_type, agent_run_name, num_rollouts_per_initial_state=1, print_info=False, display_runs=False):
+    # Set to the number of timesteps that decide success, for tests where success only depends on the first action(s)
+    # of the trained agent. Only these tests can be run in policy-probe mode (see evaluate_agent_by_policy_probe).
+    # WHOLE_HORIZON probes the whole testing horizon, which is exact for any test where H is deterministic
+    probe_horizon = None
+
+    def __init__(self, mdp, trained_agent, trained_agent_type, agent_run_name, num_rollouts_per_initial_state=1, print_info=False, display_runs=False, policy_probe=False,
+                 adaptive_ci_width=None, adaptive_threshold=None, common_random_numbers=False, sim_threads=None,
+                 batched_validation=False):
         self.mdp = mdp
         self.layout = mdp.layout_name
         self.env_horizon = self.set_testing_horizon()
+        # In adaptive mode this is the max number of rollouts per initial state (see stop_sampling_this_state)
         self.num_rollouts_per_initial_state = num_rollouts_per_initial_state
+        self.adaptive_ci_width = adaptive_ci_width
+        self.adaptive_threshold = adaptive_threshold
+        self.num_rollouts_used = None
+        # With common random numbers, the H model and trained agent are seeded per (initial state, rollout), so every
+        # agent evaluated on this test faces exactly the same H-model noise (see evaluate_agent_on_layout)
+        self.common_random_numbers = common_random_numbers
+        self.successes_each_state = None
 
         self.print_info = print_info
         self.display_runs = display_runs
@@ -171,7 +188,16 @@ class AbstractRobustnessTest(object):
         # Just a string of the name
         self.trained_agent_type = trained_agent_type
         self.agent_run_name = agent_run_name
-        self.success_rate = self.evaluate_agent_on_layout(trained_agent)
+        # The fixed batch size of a ppo agent's policy (see get_agent_action_probs)
+        self.sim_threads = sim_threads
+        # Play the validation games in lockstep batches (see ValidationRewardTest.play_validation_games_batched)
+        self.batched_validation = batched_validation
+
+        self.policy_probe = policy_probe and self.can_policy_probe(trained_agent)
+        if self.policy_probe:
+            self.success_rate = self.evaluate_agent_by_policy_probe(trained_agent)
+        else:
+            self.success_rate = self.evaluate_agent_on_layout(trained_agent)
         self._check_valid_class()
 
     def to_dict(self):
@@ -183,6 +209,13 @@ class AbstractRobustnessTest(object):
             "num_rollouts_per_initial_state": self.num_rollouts_per_initial_state,
             "trained_agent_type": self.trained_agent_type,
             "agent_run_name": self.agent_run_name,
+            "policy_probe": self.policy_probe,
+            "adaptive_ci_width": self.adaptive_ci_width,
+            "adaptive_threshold": self.adaptive_threshold,
+            "common_random_numbers": self.common_random_numbers,
+            "batched_validation": self.batched_validation,
+            "num_rollouts_used": self.num_rollouts_used,
+            "successes_each_state": self.successes_each_state,
             "success_rate": self.success_rate
         }
 
@@ -194,12 +227,23 @@ class AbstractRobustnessTest(object):
 
     def evaluate_agent_on_layout(self, trained_agent):
         H_model = self.setup_human_model()
+        if self.common_random_numbers:
+            H_model = CommonRandomNumbersAgent(H_model)
+
+        self.successes_each_state = []
+        self.num_rollouts_used = 0
 
-        subtest_successes = []
+        for state_idx, (initial_state, success_info) in enumerate(self.get_initial_states()):
 
-        for (initial_state, success_info) in self.get_initial_states():
+            subtest_successes = []
+
+            for rollout_idx in range(self.num_rollouts_per_initial_state):
+                if self.common_random_numbers:
+                    # The seeds only depend on (state, rollout), not on the agent being evaluated
+                    seed = crn_seed(state_idx, rollout_idx, self.num_rollouts_per_initial_state)
+                    H_model.seed(seed)
+                    set_global_seed(seed + CRN_TRAINED_AGENT_SEED_OFFSET)
 
-            for _ in range(self.num_rollouts_per_initial_state):
                 # Check it's a valid state:
                 self.mdp._check_valid_state(initial_state)
 
@@ -223,7 +267,98 @@ class AbstractRobustnessTest(object):
                     print(sum(subtest_successes)/len(subtest_successes))
                     print('Subtest successes: {}'.format(subtest_successes))
 
-        return sum(subtest_successes) / len(subtest_successes)
+                if self.stop_sampling_this_state(sum(subtest_successes), len(subtest_successes)):
+                    break
+
+            self.num_rollouts_used += len(subtest_successes)
+            self.successes_each_state.append([int(success) for success in subtest_successes])
+
+        success_rate_each_state = [sum(successes) / len(successes) for successes in self.successes_each_state]
+
+        if self.adaptive_ci_width is not None or self.adaptive_threshold is not None:
+            max_rollouts = self.num_rollouts_per_initial_state * len(success_rate_each_state)
+            print("{}: used {} of a max of {} rollouts".format(self.__class__.__name__, self.num_rollouts_used,
+                                                                max_rollouts))
+
+        # Each initial state has equal weight, even if they had different numbers of rollouts
+        return np.mean(success_rate_each_state)
+
+    def stop_sampling_this_state(self, num_successes, num_rollouts):
+        """
+        In adaptive mode, stop doing rollouts from an initial state once the Wilson confidence interval of its success
+        rate is narrower than self.adaptive_ci_width, or once it lies entirely above or below self.adaptive_threshold
+        (so that more rollouts couldn't change which side of the threshold the state is on)
+        """
+        if num_rollouts < MIN_ADAPTIVE_ROLLOUTS:
+            return False
+        lower, upper = wilson_interval(num_successes, num_rollouts)
+        if self.adaptive_ci_width is not None and upper - lower < self.adaptive_ci_width:
+            return True
+        if self.adaptive_threshold is not None and (lower > self.adaptive_threshold or upper < self.adaptive_threshold):
+            return True
+        return False
+
+    def can_policy_probe(self, trained_agent):
+        """Policy-probe mode needs a test with a probe_horizon and a ppo agent with a known sim_threads (whose policy
+        can be batch-evaluated on the lossless state encoding, see get_agent_action_probs)"""
+        if self.probe_horizon is None:
+            print("{} has no probe_horizon: evaluating with rollouts".format(self.__class__.__name__))
+            return False
+        if self.trained_agent_type != "ppo" or not hasattr(trained_agent, "direct_policy") or self.sim_threads is None:
+            print("Agent type {} can't be probed: evaluating with rollouts".format(self.trained_agent_type))
+            return False
+        return True
+
+    def get_probe_horizon(self):
+        return self.env_horizon if self.probe_horizon == WHOLE_HORIZON else self.probe_horizon
+
+    def evaluate_agent_by_policy_probe(self, trained_agent):
+        """
+        Evaluate the agent without any rollouts. Success must only depend on the trained agent's first
+        get_probe_horizon() actions, so we enumerate all of the agent's action sequences of that length, weight each
+        sequence by the agent's action probs, and sum the probs of the sequences that end in a successful state. This
+        gives the expected success rate exactly, with one batched forward pass per timestep over all initial states
+        (in chunks of sim_threads).
+        Sequences that reach the same state are merged (the agent's policy only depends on the state), so the frontier
+        stays small even over a whole testing horizon.
+        """
+        initial_states = self.get_initial_states()
+
+        # Each element of the frontier is (idx of the initial state, current state, prob of reaching the state)
+        frontier = []
+        for i, (initial_state, _) in enumerate(initial_states):
+            self.mdp._check_valid_state(initial_state)
+            frontier.append((i, initial_state, 1))
+
+        for _ in range(self.get_probe_horizon()):
+            action_probs = get_agent_action_probs(trained_agent, self.mdp, [state for _, state, _ in frontier],
+                                                  agent_index=1, batch_size=self.sim_threads)
+            next_frontier = defaultdict(float)  # (idx of the initial state, state) -> prob
+            for (i, state, prob), probs_this_state in zip(frontier, action_probs):
+                h_action = self.probe_h_action(state)
+                for action_idx, action in enumerate(Action.ALL_ACTIONS):
+                    if probs_this_state[action_idx] == 0:
+                        continue
+                    next_state = self.mdp.get_state_transition(state, (h_action, action))[0]
+                    next_frontier[(i, next_state)] += prob * probs_this_state[action_idx]
+            frontier = [(i, state, prob) for (i, state), prob in next_frontier.items()]
+
+        success_probs = np.zeros(len(initial_states))
+        for i, final_state, prob in frontier:
+            initial_state, success_info = initial_states[i]
+            if self.is_success(initial_state, final_state, success_info):
+                success_probs[i] += prob
+
+        if self.print_info:
+            print('Success prob for each initial state: {}'.format(success_probs))
+
+        # Each initial state has equal weight, as in evaluate_agent_on_layout
+        return np.mean(success_probs)
+
+    def probe_h_action(self, state):
+        """The action H takes at each timestep of a policy probe. Only deterministic H models can be probed, so tests
+        with a probe_horizon should use the StayAgent (or overwrite this)"""
+        return Action.STAY
 
     def is_success(self, initial_state, final_state, success_info=None):
         raise NotImplementedError()
@@ -231,6 +366,130 @@ class AbstractRobustnessTest(object):
     def _check_valid_class(self):
         assert all(test_type in self.ALL_TEST_TYPES for test_type in self.test_types), "You need to set the self.test_types class attribute for this specific test class, and each test type must be among the following: {}".format(self.test_types)
         assert all(layout in ALL_LAYOUTS for layout in self.valid_layouts)
+        assert self.probe_horizon in [None, WHOLE_HORIZON] or self.probe_horizon >= 1
+
+
+MIN_ADAPTIVE_ROLLOUTS = 3  # Never stop sampling a state before this many rollouts (the interval is unreliable)
+
+def wilson_interval(num_successes, num_trials, z=1.96):
+    """Wilson score interval for a success rate (z=1.96 gives the 95% interval)"""
+    p = num_successes / num_trials
+    denominator = 1 + z**2 / num_trials
+    centre = (p + z**2 / (2 * num_trials)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / num_trials + z**2 / (4 * num_trials**2)) / denominator
+    return centre - half_width, centre + half_width
+
+CRN_TRAINED_AGENT_SEED_OFFSET = 500000  # So that the trained agent's seed differs from H's seed for the same rollout
+
+def crn_seed(state_idx, rollout_idx, num_rollouts):
+    """Seed for one rollout of one initial state, when evaluating with common random numbers. Each (state, rollout)
+    pair has its own seed, whatever the number of rollouts per state"""
+    return state_idx * num_rollouts + rollout_idx
+
+class CommonRandomNumbersAgent(Agent):
+    """
+    Wraps the H model so that it draws from its own random stream (for both `random` and `np.random`), instead of
+    sharing the global stream with the trained agent. Otherwise, the H-model noise in a rollout would depend on how many
+    random numbers the trained agent happened to draw, and different agents wouldn't face the same H-model noise.
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.seed(0)
+
+    def seed(self, seed):
+        random_state = random.getstate()
+        np_random_state = np.random.get_state()
+        random.seed(seed)
+        np.random.seed(seed)
+        self.random_state = random.getstate()
+        self.np_random_state = np.random.get_state()
+        random.setstate(random_state)
+        np.random.set_state(np_random_state)
+
+    def action(self, state):
+        # Swap in the H model's own random stream while it picks its action
+        random_state = random.getstate()
+        np_random_state = np.random.get_state()
+        random.setstate(self.random_state)
+        np.random.set_state(self.np_random_state)
+        action = self.agent.action(state)
+        self.random_state = random.getstate()
+        self.np_random_state = np.random.get_state()
+        random.setstate(random_state)
+        np.random.set_state(np_random_state)
+        return action
+
+    def set_agent_index(self, agent_index):
+        self.agent.set_agent_index(agent_index)
+
+    def set_mdp(self, mdp):
+        self.agent.set_mdp(mdp)
+
+    def reset(self):
+        self.agent.reset()
+
+def paired_comparison(successes_a, successes_b):
+    """
+    Compare two agents that were evaluated with common random numbers. successes_a and successes_b are the
+    successes_each_state lists of the same test for each agent; only (state, rollout) cells that both agents played are
+    compared. Returns the mean and standard error of the paired difference in success (a - b).
+    """
+    differences = []
+    for state_successes_a, state_successes_b in zip(successes_a, successes_b):
+        for success_a, success_b in zip(state_successes_a, state_successes_b):
+            differences.append(success_a - success_b)
+    return mean_and_std_err(differences)
+
+def get_agent_action_probs(agent, mdp, states, agent_index, featurize_mlp=None, batch_size=None):
+    """Find the agent's action probs for every state in states, in one batched forward pass of the agent's policy.
+    agent_index is either one index for all states, or a list with the index for each state. The observations are the
+    lossless state encoding (ppo agents), or, with featurize_mlp, the featurized state (BC agents, whose input is the
+    62-dim featurized state). (The BC agents' direct_policy returns the action probs by default, and doesn't take
+    return_action_probs.)
+
+    A ppo agent's policy only takes batches of exactly sim_threads observations, so for ppo agents batch_size must be
+    sim_threads: the observations are then padded with zeros (as in get_model_policy's state_policy) and evaluated in
+    chunks of batch_size"""
+    agent_indices = agent_index if isinstance(agent_index, list) else [agent_index] * len(states)
+    if featurize_mlp is not None:
+        obs = np.array([mdp.featurize_state(state, featurize_mlp)[idx] for state, idx in zip(states, agent_indices)])
+    else:
+        obs = np.array([mdp.lossless_state_encoding(state)[idx] for state, idx in zip(states, agent_indices)])
+    if featurize_mlp is not None:
+        policy = agent.direct_policy
+    else:
+        policy = lambda obs_batch: agent.direct_policy(obs_batch, return_action_probs=True)
+    if batch_size is None:
+        return policy(obs)
+    padded_obs = np.concatenate([obs, np.zeros((-len(obs) % batch_size,) + obs.shape[1:])])
+    action_probs = [policy(padded_obs[i: i + batch_size]) for i in range(0, len(padded_obs), batch_size)]
+    return np.concatenate(action_probs)[:len(obs)]
+
+def sample_actions(action_probs):
+    return [Action.ALL_ACTIONS[np.random.choice(len(Action.ALL_ACTIONS), p=probs)] for probs in action_probs]
+
+BC_STUCK_TIME = 3  # Number of timesteps with an unchanged position and orientation before a BC agent is stuck
+
+def unblock_bc_action_probs(action_probs, history, player_state):
+    """
+    Mimics the unblock_if_stuck option of the BC agents (ImitationAgentFromPolicy.unblock_if_stuck), for when their
+    action probs are found in a batch: if the BC player's position and orientation are the same now as at each of the
+    last BC_STUCK_TIME timesteps, remove the actions it took in that time. As in the BC agents, this only applies once
+    the player has a full history of BC_STUCK_TIME + 1 timesteps. history is the list of (player state, action) of this
+    BC player in this episode, and player_state is its current player state.
+    """
+    if len(history) < BC_STUCK_TIME + 1:
+        return action_probs
+    recent = history[-BC_STUCK_TIME:]
+    if any(past_player_state.pos_and_or != player_state.pos_and_or for past_player_state, _ in recent):
+        return action_probs
+    action_probs = np.array(action_probs)
+    for _, action in recent:
+        action_probs[Action.ACTION_TO_INDEX[action]] = 0
+    if action_probs.sum() == 0:
+        return np.ones(len(action_probs)) / len(action_probs)
+    return action_probs / action_probs.sum()
 
 ###########################
 # Standard test positions #
@@ -335,6 +594,7 @@ class Test1ai(Test1):
     """
 
     test_types = ["agent_robustness"]
+    probe_horizon = WHOLE_HORIZON  # (H is a StayAgent)
 
     def set_testing_horizon(self):
         return get_layout_horizon(self.layout, "medium")
@@ -720,6 +980,7 @@ class Test1bii(Test1):
     # TODO: could make a variant that is dependent on "how much faster H is than R", making it "agent_robustness"
 
     test_types = ["agent_robustness"]
+    probe_horizon = WHOLE_HORIZON  # (H is a StayAgent)
 
     valid_layouts = ["counter_circuit", "coordination_ring", "bottleneck", "large_room", "centre_objects"]
 
@@ -976,6 +1237,8 @@ class Test3a(Test3):
 
     """Tests 3a: H is a stationary agent"""
 
+    probe_horizon = WHOLE_HORIZON
+
     def setup_human_model(self):
         return StayAgent()
 
@@ -1149,6 +1412,7 @@ class Test4(AbstractRobustnessTest):
     """
     
     test_types = ["state_robustness"]
+    probe_horizon = WHOLE_HORIZON  # (H is a StayAgent)
 
     def set_testing_horizon(self):
         return get_layout_horizon(self.layout, "medium")
@@ -1286,6 +1550,12 @@ class ValidationRewardTest(AbstractRobustnessTest):
         return 400
 
     def evaluate_agent_on_layout(self, trained_agent):
+        # (Adaptive mode doesn't apply here, as the score isn't a success rate)
+        if self.batched_validation:
+            if self.trained_agent_type == "ppo" and self.sim_threads is not None:
+                return self.play_validation_games_batched(trained_agent, self.num_rollouts_per_initial_state)
+            print("Agent type {} can't play batched validation games: playing them one at a time".format(
+                self.trained_agent_type))
         return self.play_validation_games(trained_agent, self.num_rollouts_per_initial_state)
 
     def play_validation_games(self, trained_agent, num_val_games):
@@ -1312,47 +1582,112 @@ class ValidationRewardTest(AbstractRobustnessTest):
 
         return np.mean(validation_rewards)
 
+    def play_validation_games_batched(self, trained_agent, num_val_games):
+        """
+        Same games as play_validation_games, but all (validation agent, ppo index, game) episodes are played in
+        lockstep. Each timestep, the ppo agent's actions for all episodes come from one batched forward pass, and each
+        BC agent's actions for all of its episodes come from one batched forward pass. Each ToM episode needs its own
+        ToM (they have memory), but all ToMs share one planner, so its cache is shared.
+        """
+        mdp = self.mdp
+        trained_agent.set_mdp(mdp)
+        mlp = make_mlp(mdp)
+        val_tom_params, _, _ = import_manual_tom_params(self.layout, 20)
+        val_bcs = self.load_validation_bcs(self.layout)
+        partner_names = ["ToM {}".format(i) for i in range(VAL_POP_SIZE // 2)] + \
+                        ["BC {}".format(seed) for seed in get_val_bc_seeds(self.layout)]
+
+        # Each episode is [val agent idx, ppo index, partner, partner's (player state, action) history]
+        episodes = []
+        for ppo_index in range(2):
+            for _ in range(num_val_games):
+                for val_idx, val_tom in enumerate(self.make_validation_toms(mlp, val_tom_params)):
+                    val_tom.set_agent_index(1 - ppo_index)
+                    val_tom.reset()
+                    episodes.append([val_idx, ppo_index, val_tom, []])
+                for val_idx, val_bc in enumerate(val_bcs):
+                    episodes.append([VAL_POP_SIZE // 2 + val_idx, ppo_index, val_bc, []])
+
+        states = [mdp.get_standard_start_state() for _ in episodes]
+        returns = np.zeros(len(episodes))
+        ppo_indices = [ppo_index for _, ppo_index, _, _ in episodes]
+        start_time = time.perf_counter()
+
+        for _ in range(self.env_horizon):
+            ppo_actions = sample_actions(get_agent_action_probs(trained_agent, mdp, states, ppo_indices,
+                                                                batch_size=self.sim_threads))
+
+            partner_actions = [None] * len(episodes)
+            for val_bc in val_bcs:
+                bc_episodes = [i for i, episode in enumerate(episodes) if episode[2] is val_bc]
+                # (Featurized with the BC's own planner, as in its state policy)
+                bc_action_probs = get_agent_action_probs(val_bc, mdp, [states[i] for i in bc_episodes],
+                                                         [1 - ppo_indices[i] for i in bc_episodes],
+                                                         featurize_mlp=val_bc.mlp)
+                for i, action_probs in zip(bc_episodes, bc_action_probs):
+                    action_probs = unblock_bc_action_probs(action_probs, episodes[i][3],
+                                                           states[i].players[1 - ppo_indices[i]])
+                    partner_actions[i] = sample_actions([action_probs])[0]
+            for i, (_, _, partner, _) in enumerate(episodes):
+                if partner_actions[i] is None:
+                    partner_actions[i], _ = partner.action(states[i])
+
+            for i, (_, ppo_index, _, history) in enumerate(episodes):
+                history.append((states[i].players[1 - ppo_index], partner_actions[i]))
+                joint_action = (ppo_actions[i], partner_actions[i]) if ppo_index == 0 \
+                    else (partner_actions[i], ppo_actions[i])
+                states[i], sparse_reward, _ = mdp.get_state_transition(states[i], joint_action)
+                returns[i] += sparse_reward
+
+        time_taken = time.perf_counter() - start_time
+        print("Validation games: {} env steps per sec".format(
+            np.round(len(episodes) * self.env_horizon / time_taken)))
+
+        val_idx_each_episode = np.array([val_idx for val_idx, _, _, _ in episodes])
+        for val_idx, name in enumerate(partner_names):
+            print("Validation score with {}: {}".format(name, np.mean(returns[val_idx_each_episode == val_idx])))
+
+        # Each (val agent, ppo index) has the same number of games, so this is the same as play_validation_games
+        return np.mean(returns)
+
     def make_validation_population(self, layout):
         """Create a population of e.g. 10 BC agents and 10 TOM agents, which are different from the training populations.
         This population will be used as a validation set for the ppo."""
-
-        #== Settings needed ==#
-        val_pop_size = 20  # Don't change
-        bc_dir = DATA_DIR + 'bc_runs/'
-        #=====================#
-
-        validation_population = []
-        half_val_pop_size = int(val_pop_size / 2)
-
-        # Make TOM pop
         mlp = make_mlp(self.mdp)
         VAL_TOM_PARAMS, _, _ = import_manual_tom_params(layout, 20)
+        validation_population = self.make_validation_toms(mlp, VAL_TOM_PARAMS) + self.load_validation_bcs(layout)
+        assert len(validation_population) == VAL_POP_SIZE
+        return validation_population
 
-        for i in range(half_val_pop_size):
+    def make_validation_toms(self, mlp, val_tom_params):
+        validation_toms = []
+        for i in range(VAL_POP_SIZE // 2):
             tom_agent = make_tom_agent(mlp)
-            tom_agent.set_tom_params(None, None, VAL_TOM_PARAMS, tom_params_choice=i)
-            validation_population.append(tom_agent)
+            tom_agent.set_tom_params(None, None, val_tom_params, tom_params_choice=i)
+            validation_toms.append(tom_agent)
+        return validation_toms
 
-        # Make BC pop
-        VAL_BC_SEEDS = [720, 1343, 1903, 2212, 2598, 4389, 5108, 5958, 6573, 9735] \
-            if layout in ["coordination_ring", "counter_circuit"] else \
-            [2732, 3264, 3468, 4373, 4859, 5874, 6744, 7891, 9225, 9845]
+    def load_validation_bcs(self, layout):
+        bc_dir = DATA_DIR + 'bc_runs/'
+        validation_bcs = []
+        for seed in get_val_bc_seeds(layout):
+            bc_name = layout + "_test_{}".format(seed)
+            print("LOADING validation BC MODEL FROM: {}{}".format(bc_dir, bc_name))
+            bc_agent, _ = get_bc_agent_from_saved(bc_name, unblock_if_stuck=True,
+                                                   stochastic=True,
+                                                   overwrite_bc_save_dir=bc_dir, force_compute_mlp=True)
+            bc_agent.set_mdp(self.mdp)
+            validation_bcs.append(bc_agent)
+        return validation_bcs
 
-        mdp = self.mdp
-        for i, seed in enumerate(VAL_BC_SEEDS):
-            if i < half_val_pop_size:
 
-                bc_name = layout + "_test_{}".format(seed)
-                print("LOADING validation BC MODEL FROM: {}{}".format(bc_dir, bc_name))
-                bc_agent, _ = get_bc_agent_from_saved(bc_name, unblock_if_stuck=True,
-                                                       stochastic=True,
-                                                       overwrite_bc_save_dir=bc_dir, force_compute_mlp=True)
-                bc_agent.set_mdp(mdp)
-                validation_population.append(bc_agent)
+VAL_POP_SIZE = 20  # 10 ToMs and 10 BCs. Don't change
 
-        assert len(validation_population) == val_pop_size
-
-        return validation_population
+def get_val_bc_seeds(layout):
+    VAL_BC_SEEDS = [720, 1343, 1903, 2212, 2598, 4389, 5108, 5958, 6573, 9735] \
+        if layout in ["coordination_ring", "counter_circuit"] else \
+        [2732, 3264, 3468, 4373, 4859, 5874, 6744, 7891, 9225, 9845]
+    return VAL_BC_SEEDS[:VAL_POP_SIZE // 2]
 
 
 
@@ -1371,12 +1706,17 @@ def setup_agents_to_evaluate(mdp, agent_type, agent_run_name, agent_seeds, agent
     if agent_type != "ppo":
         assert agent_seeds is None, "For all agent types except ppo agents, agent_seeds should be None"
 
+    # The batch size of the ppo agents' policies (see get_agent_action_probs)
+    sim_threads = None
+
     if agent_type == "ppo":
         seeds = get_ppo_run_seeds(agent_run_name, use_data_dir=True) if agent_seeds is None else agent_seeds
         agents = []
         for seed in seeds:
             ppo_agent_base_path = DATA_DIR + agent_run_name + "/"
-            agent, _ = get_ppo_agent(ppo_agent_base_path, seed=seed, best="train")
+            agent, config = get_ppo_agent(ppo_agent_base_path, seed=seed, best="train")
+            assert sim_threads in [None, config["sim_threads"]], "All seeds should have the same sim_threads"
+            sim_threads = config["sim_threads"]
             agents.append(agent)
     elif agent_type == "bc":
         agents = [get_bc_agent(mdp)]
@@ -1392,7 +1732,7 @@ def setup_agents_to_evaluate(mdp, agent_type, agent_run_name, agent_seeds, agent
         raise ValueError("Unrecognized agent type")
 
     assert len(agents) > 0
-    return agents
+    return agents, sim_threads
 
 def get_bc_agent(mdp):
     """Return the BC agent for this layout and seed"""
@@ -1462,7 +1802,8 @@ all_tests = [Test1ai, Test1aii, Test1aiii, Test1bi, Test1bii, Test2a, Test2b,
              Test3ai, Test3aii, Test3aiii, Test3bi, Test3bii, Test3biii, Test4c, ValidationRewardTest]
 
 def run_tests(tests_to_run, layout, num_avg, agent_type, agent_run_folder, agent_run_name, agent_save_location,
-              agent_seeds, print_info, display_runs, num_val_games):
+              agent_seeds, print_info, display_runs, num_val_games, policy_probe, adaptive_ci_width, adaptive_threshold,
+              common_random_numbers, batched_validation):
 
     print("\nStarting qualitative expt with agent {}\n".format(agent_run_name))
 
@@ -1475,10 +1816,11 @@ def run_tests(tests_to_run, layout, num_avg, agent_type, agent_run_folder, agent
     # Set up agent to evaluate
     mdp = make_mdp(layout)
     agent_to_run = agent_run_folder + agent_run_name if agent_type == "ppo" else agent_type
-    agents_to_eval = setup_agents_to_evaluate(mdp, agent_type, agent_to_run, agent_seeds, agent_save_location)
+    agents_to_eval, sim_threads = setup_agents_to_evaluate(mdp, agent_type, agent_to_run, agent_seeds,
+                                                           agent_save_location)
 
     tests = {}
-    for test_class in all_tests:
+    for test_class in get_tests_to_run(tests_to_run):
         if layout not in test_class.valid_layouts:
             continue
 
@@ -1494,18 +1836,27 @@ def run_tests(tests_to_run, layout, num_avg, agent_type, agent_run_folder, agent
                 agent_run_name=agent_run_name, 
                 num_rollouts_per_initial_state=num_avg_this_test,
                 print_info=print_info, 
-                display_runs=display_runs
+                display_runs=display_runs,
+                policy_probe=policy_probe,
+                adaptive_ci_width=adaptive_ci_width,
+                adaptive_threshold=adaptive_threshold,
+                common_random_numbers=common_random_numbers,
+                sim_threads=sim_threads,
+                batched_validation=batched_validation
             )
             results_across_seeds.append(test_object.to_dict())
 
         tests[test_object.__class__.__name__] = aggregate_test_results_across_seeds(results_across_seeds)
+        if common_random_numbers:
+            print_paired_comparisons(tests[test_object.__class__.__name__])
         print("Test {} complete. Running time so far: {}mins".
               format(test_class, round((time.perf_counter() - start_time)/60, 1)))
 
     print("\nTest results:", tests)
 
     # Save results:
-    save_results(tests, agent_run_name, agent_type, num_avg, num_val_games, layout)
+    save_results(tests, agent_run_name, agent_type, num_avg, num_val_games, layout, policy_probe, tests_to_run,
+                 adaptive_ci_width, adaptive_threshold, common_random_numbers, agent_seeds)
 
     print("\nBreakdown for agent type {}, run name {}, on layout {}:".format(agent_type, agent_run_name, layout))
     state_robustness_tests = filter_tests_by_attribute(tests, "test_types", ["state_robustness"])
@@ -1526,28 +1877,69 @@ def run_tests(tests_to_run, layout, num_avg, agent_type, agent_run_folder, agent
 
     return tests
 
+def get_tests_to_run(tests_to_run):
+    """tests_to_run is either "all" or test class names separated by commas (e.g. Test1ai,Test2a)"""
+    if tests_to_run == "all":
+        return all_tests
+    test_names = tests_to_run.split(',')
+    all_test_names = [test_class.__name__ for test_class in all_tests]
+    for test_name in test_names:
+        assert test_name in all_test_names, "Unrecognized test {}. Choose from: {}".format(test_name, all_test_names)
+    # Keep the order of all_tests
+    return [test_class for test_class in all_tests if test_class.__name__ in test_names]
+
 
 ###########################
 # RESULT PROCESSING UTILS #
 ###########################
 
-def save_results(tests, agent_run_name, agent_type, num_avg, num_val_games, layout):
+def save_results(tests, agent_run_name, agent_type, num_avg, num_val_games, layout, policy_probe=False,
+                 tests_to_run="all", adaptive_ci_width=None, adaptive_threshold=None, common_random_numbers=False,
+                 agent_seeds=None):
     agent_save_name = agent_run_name if agent_type == "ppo" else "{}_{}".format(layout, agent_type)
     filename = DATA_DIR + 'qualitative_expts/results_{}_n{}_v{}'.format(agent_save_name, num_avg, num_val_games)
+    if agent_seeds is not None:
+        # So that runs of the same agent with different seeds (e.g. jobs split by seed) don't overwrite each other
+        filename += '_s' + agent_seeds.replace(',', '_')
+    if tests_to_run != "all":
+        # So that runs of different subsets of the tests don't overwrite each other
+        filename += '_' + tests_to_run.replace(',', '_')
+    if policy_probe:
+        filename += '_pp'
+    if adaptive_ci_width is not None:
+        filename += '_ciw{}'.format(adaptive_ci_width)
+    if adaptive_threshold is not None:
+        filename += '_cit{}'.format(adaptive_threshold)
+    if common_random_numbers:
+        filename += '_crn'
     save_pickle(tests, filename)
 
+# Entries of a test's dict that are different for each seed
+PER_SEED_RESULTS = ["success_rate", "num_rollouts_used", "successes_each_state"]
+
 def aggregate_test_results_across_seeds(results):
     for result_dict in results:
         for k, v in result_dict.items():
-            if k != "success_rate":
-                # All dict entries across seeds should be the same except for the success rate
+            if k not in PER_SEED_RESULTS:
+                # All dict entries across seeds should be the same except for the success rate etc.
                 assert v == results[0][k]
 
     final_dict = copy.deepcopy(results[0])
-    del final_dict["success_rate"]
-    final_dict["success_rate_across_seeds"] = [result["success_rate"] for result in results]
+    for k in PER_SEED_RESULTS:
+        del final_dict[k]
+        final_dict[k + "_across_seeds"] = [result[k] for result in results]
     return final_dict
 
+def print_paired_comparisons(test_dict):
+    """For a test run with common random numbers, print the paired difference between each seed and the first seed"""
+    successes_across_seeds = test_dict["successes_each_state_across_seeds"]
+    if successes_across_seeds[0] is None:
+        return
+    for i in range(1, len(successes_across_seeds)):
+        mean_diff, std_err = paired_comparison(successes_across_seeds[i], successes_across_seeds[0])
+        print("Seed idx {} minus seed idx 0: success diff {} +/- {} (paired)".format(i, np.round(mean_diff, 3),
+                                                                                 np.round(std_err, 3)))
+
 def filter_tests_by_attribute(tests_dict, attribute, value):
     """
     Returns tests that have `attribute` == `value`
@@ -1573,7 +1965,7 @@ if __name__ == "__main__":
     they can still play Overcooked from that position.
     """
     parser = ArgumentParser()
-    parser.add_argument("-t", "--tests_to_run", default="all")
+    parser.add_argument("-t", "--tests_to_run", default="all", help='"all", or test names separated by commas: Test1ai,Test2a')
     parser.add_argument("-l", "--layout", help="layout", required=True)
     parser.add_argument("-n", "--num_avg", type=int, required=False, default=1)
     parser.add_argument("-a_t", "--agent_type", type=str, required=False, default="ppo") # Must be one of ["ppo", "bc", "tom", "opt_tom"]
@@ -1585,6 +1977,20 @@ if __name__ == "__main__":
     parser.add_argument("-dr", "--display_runs", default=False, action='store_true')
     parser.add_argument("-nv", "--num_val_games", default=0, type=int,
                         help='Set to 0 to not play validation games. Need to be a multiple of 3!')
+    parser.add_argument("-pp", "--policy_probe", default=False, action='store_true',
+                        help='Evaluate tests that have a probe_horizon from the action probs, instead of rollouts')
+    parser.add_argument("-ciw", "--adaptive_ci_width", default=None, type=float, required=False,
+                        help='Adaptive mode: stop the rollouts from a state when the 95%% Wilson interval of its success '
+                             'rate is narrower than this (-n is then the max rollouts per state). E.g. 0.3')
+    parser.add_argument("-cit", "--adaptive_threshold", default=None, type=float, required=False,
+                        help='Adaptive mode: stop the rollouts from a state when the 95%% Wilson interval of its success '
+                             'rate is entirely above or below this threshold. E.g. 0.5')
+    parser.add_argument("-crn", "--common_random_numbers", default=False, action='store_true',
+                        help='Seed H and the agent per (state, rollout), so all agents face identical H-model noise and '
+                             'can be compared pairwise (see paired_comparison)')
+    parser.add_argument("-bv", "--batched_validation", default=False, action='store_true',
+                        help='Play the validation games of ppo agents in lockstep batches (faster, and the same games '
+                             'in distribution, but not the same random games as without -bv)')
 
     args = parser.parse_args()
     run_tests(**args.__dict__)
@@ -0,0 +1,94 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import baselines.ppo2.ppo2 as ppo2
+
+from human_ai_robustness.pbt_double_buffer import double_buffered_runner
+
+"""
+Tests that double buffering only changes how the batches are collected. update_double_buffered runs update_model (i.e.
+ppo2.learn) inside double_buffered_runner, so here a learn loop with a fake runner and model is run with and without
+double_buffered_runner, and the train_info keys and the LR/clipping schedule are compared
+"""
+
+NUM_ENVS, NSTEPS = 2, 3
+NUM_BATCHES = 5
+
+
+class FakeEnv(object):
+    num_envs = NUM_ENVS
+
+
+class FakeModel(object):
+    """The weights are a version number, which is copied into the behaviour model by sync"""
+
+    def __init__(self):
+        self.version = 0
+
+
+class FakeRunner(object):
+    """Each batch records the version of the weights it was collected with"""
+
+    def __init__(self, env, model, nsteps, gamma, lam):
+        self.model = model
+        self.num_runs = 0
+
+    def run(self):
+        self.num_runs += 1
+        return self.model.version
+
+
+def fake_learn(env, model, total_timesteps, lr, cliprange):
+    """The parts of ppo2.learn that matter here: it builds ppo2.Runner, then does nupdates updates, each on the next
+    batch, with the lr and cliprange annealed by frac"""
+    runner = ppo2.Runner(env=env, model=model, nsteps=NSTEPS, gamma=0.99, lam=0.98)
+    nupdates = total_timesteps // (env.num_envs * NSTEPS)
+    train_info = defaultdict(list)
+    for update in range(1, nupdates + 1):
+        frac = 1.0 - (update - 1.0) / nupdates
+        batch_version = runner.run()
+        train_info["lr"].append(lr(frac))
+        train_info["cliprange"].append(cliprange(frac))
+        train_info["batch_staleness"].append(model.version - batch_version)
+        model.version += 1  # The update
+    return train_info
+
+
+def run_learn(double_buffered, max_policy_staleness=1):
+    model, behaviour_model = FakeModel(), FakeModel()
+
+    def sync_behaviour_model():
+        behaviour_model.version = model.version
+
+    learn_args = (FakeEnv(), model, NUM_BATCHES * NUM_ENVS * NSTEPS, lambda f: 1e-3 * f, lambda f: 0.05)
+    if not double_buffered:
+        return fake_learn(*learn_args), None
+    with double_buffered_runner(behaviour_model, sync_behaviour_model, NUM_BATCHES * NUM_ENVS * NSTEPS,
+                                max_policy_staleness, ThreadPoolExecutor(1)) as runners:
+        train_info = fake_learn(*learn_args)
+    return train_info, runners
+
+
+def test_same_keys_and_schedule(monkeypatch):
+    monkeypatch.setattr(ppo2, "Runner", FakeRunner)
+    train_info, _ = run_learn(double_buffered=False)
+    train_info_db, runners = run_learn(double_buffered=True)
+    assert set(train_info_db.keys()) == set(train_info.keys())
+    assert train_info_db["lr"] == train_info["lr"]
+    assert train_info_db["cliprange"] == train_info["cliprange"]
+    # learn's runner is restored afterwards:
+    assert ppo2.Runner is FakeRunner
+
+    assert len(runners) == 1
+    # Exactly the batches learn asks for are collected, and none are left over:
+    assert runners[0].runner.num_runs == NUM_BATCHES
+    assert len(runners[0].stats["collect_time"]) == len(runners[0].stats["train_time"]) == NUM_BATCHES
+
+
+def test_policy_staleness(monkeypatch):
+    monkeypatch.setattr(ppo2, "Runner", FakeRunner)
+    for max_policy_staleness in [1, 2, 3]:
+        train_info, runners = run_learn(double_buffered=True, max_policy_staleness=max_policy_staleness)
+        assert train_info["batch_staleness"] == runners[0].stats["policy_staleness"]
+        assert np.max(train_info["batch_staleness"]) <= max_policy_staleness
+        assert train_info["batch_staleness"][0] == 0
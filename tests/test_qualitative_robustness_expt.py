@@ -0,0 +1,79 @@
+import numpy as np
+
+from overcooked_ai_py.mdp.actions import Action, Direction
+from overcooked_ai_py.mdp.overcooked_mdp import PlayerState
+from human_ai_robustness.qualitative_robustness_expt import get_agent_action_probs, unblock_bc_action_probs, \
+    BC_STUCK_TIME
+
+"""
+Tests of the batched action probs used by the policy probe and the batched validation games, with fake agents and a
+fake mdp (so no trained agents are needed)
+"""
+
+SIM_THREADS = 4
+
+
+class FakeMdp(object):
+    """Each state is a number, and the observation of player i is filled with that number (negated for player 1)"""
+
+    def lossless_state_encoding(self, state):
+        return [np.full((2, 3), state), np.full((2, 3), -state)]
+
+    def featurize_state(self, state, mlp):
+        return [np.full(5, state), np.full(5, -state)]
+
+
+def fake_action_probs(x):
+    probs = np.exp(np.arange(len(Action.ALL_ACTIONS)) * x)
+    return probs / probs.sum()
+
+
+class FakePpoAgent(object):
+    """Like a ppo agent's direct_policy (see get_model_policy), its input has a fixed batch size of sim_threads"""
+
+    def direct_policy(self, obs, stochastic=True, return_action_probs=False):
+        assert obs.shape[0] == SIM_THREADS, "The ppo policy only takes batches of sim_threads observations"
+        assert return_action_probs
+        return np.array([fake_action_probs(ob.flat[0]) for ob in obs])
+
+
+class FakeBcAgent(object):
+    """Like a BC agent's direct_policy, which returns action probs by default and has no return_action_probs"""
+
+    def direct_policy(self, obs, include_waits=True, stochastic=False):
+        return np.array([fake_action_probs(ob[0]) for ob in obs])
+
+
+def test_ppo_action_probs_any_batch_size():
+    mdp = FakeMdp()
+    for num_states in [1, SIM_THREADS - 1, SIM_THREADS, 2 * SIM_THREADS + 1]:
+        states = list(range(num_states))
+        agent_indices = [state % 2 for state in states]
+        action_probs = get_agent_action_probs(FakePpoAgent(), mdp, states, agent_indices, batch_size=SIM_THREADS)
+        expected = [fake_action_probs(state if idx == 0 else -state) for state, idx in zip(states, agent_indices)]
+        assert np.allclose(action_probs, expected)
+
+
+def test_bc_action_probs():
+    states = [0, 1, 2]
+    action_probs = get_agent_action_probs(FakeBcAgent(), FakeMdp(), states, 1, featurize_mlp=object())
+    assert np.allclose(action_probs, [fake_action_probs(-state) for state in states])
+
+
+def test_unblock_bc_action_probs():
+    action_probs = np.ones(len(Action.ALL_ACTIONS)) / len(Action.ALL_ACTIONS)
+    stuck_player = PlayerState((1, 1), Direction.NORTH)
+    last_actions = [Direction.NORTH, Direction.EAST, Action.INTERACT]
+    # History of the last BC_STUCK_TIME + 1 timesteps, all in the same position and orientation:
+    history = [(stuck_player, Action.STAY)] + [(stuck_player, action) for action in last_actions]
+    assert len(history) == BC_STUCK_TIME + 1
+
+    unblocked = unblock_bc_action_probs(action_probs, history, stuck_player)
+    for action in Action.ALL_ACTIONS:
+        assert (unblocked[Action.ACTION_TO_INDEX[action]] == 0) == (action in last_actions)
+    assert np.isclose(np.sum(unblocked), 1)
+
+    # Not stuck if the current state differs, or without a full history:
+    moved_player = PlayerState((2, 1), Direction.NORTH)
+    assert np.all(unblock_bc_action_probs(action_probs, history, moved_player) == action_probs)
+    assert np.all(unblock_bc_action_probs(action_probs, history[1:], stuck_player) == action_probs)
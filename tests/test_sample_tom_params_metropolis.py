@@ -0,0 +1,58 @@
+import numpy as np
+
+from human_ai_robustness.analyse_optimise_agents.sample_tom_params_metropolis import delayed_acceptance_log_ratio
+
+"""
+Tests that delayed acceptance keeps the (tempered) posterior stationary, on a toy discrete target: the states are
+points on a ring, the proposal is a symmetric step to a neighbour, and the screen is a different (cheap) likelihood.
+The transition matrix of the two stage step is found exactly, so there's no sampling noise
+"""
+
+NUM_STATES = 7
+INVERSE_TEMP = 0.7
+
+
+def toy_log_probs(seed):
+    return np.random.RandomState(seed).randn(NUM_STATES) * 2
+
+
+def delayed_acceptance_transitions(log_probs, screen_log_probs, inverse_temp, log_ratio_fn):
+    """The transition matrix of delayed_acceptance_step's acceptance rule, with the neighbour proposal"""
+    transitions = np.zeros((NUM_STATES, NUM_STATES))
+    for x in range(NUM_STATES):
+        for y in [(x - 1) % NUM_STATES, (x + 1) % NUM_STATES]:
+            log_screen_ratio = inverse_temp * (screen_log_probs[y] - screen_log_probs[x])
+            log_ratio = log_ratio_fn(inverse_temp * (log_probs[y] - log_probs[x]), log_screen_ratio)
+            transitions[x, y] = 0.5 * min(1, np.exp(log_screen_ratio)) * min(1, np.exp(log_ratio))
+        transitions[x, x] = 1 - transitions[x].sum()
+    return transitions
+
+
+def tempered_posterior(log_probs, inverse_temp):
+    weights = np.exp(inverse_temp * (log_probs - np.max(log_probs)))
+    return weights / weights.sum()
+
+
+def test_stationary():
+    for seed in range(5):
+        log_probs, screen_log_probs = toy_log_probs(seed), toy_log_probs(seed + 100)
+        posterior = tempered_posterior(log_probs, INVERSE_TEMP)
+        transitions = delayed_acceptance_transitions(log_probs, screen_log_probs, INVERSE_TEMP,
+                                                     delayed_acceptance_log_ratio)
+        assert np.all(transitions >= 0)
+        assert np.allclose(posterior @ transitions, posterior)
+        # Detailed balance:
+        flows = posterior[:, None] * transitions
+        assert np.allclose(flows, flows.T)
+
+
+def test_screen_terms():
+    # Dividing by the forward screen prob only (without the reverse move's screen prob) isn't stationary:
+    log_probs, screen_log_probs = toy_log_probs(0), toy_log_probs(100)
+    posterior = tempered_posterior(log_probs, INVERSE_TEMP)
+    transitions = delayed_acceptance_transitions(log_probs, screen_log_probs, INVERSE_TEMP,
+                                                 lambda full, screen: full - min(0, screen))
+    assert not np.allclose(posterior @ transitions, posterior)
+    # With the screen equal to the full likelihood, every candidate that passes the screen is accepted:
+    for log_ratio in [-3., -0.5, 0., 0.5, 3.]:
+        assert delayed_acceptance_log_ratio(log_ratio, log_ratio) == 0